@@ -1,4 +1,6 @@
 import os
+import time
+import logging
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
@@ -6,12 +8,58 @@ import tornado.auth
 import tornado.escape
 from tornado.escape import json_encode as encode
 from tornado.escape import json_decode as decode
+from tornado.escape import to_unicode
 import tornado.options
-from tornado.options import define, options
 import uimodules
+from tornado import gen
 
-import redis
-r = redis.Redis()
+import models
+import sessions
+import realtime
+import metrics
+import shard
+import memory
+
+class CountingClient(object):
+    '''Wraps an async client (``models.async_client``) and counts the round
+    trips made through it
+
+    Each command is also recorded in ``metrics.registry`` under ``context``.'''
+    def __init__(self, client, context='other'):
+        self._client = client
+        self.context = context
+        self.calls = 0
+
+    def _counted(self, command, method):
+        @gen.coroutine
+        def call(*args, **kwargs):
+            self.calls += 1
+            start = time.time()
+            reply = yield method(*args, **kwargs)
+            metrics.registry.record(command, args, reply, self.context, time.time() - start)
+            raise gen.Return(reply)
+        return call
+
+    def pipeline(self, transaction=True):
+        pipe = self._client.pipeline(transaction=transaction)
+        execute = pipe.execute
+        # the whole pipeline is one round trip
+        @gen.coroutine
+        def counted():
+            self.calls += 1
+            stack = [ (str(args[0]).upper(), args[1:]) for args, _ in pipe.command_stack ]
+            start = time.time()
+            replies = yield execute()
+            metrics.registry.record_pipeline(stack, replies, self.context, time.time() - start)
+            raise gen.Return(replies)
+        pipe.execute = counted
+        return pipe
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+        return self._counted(attr.upper(), value)
 
 class BaseHandler(tornado.web.RequestHandler):
     '''
@@ -19,40 +67,110 @@ class BaseHandler(tornado.web.RequestHandler):
     >>> r.SUPPORTED_METHODS
     ('GET', 'HEAD', 'POST', 'DELETE', 'PUT')
     '''
+    services = models.services
+
+    @property
+    def ar(self):
+        '''Non-blocking redis client for this request'''
+        if not hasattr(self, '_ar'):
+            self._ar = CountingClient(models.async_client(), self.__class__.__name__)
+        return self._ar
+
+    @property
+    def redis_calls(self):
+        '''Number of redis round trips this request has made so far'''
+        return self._ar.calls if hasattr(self, '_ar') else 0
+
+    def memo(self, key, compute):
+        '''Request-scoped cache, ``compute`` runs at most once per key per request'''
+        if not hasattr(self, '_memo'):
+            self._memo = {}
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def get_secure_cookie(self, name, value=None, *args, **kwargs):
+        # decode and check the signature of each cookie once per request, as text
+        if value is not None:
+            return to_unicode(super(BaseHandler, self).get_secure_cookie(name, value, *args, **kwargs))
+        return self.memo(('cookie', name), lambda: to_unicode(super(BaseHandler, self).get_secure_cookie(name, *args, **kwargs)))
+
+    def finish(self, *args, **kwargs):
+        self.set_header('X-Redis-Calls', self.redis_calls)
+        return super(BaseHandler, self).finish(*args, **kwargs)
+
+    def on_finish(self):
+        logging.debug('%s %s made %d redis calls', self.request.method, self.request.path, self.redis_calls)
+
+    @gen.coroutine
+    def prepare(self):
+        '''Load the user and their stored service json without blocking the IOLoop
+
+        Every linked service comes back in one HGETALL of their profiles.'''
+        self._current_user = None
+        self._stored = {}
+        # model instances are shared for the length of the request
+        self.identity_map = models.IdentityMap()
+        name = yield self.session_user()
+        if name:
+            self._current_user = name
+            pipe = self.ar.pipeline(transaction=False)
+            pipe.hgetall(models.User._profiles % name)
+            # the keys from before profiles, until profiles.py has moved them
+            pipe.mget([ '%s:%s' % (name, s) for s in self.services ])
+            profiles, old = yield pipe.execute()
+            self._stored = dict( (s, (profiles or {}).get(s) or o) for s, o in zip(self.services, old) )
+
+    def save_profile(self, name, service, info):
+        '''Store the latest json from ``service`` for the user'''
+        return self.ar.hset(models.User._profiles % name, service, encode(info))
+
+    @gen.coroutine
+    def session_user(self):
+        '''Username for the session cookie, one O(1) lookup'''
+        token = self.get_secure_cookie('session')
+        if token:
+            name = yield sessions.lookup(self.ar, token)
+            raise gen.Return(name)
+        # cookies from before sessions, upgrade them as they come in
+        name = self.get_secure_cookie("user")
+        if name and (yield self.ar.sismember('___users', name)):
+            yield self.start_session(name)
+            self.clear_cookie('user')
+            raise gen.Return(name)
+
+    @gen.coroutine
+    def start_session(self, name):
+        token = yield sessions.start(self.ar, name)
+        self.set_secure_cookie('session', token)
+
+    def service_json(self, service):
+        return self.get_secure_cookie(service) or self._stored.get(service)
+    def service(self, service):
+        '''Decoded json for the service, decoded once per request'''
+        def load():
+            json = self.service_json(service)
+            return decode(json) if json else None
+        return self.memo(('service', service), load)
+
     def google_json(self):
-        c = self.get_secure_cookie('google')
-        if c:
-            return c
-        elif self.name():
-            d = r.get('%s%s' % (self.name(), ':google'))
-            return d
+        return self.service_json('google')
     def _google(self):
-        return decode(self.google_json()) if self.google_json() else None
+        return self.service('google')
 
     def twitter_json(self):
-        c = self.get_secure_cookie('twitter')
-        if c:
-            return c
-        elif self.name():
-            d = r.get('%s%s' % (self.name(), ':twitter'))
-            return d
+        return self.service_json('twitter')
     def _twitter(self):
-        return decode(self.twitter_json()) if self.twitter_json() else None
+        return self.service('twitter')
 
     def facebook_json(self):
-        c = self.get_secure_cookie('facebook')
-        if c:
-            return c
-        elif self.name():
-            d = r.get('%s%s' % (self.name(), ':facebook'))
-            return d
+        return self.service_json('facebook')
     def _facebook(self):
-        return decode(self.facebook_json()) if self.facebook_json() else None
+        return self.service('facebook')
 
     def get_current_user(self):
-        name = self.get_secure_cookie("user")
-        if name in r.smembers('___users'):
-            return name
+        # filled in by prepare
+        return self._current_user
     def name(self):
         return self.get_current_user()
 
@@ -69,7 +187,9 @@ class BaseHandler(tornado.web.RequestHandler):
 
 class AuthHandler(BaseHandler):
     '''Maybe there will be common attrs to all Auth Handlers?'''
-    pass
+    def redirect_uri(self):
+        '''Where the service sends the browser back to, this same url'''
+        return '%s://%s%s' % (self.request.protocol, self.request.host, self.request.path)
 
 class MainHandler(BaseHandler):
     @tornado.web.authenticated
@@ -80,7 +200,12 @@ class MainHandler(BaseHandler):
 
 class LogoutHandler(BaseHandler):
     '''logout the user and redirect to login'''
+    @gen.coroutine
     def get(self):
+        token = self.get_secure_cookie('session')
+        if token:
+            yield sessions.end(self.ar, token)
+        self.clear_cookie('session')
         self.clear_cookie('user')
         self.clear_cookie('google')
         self.clear_cookie('twitter')
@@ -100,58 +225,148 @@ class CreateHandler(BaseHandler):
     '''We come here with a cookie from somewhere but no User so we get a username and create'''
     def get(self):
         self.render('templates/auth/create.html', **self.common_context())
+    @gen.coroutine
     def post(self):
         name = self.get_argument('key')
-        if name and not name in r.smembers('___users'):
+        # SADD tells us if the name was free and claims it in one step
+        if name and (yield self.ar.sadd('___users', name)):
+            if not (yield models.User.async_create(self.ar, name)):
+                # taken in another case, 'Sam' is 'sam' to the models
+                yield self.ar.srem('___users', name)
+                raise tornado.web.HTTPError(403)
             twitter = self.get_secure_cookie('twitter')
             google = self.get_secure_cookie('google')
             facebook = self.get_secure_cookie('facebook')
-            r.sadd('___users', name)
-            self.set_secure_cookie("user", name)
+            yield self.start_session(name)
+            # all of the writes go out in one round trip
+            pipe = self.ar.pipeline()
+            models.add_username(name, pipe)
+            profiles = models.User._profiles % name
             if twitter:
-                r.set('%s%s' % (name, ':twitter'), twitter)
-                r.set('%s%s' % ('twitter:', self._twitter()['access_token']['user_id']), name)
+                pipe.hset(profiles, 'twitter', twitter)
+                pipe.set('%s%s' % ('twitter:', self._twitter()['access_token']['user_id']), name)
             if google:
-                r.set('%s%s' % (name, ':google'), google)
-                r.set('%s%s' % ('google:', self._google()['email']), name)
+                pipe.hset(profiles, 'google', google)
+                pipe.set('%s%s' % ('google:', self._google()['email']), name)
             if facebook:
-                r.set('%s%s' % (name, ':facebook'), facebook)
-                r.set('%s%s' % ('facebook:', self._facebook()['uid']), name)
+                pipe.hset(profiles, 'facebook', facebook)
+                pipe.set('%s%s' % ('facebook:', self._facebook()['id']), name)
+            if pipe.command_stack:
+                yield pipe.execute()
             next = self.get_argument('next')
             if next == '/create':
                 self.redirect('/')
             else:
                 self.redirect(next)
         else:
-            # we need to return forbidden here, can't create a key that exists
-            pass
+            # can't create a key that exists
+            raise tornado.web.HTTPError(403)
+
+class CheckUserName(BaseHandler):
+    '''Called on every keystroke of the signup form
 
-class CheckUserName(tornado.web.RequestHandler):
+    Most keys are not in ``models.usernames`` and are answered without
+    touching redis, a possible hit is confirmed with SISMEMBER.  The filter
+    is only a hint: names from other processes arrive over pub/sub and one
+    published while we weren't listening is missed until a restart, so a
+    taken name can come back as free.  CreateHandler's SADD is the real check.'''
+    @gen.coroutine
+    def prepare(self):
+        # no user or services needed here
+        self._current_user = None
+        self._stored = {}
+
+    @gen.coroutine
     def get(self):
         key = self.get_argument('key')
-        if r.sismember('___users', key):
+        taken = False
+        if key in models.usernames:
+            taken = yield self.ar.sismember('___users', key)
+        if taken:
             self.write('false')
         else:
             self.write('true')
 
-class GoogleHandler(AuthHandler, tornado.auth.GoogleMixin):
+class SearchHandler(BaseHandler):
+    '''Items we can see matching ``q``, best first, as json
+
+    Pass the ``cursor`` from the last page for the next one.'''
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self):
+        try:
+            count = int(self.get_argument('count', 20))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'count is not a number')
+        # 0 would never get past the cursor it was given
+        count = max(1, min(count, 100))
+        user = yield models.User.fetch_by_name(self.name(), self.ar, self.identity_map)
+        ids, cursor = yield user.fetch_search_items(self.ar, self.get_argument('q', ''),
+                self.get_argument('cursor', None), count)
+        names = yield models.Item.fetch_names(ids, self.ar)
+        self.write({'items': [ {'id': id, 'name': names[id]} for id in ids if names[id] ],
+            'cursor': cursor})
+
+class GroupsHandler(BaseHandler):
+    '''POST ``name`` (or json) to create a group, answers its id'''
+    @tornado.web.authenticated
+    @gen.coroutine
+    def post(self):
+        user = yield models.User.fetch_by_name(self.name(), self.ar, self.identity_map)
+        group_id = yield user.async_create_group(self.ar, self.get_argument('name'))
+        self.write({'id': group_id})
+
+class UpdatesHandler(BaseHandler):
+    '''POST ``text`` to add an update, to a ``group`` or ``item`` we can see if given'''
+    @tornado.web.authenticated
+    @gen.coroutine
+    def post(self):
+        user = yield models.User.fetch_by_name(self.name(), self.ar, self.identity_map)
+        group_id = self.get_argument('group', None)
+        item_id = self.get_argument('item', None)
+        if group_id and not (yield user.fetch_visible_groups(self.ar, [group_id])):
+            raise tornado.web.HTTPError(403)
+        if item_id and not (yield user.fetch_visible_items(self.ar, [item_id])):
+            raise tornado.web.HTTPError(403)
+        update_id = yield user.async_add_update(self.ar, self.get_argument('text'),
+                group_id=group_id, item_id=item_id)
+        self.write({'id': update_id})
+
+class AssignHandler(BaseHandler):
+    '''POST to join an item we can see'''
+    @tornado.web.authenticated
+    @gen.coroutine
+    def post(self, item_id):
+        user = yield models.User.fetch_by_name(self.name(), self.ar, self.identity_map)
+        if not (yield user.fetch_visible_items(self.ar, [item_id])):
+            raise tornado.web.HTTPError(403)
+        yield user.async_assign_item(self.ar, item_id)
+        self.write({'id': item_id})
+
+class GoogleHandler(AuthHandler, tornado.auth.GoogleOAuth2Mixin):
     '''get the form, post and login or create'''
-    @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
-        if self.get_argument("openid.mode", None):
-            self.get_authenticated_user(self.async_callback(self._on_auth))
+        if self.get_argument("code", None):
+            access = yield self.get_authenticated_user(redirect_uri=self.redirect_uri(),
+                    code=self.get_argument("code"))
+            google = yield self.oauth2_request("https://www.googleapis.com/oauth2/v1/userinfo",
+                    access_token=access["access_token"])
+            yield self._on_auth(google)
             return
-        self.authenticate_redirect()
+        self.authorize_redirect(redirect_uri=self.redirect_uri(),
+                client_id=self.settings["google_oauth"]["key"],
+                scope=["profile", "email"], response_type="code")
 
+    @gen.coroutine
     def _on_auth(self, google):
         if not google:
             raise tornado.web.HTTPError(500, "Google auth failed")
         google_key = "%s%s" % ('google:', google['email'])
-        username = r.get(google_key)
-        google_info_key = "%s%s" % (username, ':google')
+        username = yield self.ar.get(google_key)
         if username:
-            self.set_secure_cookie("user", username)
-            r.set(google_info_key, encode(google))
+            yield self.start_session(username)
+            yield self.save_profile(username, 'google', google)
             self.redirect("/")
         else:
             self.set_secure_cookie("google", tornado.escape.json_encode(google))
@@ -159,46 +374,53 @@ class GoogleHandler(AuthHandler, tornado.auth.GoogleMixin):
 
 class TwitterHandler(AuthHandler, tornado.auth.TwitterMixin):
     '''Authenticate with Twitter and save all of the relevant bits'''
-    @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
         if self.get_argument("oauth_token", None):
-            self.get_authenticated_user(self.async_callback(self._on_auth))
+            twitter = yield self.get_authenticated_user()
+            yield self._on_auth(twitter)
             return
-        self.authorize_redirect()
+        # fetches a request token before redirecting
+        yield self.authorize_redirect()
 
+    @gen.coroutine
     def _on_auth(self, twitter):
         if not twitter:
             raise tornado.web.HTTPError(500, "Twitter auth failed")
         twitter_key = "%s%s" % ('twitter:', twitter['access_token']['user_id'])
-        username = r.get(twitter_key) # see if we have a user with that twitter id
-        twitter_info_key = "%s%s" % (username, ':twitter')
+        username = yield self.ar.get(twitter_key) # see if we have a user with that twitter id
         if username:
-            self.set_secure_cookie("user", username)
+            yield self.start_session(username)
             # write the lates information to redis
-            r.set(twitter_info_key, encode(twitter))
+            yield self.save_profile(username, 'twitter', twitter)
             self.redirect("/")
         else:
             self.set_secure_cookie("twitter", encode(twitter))
             self.redirect("/create")
 
-class FacebookHandler(AuthHandler, tornado.auth.FacebookMixin):
+class FacebookHandler(AuthHandler, tornado.auth.FacebookGraphMixin):
     '''login with facebook and redirect to `/`'''
-    @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
-        if self.get_argument("session", None):
-            self.get_authenticated_user(self.async_callback(self._on_auth))
+        if self.get_argument("code", None):
+            facebook = yield self.get_authenticated_user(redirect_uri=self.redirect_uri(),
+                    client_id=self.settings["facebook_api_key"],
+                    client_secret=self.settings["facebook_secret"],
+                    code=self.get_argument("code"))
+            yield self._on_auth(facebook)
             return
-        self.authenticate_redirect()
+        self.authorize_redirect(redirect_uri=self.redirect_uri(),
+                client_id=self.settings["facebook_api_key"], extra_params={"scope": "email"})
 
+    @gen.coroutine
     def _on_auth(self, facebook):
         if not facebook:
             raise tornado.web.HTTPError(500, "Facebook auth failed")
-        facebook_key = "%s%s" % ('facebook:', facebook['uid'])
-        username = r.get(facebook_key)
-        facebook_info_key = "%s%s" % (username, ':facebook')
+        facebook_key = "%s%s" % ('facebook:', facebook['id'])
+        username = yield self.ar.get(facebook_key)
         if username:
-            self.set_secure_cookie("user", username)
-            r.set(facebook_info_key, encode(facebook))
+            yield self.start_session(username)
+            yield self.save_profile(username, 'facebook', facebook)
             self.redirect("/")
         else:
             self.set_secure_cookie("facebook", encode(facebook))
@@ -214,10 +436,23 @@ urls = [
     (r'/facebook', FacebookHandler),
     (r'/create', CreateHandler),
     (r'/check-username', CheckUserName),
+    (r'/search', SearchHandler),
+    (r'/groups', GroupsHandler),
+    (r'/updates', UpdatesHandler),
+    (r'/items/(\d+)/assign', AssignHandler),
+    # realtime
+    (r'/updates/socket', realtime.UpdatesSocket),
+    (r'/updates/poll', realtime.UpdatesPoll),
+    (r'/metrics', metrics.MetricsHandler),
 ]
 
-from local_settings import twitter_consumer_key, twitter_consumer_secret, facebook_api_key, facebook_secret,\
-        friendfeed_consumer_key, friendfeed_consumer_secret
+try:
+    import local_settings
+except ImportError:
+    local_settings = None # the logins need keys, everything else runs without
+
+def setting(name):
+    return getattr(local_settings, name, None)
 
 settings = {
     "static_path": os.path.join(os.path.dirname(__file__), "static"),
@@ -226,21 +461,29 @@ settings = {
     "xsrf_cookies": True,
     "ui_modules": uimodules,
     # these credentials are good for localhost:8000
-    "twitter_consumer_key": twitter_consumer_key
-    "twitter_consumer_secret": twitter_consumer_secret,
-    "facebook_api_key": facebook_api_key,
-    "facebook_secret": facebook_secret,
-    "friendfeed_consumer_key": friendfeed_consumer_key,
-    "friendfeed_consumer_secret": friendfeed_consumer_secret,
+    "google_oauth": {"key": setting('google_client_id'), "secret": setting('google_client_secret')},
+    "twitter_consumer_key": setting('twitter_consumer_key'),
+    "twitter_consumer_secret": setting('twitter_consumer_secret'),
+    "facebook_api_key": setting('facebook_api_key'),
+    "facebook_secret": setting('facebook_secret'),
+    "friendfeed_consumer_key": setting('friendfeed_consumer_key'),
+    "friendfeed_consumer_secret": setting('friendfeed_consumer_secret'),
 }
 application = tornado.web.Application(urls, **settings)
 
 # can't get this to work :(
 import tornado.autoreload
 
+# one process for development, server.py runs a worker per cpu
 if __name__ == "__main__":
     #tornado.locale.load_translations(
     #    os.path.join(os.path.dirname(__file__), "translations"))
+    tornado.options.parse_command_line()
+    shard.install()
+    memory.install()
+    models.set_packed(tornado.options.options.packed)
+    models.load_usernames()
+    realtime.hub.start()
     http_server = tornado.httpserver.HTTPServer(application)
     http_server.listen(8000)
     t=tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,255 @@
+'''Benchmark the models and handlers against a throwaway redis-server
+
+    python bench.py [--number=2000] [--concurrency=20] [--output=run.json]
+    python bench.py --compare=before.json
+
+Starts ``--redis_server`` on ``--port`` with persistence off, points
+``models.r`` and the async pool at it and kills it at the end, so nothing
+touches the redis on 6379.  Pass ``--external`` to use an already running
+server on ``--port`` instead; it gets FLUSHDB'd.
+
+Every benchmark reports ops/sec, latency percentiles in ms and the redis
+commands per op (from INFO total_commands_processed).  Handlers also report
+round trips per request from the X-Redis-Calls header.  ``--backend=memory``
+times the models on ``memory.MemoryRedis`` instead, commands are not counted.  ``--output`` writes
+the results as JSON, ``--compare`` prints the change against an earlier run.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+from tornado.options import define, options, parse_command_line
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.web import create_signed_value
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+import redis
+from redis import asyncio as aioredis
+
+import models
+import memory
+import sessions
+from models import User, Item, Group
+
+define('port', default=6390, type=int, help='port for the throwaway redis-server')
+define('redis_server', default='redis-server', help='redis-server binary')
+define('external', default=False, type=bool, help='use a running server on --port, it is flushed')
+define('number', default=2000, type=int, help='operations per benchmark')
+define('concurrency', default=20, type=int, help='requests in flight for the handler benchmarks')
+define('only', default='', help='comma separated benchmark names to run')
+define('output', default='', help='write the results here as JSON')
+define('backend', default='redis', help="'memory' runs the model benchmarks in process, no server or handlers")
+define('compare', default='', help='JSON from an earlier run to compare against')
+
+xsrf = 'benchxsrftoken'
+
+def start_redis():
+    '''A redis-server that keeps nothing on disk, returns the process'''
+    process = subprocess.Popen([options.redis_server, '--port', str(options.port),
+        '--save', '', '--appendonly', 'no'], stdout=open(os.devnull, 'w'))
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', options.port), 0.1).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+    process.kill()
+    raise Exception('redis-server did not start on port %s' % options.port)
+
+def use_port(port):
+    '''Point the models at our server.  The scripts are registered on
+    ``models.r`` so it keeps its identity and gets a new pool.'''
+    models.r.connection_pool = redis.ConnectionPool(port=port, decode_responses=True)
+    models.async_pool = aioredis.BlockingConnectionPool(max_connections=250, port=port,
+            decode_responses=True)
+
+def commands():
+    # the INFO call itself is counted too, take it back off
+    return models.r.info('stats')['total_commands_processed'] - 1
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+def summary(latencies, elapsed, commands_run, **extra):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    result = {'ops': n, 'ops_per_sec': n / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000, 'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000, 'max_ms': latencies[-1] * 1000,
+        'commands_per_op': float(commands_run) / n}
+    result.update(extra)
+    return result
+
+def measure(op, n):
+    '''Run ``op(i)`` for i in range(n), each as its own "request"'''
+    before = commands()
+    latencies = []
+    start = time.time()
+    for i in range(n):
+        t = time.time()
+        op(i)
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    return summary(latencies, elapsed, commands() - before)
+
+class Fixture(object):
+    '''A user with some groups, items, components and updates to read'''
+    def __init__(self, n):
+        self.user = User(name='bench', create=True)
+        self.items = self.user.create_items([ 'item %s' % i for i in range(n) ])
+        self.groups = [ self.user.create_group('group %s' % i) for i in range(10) ]
+        self.item = self.user.create_item('components')
+        item = Item(self.item)
+        for i in range(50):
+            item.add_component(json.dumps({'name': 'component %s' % i}))
+        for i in range(50):
+            self.user.add_update('update %s' % i)
+
+def model_benchmarks(fixture, n):
+    u, items = fixture.user, fixture.items
+    return [
+        ('user_create', lambda i: User(name='user%s' % i, create=True)),
+        ('user_read', lambda i: User(u.id).name),
+        ('item_create', lambda i: u.create_item('new item %s' % i)),
+        ('item_read', lambda i: Item(items[i % len(items)]).name),
+        ('item_set_attr', lambda i: Item(items[i % len(items)]).set_string_attr('color', 'red')),
+        ('item_delete', lambda i: u.destroy_item(items[i])),
+        ('group_create', lambda i: u.create_group('new group %s' % i)),
+        ('group_read', lambda i: Group(fixture.groups[i % 10]).name),
+        ('groups', lambda i: u.groups()),
+        ('update_texts', lambda i: u.update_texts()),
+        ('components', lambda i: Item(fixture.item).components()),
+    ]
+
+@gen.coroutine
+def load(make_request, n, concurrency):
+    '''Keep ``concurrency`` requests in flight until ``n`` have finished'''
+    client = AsyncHTTPClient(max_clients=concurrency)
+    latencies, calls, errors = [], [], [0]
+    counter = iter(range(n))
+
+    @gen.coroutine
+    def worker():
+        for i in counter:
+            t = time.time()
+            try:
+                response = yield client.fetch(make_request(i))
+            except HTTPError as e:
+                response = e.response
+                # redirects count, they are what these handlers answer with
+                if e.code >= 400 or response is None:
+                    errors[0] += 1
+            latencies.append(time.time() - t)
+            if response is not None:
+                calls.append(int(response.headers.get('X-Redis-Calls', 0)))
+
+    before = commands()
+    start = time.time()
+    yield [ worker() for _ in range(concurrency) ]
+    elapsed = time.time() - start
+    raise gen.Return(summary(latencies, elapsed, commands() - before, errors=errors[0],
+        round_trips_per_op=float(sum(calls)) / max(len(calls), 1)))
+
+def handler_benchmarks(fixture, http_port):
+    base = 'http://localhost:%s' % http_port
+    taken = fixture.user.name
+    token = IOLoop.instance().run_sync(lambda: sessions.start(models.async_client(), taken))
+    import app
+    session = create_signed_value(app.settings['cookie_secret'], 'session', token)
+
+    def main(i):
+        return HTTPRequest(base + '/', headers={'Cookie': 'session=%s' % session},
+                follow_redirects=False)
+    def create(i):
+        return HTTPRequest(base + '/create', method='POST', follow_redirects=False,
+                headers={'Cookie': '_xsrf=%s' % xsrf},
+                body='_xsrf=%s&key=newuser%s&next=/' % (xsrf, i))
+    def check_free(i):
+        return HTTPRequest(base + '/check-username?key=free%s' % i)
+    def check_taken(i):
+        return HTTPRequest(base + '/check-username?key=%s' % taken)
+
+    return [('MainHandler', main), ('CreateHandler', create),
+        ('check_username_free', check_free), ('check_username_taken', check_taken)]
+
+def compare(results, path):
+    old = json.load(open(path))['results']
+    for name in sorted(set(results) & set(old)):
+        new, before = results[name], old[name]
+        print('%-22s ops/sec %9.0f -> %9.0f (%+.0f%%)   p99 %7.2f -> %7.2f ms   commands/op %5.1f -> %5.1f' % (
+            name, before['ops_per_sec'], new['ops_per_sec'],
+            100.0 * (new['ops_per_sec'] / before['ops_per_sec'] - 1),
+            before['p99_ms'], new['p99_ms'], before['commands_per_op'], new['commands_per_op']))
+
+def report(results):
+    for name, result in results.items():
+        print('%-22s %9.0f ops/sec   p50 %6.2f  p90 %6.2f  p99 %6.2f ms   %5.1f commands/op' % (
+            name, result['ops_per_sec'], result['p50_ms'], result['p90_ms'],
+            result['p99_ms'], result['commands_per_op']))
+
+def run(handlers=True):
+    only = set(filter(None, options.only.split(',')))
+    wanted = lambda name: not only or name in only
+    n = options.number
+    models.r.flushdb()
+    fixture = Fixture(n)
+    models.load_usernames()
+
+    results = {}
+    for name, op in model_benchmarks(fixture, n):
+        if wanted(name):
+            results[name] = measure(op, n)
+    if not handlers:
+        return results
+
+    try:
+        import app
+    except ImportError as e:
+        # app needs local_settings.py for its oauth keys
+        print('skipping the handler benchmarks: %s' % e)
+        return results
+    http = HTTPServer(app.application)
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    http_port = sock.getsockname()[1]
+    sock.close()
+    http.listen(http_port, 'localhost')
+    for name, make_request in handler_benchmarks(fixture, http_port):
+        if wanted(name):
+            results[name] = IOLoop.instance().run_sync(
+                    lambda: load(make_request, n, options.concurrency))
+    http.stop()
+    return results
+
+def main():
+    parse_command_line()
+    if options.backend == 'memory':
+        models.use_client(memory.MemoryRedis())
+        info, results = {'redis_version': 'memory'}, run(handlers=False)
+        return finish(info, results)
+    process = None if options.external else start_redis()
+    try:
+        use_port(options.port)
+        info = models.r.info()
+        results = run()
+    finally:
+        if process:
+            process.kill()
+            process.wait()
+    finish(info, results)
+
+def finish(info, results):
+    report(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'when': time.time(), 'redis_version': info['redis_version'],
+                'python': sys.version.split()[0], 'number': options.number,
+                'concurrency': options.concurrency, 'results': results}, f, indent=2, sort_keys=True)
+    if options.compare:
+        compare(results, options.compare)
+
+if __name__ == '__main__':
+    main()
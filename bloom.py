@@ -0,0 +1,54 @@
+'''A compact in-process bloom filter
+
+Answers "definitely not seen" or "possibly seen" for strings using a few
+bits per member, so most lookups never need a round trip to redis.
+'''
+import math
+import struct
+import hashlib
+
+class BloomFilter(object):
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        '''Sized so that ``capacity`` members give roughly ``error_rate`` false positives'''
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.m = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = max(1, int(round(self.m * math.log(2) / capacity)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        # double hashing: k positions from the two halves of one md5
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(value).digest())
+        return [ (h1 + i * h2) % self.m for i in range(self.k) ]
+
+    def add(self, value):
+        '''Only values that weren't (possibly) in already count towards ``full``'''
+        new = False
+        for p in self._positions(value):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                self.bits[p >> 3] |= 1 << (p & 7)
+                new = True
+        if new:
+            self.count += 1
+
+    def update(self, values):
+        for v in values:
+            self.add(v)
+
+    def __contains__(self, value):
+        bits = self.bits
+        for p in self._positions(value):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        '''True once we hold more than we were sized for'''
+        return self.count > self.capacity
@@ -0,0 +1,68 @@
+'''Migrate item comments from lists to a zset by time and a hash of bodies
+
+    python comments.py [--batch=200] [--pause=0.01]
+
+Each 'items:<id>:list:comments' becomes 'items:<id>:sset:comments' (comment
+id -> time) and 'items:<id>:hash:comments' (comment id -> body), in one
+MULTI per item, and the list is deleted.  The lists hold update ids, the
+body is the text in 'updates:<id>', which is left where it is; an update
+deleted since is dropped.  Comments get new ids from 'comments_incr'.  The
+lists never had times, so the old comments keep their order with scores
+1, 2, 3 ... and are older than any comment added since the upgrade.  Their
+words are already in the search index and stay there.
+
+Deploy the new models first so nothing writes to the lists any more.  Old
+comments don't show until their item is migrated.  It is safe to stop and
+run again, migrated items have no list left.
+'''
+import time
+from tornado.options import define, options, parse_command_line
+
+import memory
+import models
+from models import User, Item
+
+define('batch', default=200, type=int, help='items migrated per round trip')
+define('pause', default=0.01, type=float, help='seconds to sleep between batches')
+
+def migrate(ids):
+    '''Move the comment lists of ``ids``, returns how many comments moved'''
+    pipe = models.r.pipeline(transaction=False)
+    for id in ids:
+        pipe.lrange(Item._comment_list % id, 0, -1)
+    lists = pipe.execute()
+    update_ids = set( u for updates in lists for u in updates )
+    texts = dict(zip(update_ids, models.mget([ User._update_str % u for u in update_ids ])))
+    moved = 0
+    for id, updates in zip(ids, lists):
+        if not updates:
+            continue
+        i = Item._hydrate(id)
+        comments = [ texts[u] for u in updates if texts[u] is not None ]
+        comment_ids = models.new_ids(Item._comment_pk, len(comments))
+        pipe = models.r.pipeline(transaction=True)
+        scored, bodies = {}, {}
+        for n, (comment_id, body) in enumerate(zip(comment_ids, comments)):
+            scored[comment_id] = n + 1
+            bodies[comment_id] = body
+        if comments:
+            pipe.zadd(i.rcomments, scored)
+            pipe.hset(i.rcomment_bodies, mapping=bodies)
+        pipe.delete(Item._comment_list % id)
+        pipe.execute()
+        moved += len(comments)
+    return moved
+
+def main():
+    parse_command_line()
+    memory.install()
+    start = time.time()
+    items = moved = 0
+    for ids in models.chunked(models.scan_ids(Item._comment_list, options.batch), options.batch):
+        moved += migrate(ids)
+        items += len(ids)
+        time.sleep(options.pause)
+    print('moved %d comments of %d items in %.1fs' % (moved, items, time.time() - start))
+
+if __name__ == '__main__':
+    main()
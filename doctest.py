@@ -1,11 +1,16 @@
 from tornado.escape import json_decode as decode
 from tornado.escape import json_encode as encode
-import redis
-r = redis.Redis()
-r.flush()
+import sys
+import models
+# python doctest.py memory runs the same steps on the in-process engine
+if 'memory' in sys.argv[1:]:
+    import memory
+    models.use_client(memory.MemoryRedis())
+r = models.r
+r.flushdb()
 from models import User, Item, Group
 r.keys('*')
-User(name='Skylar')
+User(name='Skylar', create=True)
 r.keys('*')
 u=User(name='Skylar')
 u.name
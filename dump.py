@@ -0,0 +1,320 @@
+'''Stream the model graph to and from JSON lines
+
+    python dump.py --export=graph.jsonl [--batch=500]
+    python dump.py --load=graph.jsonl [--batch=500]
+
+Export walks users, groups, items, updates, the '___users' names and the
+'<service>:<unique id>' login keys with SCAN and reads each batch
+of objects in a single pipeline, so memory stays bounded by ``--batch``.
+Each line is one object, eg
+
+    {"type": "item", "id": "7", "name": "Create a talk", "creator": "1", ...}
+    {"type": "login", "key": "twitter:1234", "name": "skyl"}
+
+Load writes ``--batch`` lines per pipeline and keeps the ids from the file,
+then moves the id counters past the highest id loaded.  Items are put in
+the search index as they load.  Load into an empty database (a fresh shard,
+staging); ids are not remapped.  Items and groups
+are written packed with ``--packed``, as the app stores them.  Timelines,
+sessions and the generic list/set attrs are not included.
+'''
+import re
+import sys
+import time
+import json
+from tornado.options import define, options, parse_command_line
+
+import memory
+import models
+import search
+from models import User, Item, Group, first
+
+define('export', default='', help='write the graph to this file, - for stdout')
+define('load', default='', help='read the graph from this file, - for stdin')
+define('batch', default=500, type=int, help='objects per pipeline')
+
+class Progress(object):
+    '''Reports records per second to stderr every ``every`` records'''
+
+    def __init__(self, verb, every=10000):
+        self.verb, self.every = verb, every
+        self.count = 0
+        self.start = time.time()
+
+    def add(self, n):
+        before = self.count
+        self.count += n
+        if self.count // self.every > before // self.every:
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        sys.stderr.write('%s %d records in %.1fs (%.0f/s)\n' % (
+            self.verb, self.count, elapsed, self.count / elapsed))
+
+def split_attrs(prefix, keys, values):
+    return dict( (k[len(prefix):], v) for k, v in zip(keys, values) if v is not None )
+
+def string_attrs(template, ids, registries):
+    '''The old style string attrs, read through the registries in one pipeline'''
+    keys = [ [ k for k in reg if k.startswith(template % id) ] for id, reg in zip(ids, registries) ]
+    pipe = models.r.pipeline(transaction=False)
+    for ks in keys:
+        if ks:
+            pipe.mget(ks)
+    values = iter(pipe.execute())
+    return [ split_attrs(template % id, ks, next(values)) if ks else {}
+        for id, ks in zip(ids, keys) ]
+
+def packed_attrs(fields):
+    return dict( (k[5:], v) for k, v in fields.items() if k.startswith('attr:') )
+
+def export_users(ids):
+    names = User.names(ids)
+    pipe = models.r.pipeline(transaction=False)
+    for id in ids:
+        u = User._hydrate(id)
+        pipe.hgetall(User._profiles % names[id])
+        pipe.smembers(u.rcreated_items)
+        pipe.smembers(u.rassigned_items)
+        pipe.smembers(u.rcreated_groups)
+        pipe.smembers(u.rassigned_groups)
+        pipe.lrange(u.rupdates, 0, -1)
+        pipe.mget([ User._service.format(id=id, service=s) for s in models.services ])
+    values = pipe.execute()
+    for n, id in enumerate(ids):
+        profiles, ci, ai, cg, ag, updates, svc = values[7*n:7*n + 7]
+        # keys profiles.py hasn't moved yet
+        old = dict( (s, v) for s, v in zip(models.services, svc) if v )
+        old.update(profiles)
+        yield {'type': 'user', 'id': id, 'name': names[id],
+            'created_items': sorted(ci), 'assigned_items': sorted(ai),
+            'created_groups': sorted(cg), 'assigned_groups': sorted(ag),
+            'updates': updates,
+            'services': old}
+
+def export_groups(ids):
+    pipe = models.r.pipeline(transaction=False)
+    for id in ids:
+        g = Group._hydrate(id)
+        pipe.hgetall(g.rhash)
+        pipe.mget([g.rname, g.rcreator])
+        pipe.smembers(g.rmembers)
+        pipe.lrange(g.ritems, 0, -1)
+        pipe.smembers(g.rkeys)
+    values = pipe.execute()
+    rows = [ values[5*n:5*n + 5] for n in range(len(ids)) ]
+    attrs = string_attrs(Group._attrs, ids, [ row[4] for row in rows ])
+    for id, (fields, (name, creator), members, items, _), old in zip(ids, rows, attrs):
+        old.update(packed_attrs(fields))
+        yield {'type': 'group', 'id': id, 'name': first(fields.get('name'), name),
+            'creator': first(fields.get('creator'), creator),
+            'members': sorted(members), 'items': items, 'attrs': old}
+
+def export_items(ids):
+    pipe = models.r.pipeline(transaction=False)
+    for id in ids:
+        i = Item._hydrate(id)
+        pipe.hgetall(i.rhash)
+        pipe.mget([Item._name % id, i.rcreator, i.rgroup])
+        pipe.smembers(i.rmembers)
+        pipe.zrange(i.rcomments, 0, -1, withscores=True)
+        pipe.hgetall(i.rcomment_bodies)
+        pipe.lrange(Item._comment_list % id, 0, -1)
+        pipe.zrange(i.rcomponents, 0, -1, withscores=True)
+        pipe.smembers(i.rkeys)
+    values = pipe.execute()
+    rows = [ values[8*n:8*n + 8] for n in range(len(ids)) ]
+    attrs = string_attrs(Item._attrs, ids, [ row[7] for row in rows ])
+    # a list comments.py hasn't moved yet holds update ids
+    unmigrated = set( u for row in rows for u in row[5] )
+    texts = dict(zip(unmigrated, models.mget([ User._update_str % u for u in unmigrated ])))
+    for id, (fields, (name, creator, group), members, times, bodies, old_ids, components, _), old in \
+            zip(ids, rows, attrs):
+        old.update(packed_attrs(fields))
+        yield {'type': 'item', 'id': id, 'name': first(fields.get('name'), name),
+            'creator': first(fields.get('creator'), creator),
+            'group': first(fields.get('group'), group), 'members': sorted(members),
+            'comments': [ [c, when, bodies.get(c)] for c, when in times ],
+            'old_comments': [ [u, texts[u]] for u in old_ids ],
+            'components': components, 'attrs': old}
+
+def export_updates(ids):
+    for id, text in zip(ids, models.mget([ User._update_str % id for id in ids ])):
+        if text is not None:
+            yield {'type': 'update', 'id': id, 'text': text}
+
+def export_usernames(names):
+    for name in names:
+        yield {'type': 'username', 'name': name}
+
+# '<service>:<unique id>' -> name from app.py, not profiles.py's old '<name>:<service>'
+login_key = re.compile(r'^(%s):' % '|'.join(models.services))
+old_login_key = re.compile(r'^[^:]+:(%s)$' % '|'.join(models.services))
+
+def login_keys():
+    for service in models.services:
+        for key in models.r.scan_iter(match=service + ':*', count=options.batch):
+            if login_key.match(key) and not old_login_key.match(key):
+                yield key
+
+def export_logins(keys):
+    for key, name in zip(keys, models.mget(keys)):
+        if name is not None:
+            yield {'type': 'login', 'key': key, 'name': name}
+
+def object_ids(cls):
+    '''Packed objects only have a hash, older ones only a name key'''
+    if not cls._hash:
+        for id in models.scan_ids(cls._name, options.batch):
+            yield id
+        return
+    for id in models.scan_ids(cls._hash, options.batch):
+        yield id
+    # the name keys of objects not yet packed, skipping the ones yielded above
+    for batch in models.chunked(models.scan_ids(cls._name, options.batch), options.batch):
+        pipe = models.r.pipeline(transaction=False)
+        for id in batch:
+            pipe.exists(cls._hash % id)
+        for id, packed in zip(batch, pipe.execute()):
+            if not packed:
+                yield id
+
+def export(out):
+    progress = Progress('exported')
+    streams = [
+        (object_ids(User), export_users),
+        (object_ids(Group), export_groups),
+        (object_ids(Item), export_items),
+        (models.scan_ids(User._update_str, options.batch), export_updates),
+        (models.r.sscan_iter('___users', count=options.batch), export_usernames),
+        (login_keys(), export_logins),
+    ]
+    for ids, reader in streams:
+        for batch in models.chunked(ids, options.batch):
+            n = 0
+            for record in reader(batch):
+                out.write(json.dumps(record) + '\n')
+                n += 1
+            progress.add(n)
+    progress.report()
+
+def write_scalars(pipe, cls, id, fields, attrs):
+    '''name/creator/group and string attrs, as a hash or as keys'''
+    fields = dict( (f, v) for f, v in fields.items() if v is not None )
+    if cls.packed:
+        fields.update(('attr:' + k, v) for k, v in attrs.items())
+        if fields:
+            pipe.hset(cls._hash % id, mapping=fields)
+        return
+    for field, template in cls._scalars:
+        if field in fields:
+            pipe.set(template % id, fields[field])
+    for k, v in attrs.items():
+        pipe.set(cls._attrs % id + k, v)
+        pipe.sadd(cls._registry % id, cls._attrs % id + k)
+
+def load_record(pipe, record):
+    kind, id = record['type'], record.get('id')
+    if kind == 'username':
+        pipe.sadd('___users', record['name'])
+    elif kind == 'login':
+        pipe.set(record['key'], record['name'])
+    elif kind == 'user':
+        u = User._hydrate(id)
+        pipe.set(u.rname, record['name'])
+        pipe.set(User._id % record['name'].lower(), id)
+        for key, field in ((u.rcreated_items, 'created_items'), (u.rassigned_items, 'assigned_items'),
+                (u.rcreated_groups, 'created_groups'), (u.rassigned_groups, 'assigned_groups')):
+            if record[field]:
+                pipe.sadd(key, *record[field])
+        if record['updates']:
+            pipe.rpush(u.rupdates, *record['updates'])
+        if record['services']:
+            pipe.hset(User._profiles % record['name'], mapping=record['services'])
+    elif kind == 'group':
+        g = Group._hydrate(id)
+        write_scalars(pipe, Group, id, {'name': record['name'], 'creator': record['creator']}, record['attrs'])
+        if record['members']:
+            pipe.sadd(g.rmembers, *record['members'])
+        if record['items']:
+            pipe.rpush(g.ritems, *record['items'])
+    elif kind == 'item':
+        i = Item._hydrate(id)
+        write_scalars(pipe, Item, id, {'name': record['name'], 'creator': record['creator'],
+            'group': record['group']}, record['attrs'])
+        if record['members']:
+            pipe.sadd(i.rmembers, *record['members'])
+        bodies = []
+        for comment in record['comments']:
+            if isinstance(comment, list):
+                comment_id, when, body = comment
+                pipe.zadd(i.rcomments, {comment_id: when})
+                pipe.hset(i.rcomment_bodies, comment_id, body)
+                bodies.append(body)
+            else:
+                # an update id from an old list, as files from before 'old_comments' had them
+                pipe.rpush(Item._comment_list % id, comment)
+        for update_id, body in record.get('old_comments', ()):
+            pipe.rpush(Item._comment_list % id, update_id)
+            if body is not None:
+                bodies.append(body)
+        for member, score in record['components']:
+            pipe.zadd(i.rcomponents, {member: score})
+        search.apply(pipe, id, search.item_postings(record['name'],
+            [ member for member, score in record['components'] ], bodies))
+    elif kind == 'update':
+        pipe.set(User._update_str % id, record['text'])
+
+counters = {'user': User._pk, 'group': Group._pk, 'item': Item._pk, 'update': 'updates_incr'}
+
+# Only ever move a counter forward
+_raise_counter_lua = '''
+if tonumber(redis.call('GET', KEYS[1]) or 0) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+'''
+
+def _raise_counter_python(client, keys, args):
+    if int(client.get(keys[0]) or 0) < int(args[0]):
+        client.set(keys[0], args[0])
+
+raise_counter = models.Script(_raise_counter_lua, _raise_counter_python, local=True)
+
+def load(lines):
+    progress = Progress('loaded')
+    highest = dict( (c, 0) for c in list(counters.values()) + [Item._comment_pk] )
+    for batch in models.chunked(lines, options.batch):
+        pipe = models.r.pipeline(transaction=False)
+        for line in batch:
+            record = json.loads(line)
+            load_record(pipe, record)
+            counter = counters.get(record['type'])
+            if counter:
+                highest[counter] = max(highest[counter], int(record['id']))
+            for comment in record.get('comments', ()):
+                if isinstance(comment, list):
+                    highest[Item._comment_pk] = max(highest[Item._comment_pk], int(comment[0]))
+        pipe.execute()
+        progress.add(len(batch))
+    for counter, id in highest.items():
+        if id:
+            raise_counter(keys=[counter], args=[id], client=models.r)
+    progress.report()
+
+def main():
+    parse_command_line()
+    memory.install()
+    models.set_packed(options.packed)
+    if options.export:
+        out = sys.stdout if options.export == '-' else open(options.export, 'w')
+        export(out)
+        out.close()
+    elif options.load:
+        f = sys.stdin if options.load == '-' else open(options.load)
+        load(line for line in f if line.strip())
+    else:
+        options.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+'''Find and repair drift between the forward and reverse indexes
+
+    python indexes.py [--repair] [--count=500] [--pause=0.01] [--cached_groups=1000]
+
+Walks the keyspace with SCAN (``--count`` keys at a time, sleeping
+``--pause`` between batches) and checks both ends of every relationship:
+
+    item group fk        <-> groups:<id>:list:items
+    items:<id>:mm:members <-> users:<id>:set:assigned_items
+    groups:<id>:members   <-> users:<id>:set:assigned_groups
+
+Item membership is kept as the union of both ends.  For groups the members
+set wins, which also clears the user ids the old ``add_to_group`` put into
+assigned_groups.  It also puts generic attr keys into their object's
+registry ('items:<id>:keys', 'groups:<id>:keys'), run it once after
+upgrading so deletes find attrs written before registries existed (until
+it has, deleting an object with an empty registry SCANs for its attrs).
+Without ``--repair`` it only reports.
+'''
+import itertools
+import re
+import time
+from collections import defaultdict, OrderedDict
+from tornado.options import define, options, parse_command_line
+
+import memory
+import models
+from models import Item, Group, User, first
+
+define('repair', default=False, type=bool, help='fix what we find, not just report it')
+define('count', default=500, type=int, help='keys per SCAN batch')
+define('pause', default=0.01, type=float, help='seconds to sleep between batches')
+define('cached_groups', default=1000, type=int, help='group item lists kept in memory while checking items')
+
+found = defaultdict(int)
+
+def ids_for(template):
+    return models.scan_ids(template, options.count, options.pause)
+
+def run(pipe, label):
+    '''Execute repairs (or throw them away) and count them'''
+    found[label] += len(pipe.command_stack)
+    if options.repair and pipe.command_stack:
+        pipe.execute()
+
+def item_groups(ids):
+    pipe = models.r.pipeline(transaction=False)
+    for id in ids:
+        pipe.hget(Item._hash % id, 'group')
+        pipe.get(Item._group % id)
+    values = pipe.execute()
+    return [ first(values[2*n], values[2*n + 1]) for n in range(len(ids)) ]
+
+def group_items(listed, group):
+    '''The set of items in ``group``'s list, kept in ``listed`` for the next
+    batches.  Streamed ``--count`` at a time, LRANGE rather than LPOS which
+    needs redis 6.0.6.'''
+    if group in listed:
+        listed[group] = listed.pop(group) # most recently used goes last
+    else:
+        listed[group] = set(models.iter_list(Group._items % group, options.count))
+        if len(listed) > options.cached_groups:
+            listed.popitem(last=False)
+    return listed[group]
+
+def check_item_groups():
+    '''Every item with a group fk is in that group's list, if the group is
+    still there.  The fk of a deleted group is left for the app to clean up.'''
+    ids = itertools.chain(ids_for(Item._group), ids_for(Item._hash))
+    listed = OrderedDict()
+    for batch in models.chunked(ids, options.count):
+        pairs = [ (i, g) for i, g in zip(batch, item_groups(batch)) if g ]
+        names = Group.names(sorted(set( g for i, g in pairs )))
+        repair = models.r.pipeline(transaction=False)
+        for item, group in pairs:
+            if names[group] is None:
+                continue
+            items = group_items(listed, group)
+            if item not in items:
+                repair.lpush(Group._items % group, item)
+                items.add(item) # an item is found twice while it is being packed
+        run(repair, 'items missing from their group list')
+
+def check_group_lists():
+    '''Every item in a group's list says it belongs to that group'''
+    for group in ids_for(Group._items):
+        for batch in models.chunked(models.iter_list(Group._items % group, options.count), options.count):
+            repair = models.r.pipeline(transaction=False)
+            for item, actual in zip(batch, item_groups(batch)):
+                if actual != group:
+                    repair.lrem(Group._items % group, 0, item)
+            run(repair, 'items listed in a group they are not in')
+
+def check_pairs(cls, assigned_template, label, members_win=False):
+    '''Both ends of a membership.  The object's ``members`` set of user ids
+    against each user's ``assigned`` set of object ids.  Ids of deleted
+    objects are dropped from ``assigned`` either way.'''
+    members_template = cls._members
+    for obj in ids_for(members_template):
+        members = models.r.sscan_iter(members_template % obj, count=options.count)
+        for batch in models.chunked(members, options.count):
+            pipe = models.r.pipeline(transaction=False)
+            for user in batch:
+                pipe.sismember(assigned_template % user, obj)
+            repair = models.r.pipeline(transaction=False)
+            for user, ok in zip(batch, pipe.execute()):
+                if not ok:
+                    repair.sadd(assigned_template % user, obj)
+            run(repair, '%s members missing the reverse entry' % label)
+    for user in ids_for(assigned_template):
+        assigned = models.r.sscan_iter(assigned_template % user, count=options.count)
+        for batch in models.chunked(assigned, options.count):
+            pipe = models.r.pipeline(transaction=False)
+            for obj in batch:
+                pipe.sismember(members_template % obj, user)
+            names = cls.names(batch)
+            repair = models.r.pipeline(transaction=False)
+            for obj, ok in zip(batch, pipe.execute()):
+                if ok:
+                    continue
+                if members_win or not names[obj]:
+                    repair.srem(assigned_template % user, obj)
+                else:
+                    repair.sadd(members_template % obj, user)
+            run(repair, '%s assignments missing the reverse entry' % label)
+
+def check_registries():
+    '''Every generic attr key is in its object's registry, where deletes look
+    for them.  Finds the ones written before there were registries.'''
+    for cls in (Item, Group):
+        for template in cls._generic:
+            attr = re.compile('^' + re.escape(template).replace(re.escape('%s'), r'(\d+)'))
+            keys = models.r.scan_iter(match=template % '*' + '*', count=options.count)
+            for batch in models.chunked(keys, options.count):
+                found_keys = [ (m.group(1), k) for m, k in ((attr.match(k), k) for k in batch) if m ]
+                pipe = models.r.pipeline(transaction=False)
+                for id, key in found_keys:
+                    pipe.sismember(cls._registry % id, key)
+                repair = models.r.pipeline(transaction=False)
+                for (id, key), ok in zip(found_keys, pipe.execute()):
+                    if not ok:
+                        repair.sadd(cls._registry % id, key)
+                run(repair, 'attr keys missing from their registry')
+                time.sleep(options.pause)
+    if options.repair:
+        models.r.set(models.registries_filled, int(time.time()))
+
+def main():
+    parse_command_line()
+    memory.install()
+    start = time.time()
+    check_item_groups()
+    check_group_lists()
+    check_pairs(Item, User._assigned_items, 'item')
+    check_pairs(Group, User._assigned_groups, 'group', members_win=True)
+    check_registries()
+    for label, n in sorted(found.items()):
+        print('%6d %s' % (n, label))
+    print('%s in %.1fs' % ('repaired' if options.repair else 'checked (dry run)', time.time() - start))
+
+if __name__ == '__main__':
+    main()
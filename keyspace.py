@@ -0,0 +1,201 @@
+'''Where our redis memory goes, by key pattern and object type
+
+    python keyspace.py [--sample=0.05] [--rate=5000] [--count=500] [--json=out.json]
+    python keyspace.py --host=replica --port=6380 [--orphans]
+    python keyspace.py --memory_store=/var/lib/tumbleweed/data
+
+Walks the keyspace with SCAN, at most ``--rate`` keys a second, and puts
+every key under one of the templates on ``User``, ``Item`` and ``Group``
+(``_created_items``, ``_attrs``, ``_comments`` ...) or the few site-wide
+keys, anything else is 'unknown'.  Point it at a replica or a server loaded
+from a dump to keep it off the live one.
+
+For ``--sample`` of the objects (picked by id, so every key of a sampled
+object is measured) it asks MEMORY USAGE and reports per pattern totals,
+scaled up to the whole keyspace, and the distribution of bytes per object
+for each type.  With ``--orphans`` every key is checked for a parent object
+that still exists and the orphans are listed.
+'''
+import re
+import json
+import time
+import zlib
+from collections import defaultdict
+from tornado.options import define, options, parse_command_line
+import redis
+
+import memory
+import models
+import sessions
+from models import User, Item, Group, Timeline
+
+define('host', default='localhost', help='redis to profile')
+define('port', default=6379, type=int)
+define('db', default=0, type=int)
+define('count', default=500, type=int, help='SCAN COUNT')
+define('rate', default=5000, type=int, help='most keys per second to look at')
+define('sample', default=0.05, type=float, help='fraction of objects to measure')
+define('orphans', default=False, type=bool, help='check every key for a live parent')
+define('show', default=20, type=int, help='orphans to print')
+define('json', default='', help='also write the report here')
+
+def schema():
+    '''(pattern name, object type, regex) for every key template we write
+
+    The id is group 1.  Templates ending in ':' (the generic attrs) match
+    any suffix.  Longest literal first so 'items:%s' doesn't take the rest.'''
+    entries = []
+    for cls in (User, Item, Group):
+        for attr in dir(cls):
+            template = getattr(cls, attr)
+            if not attr.startswith('_') or not isinstance(template, str) or '%s' not in template:
+                continue
+            if attr in ('_id', '_profiles'): # keyed by name, not id
+                continue
+            if attr == '_update_str':
+                entries.append(('Update._update_str', 'Update', template))
+            else:
+                entries.append(('%s.%s' % (cls.__name__, attr), cls.__name__, template))
+    entries.append(('User._service', 'User', User._service.format(id='%s', service='*')))
+    entries.append(('Timeline._user', 'User', Timeline._user))
+    entries.append(('Timeline._group', 'Group', Timeline._group))
+    patterns = []
+    for name, kind, template in set(entries):
+        literal = re.escape(template).replace(re.escape('%s'), r'(\d+)').replace(re.escape('*'), '[^:]+')
+        tail = '.+' if template.endswith(':') else ''
+        patterns.append((len(template), name, kind, re.compile('^' + literal + tail + '$')))
+    patterns.sort(reverse=True)
+    return [ p[1:] for p in patterns ]
+
+# keys that don't belong to an object
+site_wide = [
+    ('users_by_name', re.compile(r'^users:id_for:')),
+    ('profiles', re.compile('^' + User._profiles.replace('%s', ''))),
+    ('sessions', re.compile('^' + sessions._session.replace('%s', ''))),
+    ('counters', re.compile(r'^\w+_incr$')),
+    ('___users', re.compile(r'^___users$')),
+    ('search', re.compile(r'^\{search\}:')),
+    ('login:<name>:<service>', re.compile(r'^[^:]+:(google|twitter|facebook)$')),
+    ('login:<service>:<id>', re.compile(r'^(google|twitter|facebook):')),
+]
+
+def classify(key, patterns):
+    '''(pattern name, object type, id), the last two None for site-wide keys'''
+    for name, kind, regex in patterns:
+        m = regex.match(key)
+        if m:
+            return name, kind, m.group(1)
+    for name, regex in site_wide:
+        if regex.match(key):
+            return name, None, None
+    return 'unknown', None, None
+
+def sampled(kind, id):
+    return zlib.crc32(('%s:%s' % (kind, id)).encode('utf-8')) % 10000 < options.sample * 10000
+
+def scan():
+    '''Every key, no faster than ``--rate`` a second'''
+    start, seen = time.time(), 0
+    for batch in models.chunked(models.r.scan_iter(count=options.count), options.count):
+        for key in batch:
+            yield key if isinstance(key, str) else key.decode('utf-8', 'replace')
+        seen += len(batch)
+        ahead = seen / float(options.rate) - (time.time() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+class Profile(object):
+
+    def __init__(self):
+        self.patterns = schema()
+        self.keys = defaultdict(int) # pattern -> keys seen
+        self.measured = defaultdict(int) # pattern -> keys measured
+        self.bytes = defaultdict(int) # pattern -> bytes measured
+        self.objects = defaultdict(lambda: defaultdict(int)) # type -> id -> bytes
+        self.alive = {} # (type, id) -> bool
+        self.orphans = defaultdict(int) # pattern -> orphan count
+        self.examples = defaultdict(list) # pattern -> the first ``--show`` orphans
+
+    def add(self, keys):
+        found = [ (key,) + classify(key, self.patterns) for key in keys ]
+        measure = [ f for f in found if f[2] and sampled(f[2], f[3]) ]
+        pipe = models.r.pipeline(transaction=False)
+        for key, name, kind, id in measure:
+            pipe.execute_command('MEMORY', 'USAGE', key)
+        for (key, name, kind, id), used in zip(measure, pipe.execute()):
+            self.measured[name] += 1
+            self.bytes[name] += used or 0
+            self.objects[kind][id] += used or 0
+        for key, name, kind, id in found:
+            self.keys[name] += 1
+        if options.orphans:
+            self.check_parents([ f for f in found if f[2] ])
+
+    def check_parents(self, found):
+        '''An object exists while its name key or packed hash does'''
+        unknown = list(set( (kind, id) for key, name, kind, id in found if (kind, id) not in self.alive ))
+        pipe = models.r.pipeline(transaction=False)
+        for kind, id in unknown:
+            cls = getattr(models, kind)
+            name = User._update_str if cls is models.Update else cls._name
+            pipe.exists(name % id)
+            pipe.exists((cls._hash or name) % id)
+        exists = pipe.execute()
+        for n, parent in enumerate(unknown):
+            self.alive[parent] = bool(exists[2*n] or exists[2*n + 1])
+        for key, name, kind, id in found:
+            if not self.alive[(kind, id)]:
+                self.orphans[name] += 1
+                if len(self.examples[name]) < options.show:
+                    self.examples[name].append(key)
+
+    def report(self):
+        patterns = {}
+        for name, count in self.keys.items():
+            measured = self.measured[name]
+            patterns[name] = {'keys': count, 'measured': measured, 'bytes_measured': self.bytes[name],
+                'bytes_estimated': int(self.bytes[name] * float(count) / measured) if measured else None,
+                'orphans': self.orphans[name]}
+        types = {}
+        for kind, sizes in self.objects.items():
+            sizes = sorted(sizes.values())
+            at = lambda p: sizes[min(len(sizes) - 1, int(len(sizes) * p))]
+            types[kind] = {'sampled': len(sizes), 'mean': sum(sizes) / float(len(sizes)),
+                'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': sizes[-1]}
+        return {'patterns': patterns, 'types': types,
+            'orphans': dict(self.examples)}
+
+def print_report(report):
+    print('%-28s %10s %10s %14s %8s' % ('pattern', 'keys', 'measured', 'est. bytes', 'orphans'))
+    rows = sorted(report['patterns'].items(), key=lambda row: -(row[1]['bytes_estimated'] or 0))
+    for name, row in rows:
+        print('%-28s %10d %10d %14s %8s' % (name, row['keys'], row['measured'],
+            row['bytes_estimated'] if row['bytes_estimated'] is not None else '-',
+            row['orphans'] if options.orphans else '-'))
+    print('')
+    print('%-10s %8s %10s %10s %10s %10s %10s' % ('type', 'sampled', 'mean', 'p50', 'p90', 'p99', 'max'))
+    for kind, row in sorted(report['types'].items()):
+        print('%-10s %8d %10.0f %10d %10d %10d %10d' % (kind, row['sampled'], row['mean'],
+            row['p50'], row['p90'], row['p99'], row['max']))
+    for name, keys in sorted(report['orphans'].items()):
+        print('')
+        print('orphans under %s (%d):' % (name, report['patterns'][name]['orphans']))
+        for key in keys:
+            print('    ' + key)
+
+def main():
+    parse_command_line()
+    models.r.connection_pool = redis.ConnectionPool(host=options.host, port=options.port, db=options.db,
+            decode_responses=True)
+    memory.install()
+    profile = Profile()
+    for batch in models.chunked(scan(), options.count):
+        profile.add(batch)
+    report = profile.report()
+    print_report(report)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,730 @@
+'''An in-process stand-in for redis, for one box, CI and benchmarks
+
+    import models, memory
+    models.use_client(memory.MemoryRedis('/var/lib/tumbleweed/data'))
+
+or ``--memory_store=/var/lib/tumbleweed/data`` for app.py and server.py.
+
+``MemoryRedis`` has the methods of ``redis.Redis`` the models use, with the
+same arguments, over plain dicts, lists and sets, so a model call is a few dictionary
+lookups instead of a round trip.  It can't run Lua: ``register_script``
+hands back the Python version given to ``models.Script`` (or added to
+``python_scripts``) and runs it holding ``lock``, so scripts are still
+atomic here.  Pipelines run under the lock too.
+
+With a ``path`` every write is appended to '<path>.aof' as a JSON line and
+the whole dataset goes to '<path>.snapshot' every ``snapshot_every`` writes
+or ``snapshot_interval`` seconds, after which the log starts again.  Only
+the copy of the data is made under the lock, a thread writes it out while
+the writes carry on into the new log; the old one is kept as
+'<path>.aof.old' until the snapshot is on disk.  Startup loads the snapshot
+and replays the logs.  ``fsync`` is 'always', 'everysec'
+or 'no', as in redis.
+
+What it doesn't do: pub/sub (PUBLISH is dropped, so realtime.py needs
+redis), and the handlers' async client still talks to redis for sessions
+and logins.  One process only, the files can't be shared.
+'''
+import os
+import json
+import time
+import bisect
+import fnmatch
+import threading
+from tornado.options import define, options
+from redis.exceptions import ResponseError
+
+define('memory_store', default='', help='keep the models in process, logged to this path')
+
+# Lua source -> a Python function doing the same, see ``models.Script``
+python_scripts = {}
+
+# logs without a version were written with redis-py 2's argument orders
+log_version = 2
+
+def upgrade(name, args, kwargs):
+    '''A command from a version 1 log, with the arguments it takes now'''
+    if name in ('lrem', 'zincrby'):
+        default = 0 if name == 'lrem' else 1
+        return [args[0], args[2] if len(args) > 2 else default, args[1]], {}
+    if name == 'zadd':
+        mapping = dict(zip(args[1::2], args[2::2]))
+        mapping.update(kwargs)
+        return [args[0], mapping], {}
+    return args, kwargs
+
+def text(value):
+    '''Everything is stored the way redis would hand it back, as a string'''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bytes): # py3
+        return value.decode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    try:
+        return str(value)
+    except UnicodeEncodeError: # py2 unicode
+        return value.encode('utf-8')
+
+def score(value, exclusive_ok=False):
+    '''A zset score or bound, '(5' gives (5.0, True)'''
+    value = text(value)
+    exclusive = value.startswith('(')
+    if exclusive:
+        value = value[1:]
+    value = {'+inf': 'inf', '-inf': '-inf', 'inf': 'inf'}.get(value, value)
+    return (float(value), exclusive) if exclusive_ok else float(value)
+
+def bounds(length, start, end):
+    '''python slice bounds for redis' inclusive, negative-friendly start/end'''
+    start, end = int(start), int(end)
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end = length + end
+    return start, max(min(end, length - 1) + 1, start)
+
+class ZSet(object):
+    '''scores by member and (score, member) pairs kept sorted'''
+    __slots__ = ('scores', 'entries')
+
+    def __init__(self):
+        self.scores = {}
+        self.entries = []
+
+    def add(self, member, value):
+        old = self.scores.get(member)
+        if old is not None:
+            del self.entries[bisect.bisect_left(self.entries, (old, member))]
+        self.scores[member] = value
+        bisect.insort(self.entries, (value, member))
+        return old is None
+
+    def remove(self, member):
+        old = self.scores.pop(member, None)
+        if old is None:
+            return False
+        del self.entries[bisect.bisect_left(self.entries, (old, member))]
+        return True
+
+    def by_score(self, low, high):
+        '''(score, member) from low to high, each a (value, exclusive) bound'''
+        (low, low_ex), (high, high_ex) = low, high
+        n = bisect.bisect_left(self.entries, (low,))
+        while n < len(self.entries):
+            value, member = self.entries[n]
+            n += 1
+            if low_ex and value == low:
+                continue
+            if value > high or (high_ex and value == high):
+                break
+            yield value, member
+
+    def __len__(self):
+        return len(self.scores)
+
+def writes(method):
+    '''A command that changes data: run it under the lock and log it'''
+    name = method.__name__
+    def logged(self, *args, **kwargs):
+        with self.lock:
+            self.nesting += 1
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                self.nesting -= 1
+            # only the outermost command, getset's set is replayed by getset
+            if self.aof is not None and not self.nesting:
+                self.log(name, args, kwargs)
+            return result
+    logged.__name__ = name
+    logged.__doc__ = method.__doc__
+    return logged
+
+class MemoryRedis(object):
+
+    runs_lua = False
+    cross_key_scripts = False
+
+    def __init__(self, path=None, snapshot_every=100000, snapshot_interval=300, fsync='everysec'):
+        self.lock = threading.RLock()
+        self.nesting = 0
+        self.data = {}
+        self.expires = {} # key -> unix time
+        self.path = path
+        self.aof = None
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.generation = 0
+        self.saving = None # the thread writing the last snapshot
+        self.writes = 0
+        self.last_snapshot = self.last_sync = time.time()
+        if path:
+            self.load()
+
+    # durability
+
+    def load(self):
+        snapshot = self.path + '.snapshot'
+        if os.path.exists(snapshot):
+            with open(snapshot) as f:
+                saved = json.load(f)
+            self.generation = saved['generation']
+            self.expires = saved['expires']
+            for key, (kind, value) in saved['data'].items():
+                key = text(key)
+                if kind == 'string':
+                    self.data[key] = text(value)
+                elif kind == 'list':
+                    self.data[key] = [ text(v) for v in value ]
+                elif kind == 'set':
+                    self.data[key] = set( text(v) for v in value )
+                elif kind == 'hash':
+                    self.data[key] = dict( (text(k), text(v)) for k, v in value.items() )
+                else:
+                    z = self.data[key] = ZSet()
+                    for member, value in value:
+                        z.add(text(member), value)
+        for aof in (self.path + '.aof.old', self.path + '.aof'):
+            if not os.path.exists(aof):
+                continue
+            with open(aof) as f:
+                header = json.loads(f.readline() or 'null')
+                # a log from before the last snapshot is in the snapshot already,
+                # the old one is only read when its snapshot didn't land
+                if header and header['generation'] >= self.generation:
+                    for line in f:
+                        if not line.endswith('\n'):
+                            break # torn last write
+                        name, args, kwargs = json.loads(line)
+                        if header.get('version', 1) < log_version:
+                            args, kwargs = upgrade(name, args, kwargs)
+                        getattr(self, name)(*args, **dict( (str(k), v) for k, v in kwargs.items() ))
+        # fold the log into a new snapshot before it is started again
+        self.snapshot()
+
+    def start_log(self):
+        if self.aof is not None:
+            self.aof.close()
+        self.aof = None
+        aof = open(self.path + '.aof', 'w')
+        aof.write(json.dumps({'generation': self.generation, 'version': log_version}) + '\n')
+        aof.flush()
+        self.aof = aof
+
+    def log(self, name, args, kwargs):
+        self.aof.write(json.dumps([name, args, kwargs]) + '\n')
+        self.aof.flush()
+        now = time.time()
+        if self.fsync == 'always' or (self.fsync == 'everysec' and now - self.last_sync >= 1):
+            os.fsync(self.aof.fileno())
+            self.last_sync = now
+        self.writes += 1
+        due = self.writes >= self.snapshot_every or now - self.last_snapshot >= self.snapshot_interval
+        if due and not (self.saving and self.saving.is_alive()):
+            self.snapshot(background=True)
+
+    def snapshot(self, background=False):
+        '''Write everything to '<path>.snapshot' and start a new log
+
+        With ``background`` it is written on a thread, writes only wait for
+        the copy.'''
+        # one at a time, the log before this one may still be needed
+        self.wait()
+        with self.lock:
+            data = {}
+            for key, value in self.data.items():
+                if isinstance(value, str):
+                    data[key] = ('string', value)
+                elif isinstance(value, list):
+                    data[key] = ('list', list(value))
+                elif isinstance(value, set):
+                    data[key] = ('set', list(value))
+                elif isinstance(value, dict):
+                    data[key] = ('hash', dict(value))
+                else:
+                    data[key] = ('zset', [ (m, s) for s, m in value.entries ])
+            self.generation += 1
+            saved = {'generation': self.generation, 'expires': dict(self.expires), 'data': data}
+            if not background:
+                # on disk before the logs it replaces go
+                self.write_snapshot(saved)
+            else:
+                if self.aof is not None:
+                    self.aof.close()
+                    self.aof = None
+                os.rename(self.path + '.aof', self.path + '.aof.old')
+            self.start_log()
+            self.writes = 0
+            self.last_snapshot = time.time()
+        if background:
+            self.saving = threading.Thread(target=self.write_snapshot, args=(saved,), name='snapshot')
+            self.saving.daemon = True
+            self.saving.start()
+
+    def write_snapshot(self, saved):
+        tmp = self.path + '.snapshot.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path + '.snapshot')
+        if os.path.exists(self.path + '.aof.old'):
+            os.remove(self.path + '.aof.old')
+
+    def wait(self):
+        '''Until the snapshot being written, if any, is on disk'''
+        if self.saving is not None:
+            self.saving.join()
+            self.saving = None
+
+    # keys
+
+    def _get(self, key, kind=None, create=False):
+        key = text(key)
+        if self.expires and key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            del self.expires[key]
+        value = self.data.get(key)
+        if value is None:
+            if create:
+                value = self.data[key] = kind()
+            return value
+        if kind is not None and not isinstance(value, kind):
+            raise ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _cleanup(self, key, value):
+        '''redis has no empty containers'''
+        if not value:
+            self.data.pop(text(key), None)
+            self.expires.pop(text(key), None)
+
+    @writes
+    def delete(self, *names):
+        deleted = 0
+        for name in names:
+            if self._get(name) is not None:
+                del self.data[text(name)]
+                self.expires.pop(text(name), None)
+                deleted += 1
+        return deleted
+
+    def exists(self, *names):
+        return sum(1 for name in names if self._get(name) is not None)
+
+    def type(self, name):
+        value = self._get(name)
+        kinds = ((str, 'string'), (list, 'list'), (set, 'set'), (dict, 'hash'), (ZSet, 'zset'))
+        return 'none' if value is None else [ n for k, n in kinds if isinstance(value, k) ][0]
+
+    def expire(self, name, seconds):
+        return self.expireat(name, time.time() + int(seconds))
+
+    @writes
+    def expireat(self, name, when):
+        if self._get(name) is None:
+            return False
+        self.expires[text(name)] = float(when)
+        return True
+
+    def keys(self, pattern='*'):
+        return [ k for k in list(self.data) if fnmatch.fnmatchcase(k, pattern) and self._get(k) is not None ]
+
+    def scan(self, cursor=0, match=None, count=None):
+        return self._page(sorted(self.keys(match or '*')), cursor, count)
+
+    def scan_iter(self, match=None, count=None):
+        return iter(self.keys(match or '*'))
+
+    def _page(self, items, cursor, count):
+        start, count = int(cursor), int(count or 10)
+        end = start + count
+        return (end if end < len(items) else 0), items[start:end]
+
+    @writes
+    def flushdb(self):
+        self.data.clear()
+        self.expires.clear()
+        return True
+
+    def dbsize(self):
+        return len(self.data)
+
+    def info(self, section=None):
+        return {'redis_version': 'memory', 'used_memory': 0, 'total_commands_processed': 0}
+
+    def memory(self, subcommand, key=None):
+        '''MEMORY USAGE, nothing is measured here'''
+        return None
+
+    def ping(self):
+        return True
+
+    def publish(self, channel, message):
+        return 0
+
+    # strings
+
+    def get(self, name):
+        return self._get(name, str)
+
+    def mget(self, keys, *args):
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        return [ self._get(k, str) for k in keys + list(args) ]
+
+    @writes
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        exists = self._get(name) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        self.data[text(name)] = text(value)
+        self.expires.pop(text(name), None)
+        if ex or px:
+            self.expires[text(name)] = time.time() + (ex or px / 1000.0)
+        return True
+
+    @writes
+    def setnx(self, name, value):
+        return bool(self.set(name, value, nx=True))
+
+    @writes
+    def getset(self, name, value):
+        old = self._get(name, str)
+        self.set(name, value)
+        return old
+
+    @writes
+    def incr(self, name, amount=1):
+        value = int(self._get(name, str) or 0) + int(amount)
+        self.data[text(name)] = str(value)
+        return value
+    incrby = incr
+
+    # lists
+
+    @writes
+    def lpush(self, name, *values):
+        l = self._get(name, list, create=True)
+        for v in values:
+            l.insert(0, text(v))
+        return len(l)
+
+    @writes
+    def rpush(self, name, *values):
+        l = self._get(name, list, create=True)
+        l.extend(text(v) for v in values)
+        return len(l)
+
+    def lrange(self, name, start, end):
+        l = self._get(name, list) or []
+        return l[slice(*bounds(len(l), start, end))]
+
+    def llen(self, name):
+        return len(self._get(name, list) or ())
+
+    def lindex(self, name, index):
+        l = self._get(name, list) or []
+        index = int(index)
+        return l[index] if -len(l) <= index < len(l) else None
+
+    @writes
+    def lrem(self, name, num, value):
+        l = self._get(name, list)
+        if not l:
+            return 0
+        value, num = text(value), int(num)
+        positions = [ i for i, v in enumerate(l) if v == value ]
+        if num > 0:
+            positions = positions[:num]
+        elif num < 0:
+            positions = positions[num:]
+        for i in reversed(positions):
+            del l[i]
+        self._cleanup(name, l)
+        return len(positions)
+
+    @writes
+    def ltrim(self, name, start, end):
+        l = self._get(name, list)
+        if l:
+            l[:] = l[slice(*bounds(len(l), start, end))]
+            self._cleanup(name, l)
+        return True
+
+    # sets
+
+    @writes
+    def sadd(self, name, *values):
+        s = self._get(name, set, create=True)
+        before = len(s)
+        s.update(text(v) for v in values)
+        return len(s) - before
+
+    @writes
+    def srem(self, name, *values):
+        s = self._get(name, set)
+        if not s:
+            return 0
+        before = len(s)
+        s.difference_update(text(v) for v in values)
+        self._cleanup(name, s)
+        return before - len(s)
+
+    def smembers(self, name):
+        return set(self._get(name, set) or ())
+
+    def sismember(self, name, value):
+        return text(value) in (self._get(name, set) or ())
+
+    def scard(self, name):
+        return len(self._get(name, set) or ())
+
+    def sunion(self, keys, *args):
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        union = set()
+        for k in keys + list(args):
+            union.update(self._get(k, set) or ())
+        return union
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        members = sorted( m for m in self._get(name, set) or () if not match or fnmatch.fnmatchcase(m, match) )
+        return self._page(members, cursor, count)
+
+    def sscan_iter(self, name, match=None, count=None):
+        return iter([ m for m in self._get(name, set) or () if not match or fnmatch.fnmatchcase(m, match) ])
+
+    # sorted sets
+
+    @writes
+    def zadd(self, name, mapping, nx=False, xx=False):
+        '''``mapping`` is member -> score'''
+        z = self._get(name, ZSet, create=True)
+        added = 0
+        for member, value in mapping.items():
+            exists = text(member) in z.scores
+            if (nx and exists) or (xx and not exists):
+                continue
+            added += z.add(text(member), float(value))
+        self._cleanup(name, z)
+        return added
+
+    @writes
+    def zincrby(self, name, amount, value):
+        z = self._get(name, ZSet, create=True)
+        member = text(value)
+        new = z.scores.get(member, 0.0) + float(amount)
+        z.add(member, new)
+        return new
+
+    @writes
+    def zinterstore(self, dest, keys, aggregate=None):
+        '''``keys`` is a list, or a dict of key -> weight'''
+        weights = keys if isinstance(keys, dict) else dict( (k, 1) for k in keys )
+        sets = [ (self._get(k, ZSet) or ZSet(), float(w)) for k, w in weights.items() ]
+        pick = {None: sum, 'SUM': sum, 'MIN': min, 'MAX': max}[aggregate and aggregate.upper()]
+        smallest = min(sets, key=lambda s: len(s[0]))[0]
+        result = ZSet()
+        for member in smallest.scores:
+            if all(member in z.scores for z, w in sets):
+                result.add(member, pick([ z.scores[member] * w for z, w in sets ]))
+        self.data.pop(text(dest), None)
+        self.expires.pop(text(dest), None)
+        if result:
+            self.data[text(dest)] = result
+        return len(result)
+
+    @writes
+    def zrem(self, name, *values):
+        z = self._get(name, ZSet)
+        if not z:
+            return 0
+        removed = sum(1 for v in values if z.remove(text(v)))
+        self._cleanup(name, z)
+        return removed
+
+    def zcard(self, name):
+        return len(self._get(name, ZSet) or ())
+
+    def zscore(self, name, value):
+        z = self._get(name, ZSet)
+        return z.scores.get(text(value)) if z else None
+
+    def _pairs(self, entries, withscores, score_cast_func=float):
+        if withscores:
+            return [ (m, score_cast_func(s)) for s, m in entries ]
+        return [ m for s, m in entries ]
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        z = self._get(name, ZSet)
+        entries = list(reversed(z.entries)) if z and desc else (z.entries if z else [])
+        return self._pairs(entries[slice(*bounds(len(entries), start, end))], withscores, score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self.zrange(name, start, end, True, withscores, score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        z = self._get(name, ZSet)
+        entries = list(z.by_score(score(min, True), score(max, True))) if z else []
+        if start is not None:
+            entries = entries[int(start):int(start) + int(num)]
+        return self._pairs(entries, withscores, score_cast_func)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None, withscores=False, score_cast_func=float):
+        z = self._get(name, ZSet)
+        entries = list(z.by_score(score(min, True), score(max, True)))[::-1] if z else []
+        if start is not None:
+            entries = entries[int(start):int(start) + int(num)]
+        return self._pairs(entries, withscores, score_cast_func)
+
+    @writes
+    def zremrangebyrank(self, name, min, max):
+        z = self._get(name, ZSet)
+        if not z:
+            return 0
+        doomed = z.entries[slice(*bounds(len(z.entries), min, max))]
+        for s, m in doomed:
+            z.remove(m)
+        self._cleanup(name, z)
+        return len(doomed)
+
+    @writes
+    def zremrangebyscore(self, name, min, max):
+        z = self._get(name, ZSet)
+        if not z:
+            return 0
+        doomed = list(z.by_score(score(min, True), score(max, True)))
+        for s, m in doomed:
+            z.remove(m)
+        self._cleanup(name, z)
+        return len(doomed)
+
+    def zscan(self, name, cursor=0, match=None, count=None):
+        z = self._get(name, ZSet)
+        pairs = [ (m, s) for s, m in (z.entries if z else []) if not match or fnmatch.fnmatchcase(m, match) ]
+        return self._page(pairs, cursor, count)
+
+    def zscan_iter(self, name, match=None, count=None):
+        return iter(self.zscan(name, 0, match, len(self._get(name, ZSet) or ()) + 1)[1])
+
+    # hashes
+
+    def hget(self, name, key):
+        return (self._get(name, dict) or {}).get(text(key))
+
+    def hgetall(self, name):
+        return dict(self._get(name, dict) or {})
+
+    def hmget(self, name, keys, *args):
+        h = self._get(name, dict) or {}
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        return [ h.get(text(k)) for k in keys + list(args) ]
+
+    def hvals(self, name):
+        return list((self._get(name, dict) or {}).values())
+
+    def hexists(self, name, key):
+        return text(key) in (self._get(name, dict) or {})
+
+    @writes
+    def hset(self, name, key=None, value=None, mapping=None):
+        h = self._get(name, dict, create=True)
+        pairs = list((mapping or {}).items())
+        if key is not None:
+            pairs.append((key, value))
+        added = 0
+        for k, v in pairs:
+            added += text(k) not in h
+            h[text(k)] = text(v)
+        self._cleanup(name, h)
+        return added
+
+    @writes
+    def hsetnx(self, name, key, value):
+        h = self._get(name, dict, create=True)
+        if text(key) in h:
+            return 0
+        h[text(key)] = text(value)
+        return 1
+
+    @writes
+    def hmset(self, name, mapping):
+        h = self._get(name, dict, create=True)
+        h.update( (text(k), text(v)) for k, v in mapping.items() )
+        return True
+
+    @writes
+    def hdel(self, name, *keys):
+        h = self._get(name, dict)
+        if not h:
+            return 0
+        deleted = sum(1 for k in keys if h.pop(text(k), None) is not None)
+        self._cleanup(name, h)
+        return deleted
+
+    # the rest of the client
+
+    def execute_command(self, *args, **options):
+        return getattr(self, str(args[0]).lower())(*args[1:])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        '''Lua can't run here, the Python version given for it runs instead'''
+        if script not in python_scripts:
+            raise ResponseError('NOSCRIPT no Python version of this script, see models.Script')
+        return MemoryScript(self, python_scripts[script])
+
+class MemoryScript(object):
+    '''A script's Python version, run under the engine's lock so it is atomic'''
+
+    def __init__(self, engine, python):
+        self.engine = engine
+        self.python = python
+
+    def run(self, keys, args):
+        with self.engine.lock:
+            return self.python(self.engine, list(keys), [ str(a) for a in args ])
+
+    def __call__(self, keys=[], args=[], client=None):
+        if isinstance(client, MemoryPipeline):
+            # runs in its place in the pipeline, the reply comes from execute
+            client.command_stack.append((self.run, (keys, args), {}))
+            return client
+        return self.run(keys, args)
+
+class MemoryPipeline(object):
+    '''Queues calls and runs them all under the engine's lock'''
+
+    runs_lua = False
+    cross_key_scripts = False
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        method = getattr(self.engine, name)
+        def queue(*args, **kwargs):
+            self.command_stack.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        self.command_stack = []
+
+    def execute(self):
+        stack, self.command_stack = self.command_stack, []
+        with self.engine.lock:
+            return [ method(*args, **kwargs) for method, args, kwargs in stack ]
+
+def install():
+    '''Put the models on a ``MemoryRedis`` when ``--memory_store`` is given'''
+    if options.memory_store:
+        import models
+        models.use_client(MemoryRedis(options.memory_store))
@@ -0,0 +1,302 @@
+'''Count what we ask redis for, and who asks
+
+Every command through ``models.r`` (an ``InstrumentedRedis``) and through a
+handler's ``ar`` (see ``app.CountingClient``) is recorded with
+
+    command    GET, SADD, EVALSHA ...
+    namespace  users, items, groups, updates ... from the first key
+    context    'Item.set_group' for model code (see ``traced``), the handler
+               class for ``ar``
+
+as a count, an estimate of the bytes sent and received and a latency
+histogram.  ``MetricsHandler`` serves it all in the Prometheus text format.
+Commands slower than ``--slow_command_ms`` are logged to 'redis.slow'.
+
+Pipelines are recorded per command, their latency once as 'PIPELINE'.
+
+Each worker of server.py counts on its own.  With ``--metrics_dir`` they
+write what they have there every ``--metrics_interval`` seconds and
+``/metrics`` adds them all up, whichever worker answers.  A worker that
+dies takes its counts with it, Prometheus sees that as a counter reset.
+'''
+import os
+import json
+import time
+import errno
+import inspect
+import logging
+import functools
+import threading
+from collections import defaultdict
+
+import redis
+import tornado.web
+from tornado.options import define, options
+
+define('slow_command_ms', default=10, type=float, help='log redis commands slower than this')
+define('metrics_dir', default='', help='share the workers\' metrics through files in this directory')
+define('metrics_interval', default=5, type=float, help='seconds between writes to --metrics_dir')
+
+slow_log = logging.getLogger('redis.slow')
+
+namespaces = ('users', 'items', 'groups', 'updates', 'timelines', 'sessions', 'events')
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf'))
+# the first argument isn't a key for these
+keyless = frozenset(('INFO', 'PING', 'ECHO', 'SCAN', 'SELECT', 'FLUSHDB', 'SCRIPT',
+    'MULTI', 'EXEC', 'DBSIZE', 'TIME'))
+
+def namespace(command, args):
+    if command in keyless or not args:
+        return 'none'
+    key = args[0]
+    if command in ('EVAL', 'EVALSHA'):
+        if len(args) < 3 or not int(args[1]):
+            return 'none'
+        key = args[2]
+    if isinstance(key, (list, tuple)):
+        # MGET and friends take a list
+        if not key:
+            return 'none'
+        key = key[0]
+    if not isinstance(key, str):
+        key = key.decode('utf-8', 'replace') if isinstance(key, bytes) else str(key)
+    prefix = key.split(':', 1)[0]
+    return prefix if prefix in namespaces else 'other'
+
+def size(value):
+    '''Rough bytes on the wire for an argument or reply'''
+    if value is None:
+        return 0
+    if isinstance(value, (list, tuple, set)):
+        return sum(size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(size(k) + size(v) for k, v in value.items())
+    return len(value) if isinstance(value, (str, bytes)) else len(str(value))
+
+_local = threading.local()
+
+class context(object):
+    '''``with context('User.add_update'):`` puts the commands inside down to
+    that name.  The outermost one wins, so a command from ``fan_out`` is put
+    down to ``User.add_update``.'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.outer = getattr(_local, 'name', None)
+        if self.outer is None:
+            _local.name = self.name
+
+    def __exit__(self, *exc):
+        _local.name = self.outer
+
+def current_context():
+    return getattr(_local, 'name', None) or 'other'
+
+def _traced_function(function, name=None):
+    '''``function`` run in its own context, named after it or for a method
+    after the class it was called on (``Group._create``, not ``Model._create``)'''
+    def label(args):
+        if name or not args:
+            return name or function.__name__
+        owner = args[0] if isinstance(args[0], type) else args[0].__class__
+        return '%s.%s' % (owner.__name__, function.__name__)
+    if inspect.isgeneratorfunction(function):
+        # only while it runs, not while the caller holds it between items
+        @functools.wraps(function)
+        def generator(*args, **kwargs):
+            items = function(*args, **kwargs)
+            while True:
+                with context(label(args)):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                yield item
+        return generator
+    @functools.wraps(function)
+    def traced_function(*args, **kwargs):
+        with context(label(args)):
+            return function(*args, **kwargs)
+    return traced_function
+
+def traced(obj):
+    '''Decorate a function, or every method of a class, so the redis commands
+    they send are recorded under their name'''
+    if not isinstance(obj, type):
+        return _traced_function(obj, obj.__name__)
+    for attr, value in list(vars(obj).items()):
+        if attr.startswith('__') and attr != '__init__':
+            continue
+        if isinstance(value, classmethod):
+            value = classmethod(_traced_function(value.__func__))
+        elif isinstance(value, staticmethod):
+            value = staticmethod(_traced_function(value.__func__, '%s.%s' % (obj.__name__, attr)))
+        elif isinstance(value, property):
+            value = property(*[ f and _traced_function(f) for f in (value.fget, value.fset, value.fdel) ],
+                    doc=value.__doc__)
+        elif inspect.isfunction(value):
+            value = _traced_function(value)
+        else:
+            continue
+        setattr(obj, attr, value)
+    return obj
+
+class Registry(object):
+    '''Counters and histograms keyed by (command, namespace, context)'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.calls = defaultdict(int)
+        self.sent = defaultdict(int)
+        self.received = defaultdict(int)
+        # (command, namespace, context) -> per bucket counts, total seconds
+        self.histograms = defaultdict(lambda: [0] * len(buckets))
+        self.seconds = defaultdict(float)
+
+    def state(self):
+        '''Everything counted, as json for ``add``'''
+        with self.lock:
+            return dict( (field, [ [list(labels), value] for labels, value in getattr(self, field).items() ])
+                for field in ('calls', 'sent', 'received', 'histograms', 'seconds') )
+
+    def add(self, state):
+        '''Count what another worker's ``state`` counted too'''
+        with self.lock:
+            for field, values in state.items():
+                counts = getattr(self, field)
+                for labels, value in values:
+                    labels = tuple(labels)
+                    if field == 'histograms':
+                        counts[labels] = [ a + b for a, b in zip(counts[labels], value) ]
+                    else:
+                        counts[labels] += value
+
+    def record(self, command, args, reply, context, elapsed=None):
+        labels = (command, namespace(command, args), context)
+        with self.lock:
+            self.calls[labels] += 1
+            self.sent[labels] += size(args)
+            self.received[labels] += size(reply)
+            if elapsed is not None:
+                self._observe(labels, elapsed)
+        if elapsed is not None:
+            self.check_slow(command, args, context, elapsed)
+
+    def record_pipeline(self, stack, replies, context, elapsed):
+        '''``stack`` is a list of (command, args)'''
+        for (command, args), reply in zip(stack, replies or ()):
+            self.record(command, args, reply, context)
+        ns = namespace(*stack[0]) if stack else 'none'
+        with self.lock:
+            self._observe(('PIPELINE', ns, context), elapsed)
+        self.check_slow('PIPELINE', [ c for c, _ in stack ], context, elapsed)
+
+    def _observe(self, labels, elapsed):
+        counts = self.histograms[labels]
+        for n, le in enumerate(buckets):
+            if elapsed <= le:
+                counts[n] += 1
+                break
+        self.seconds[labels] += elapsed
+
+    def check_slow(self, command, args, context, elapsed):
+        if elapsed * 1000 >= options.slow_command_ms:
+            slow_log.warning('%.1fms %s %s from %s', elapsed * 1000, command,
+                    ' '.join(str(a) for a in args[:3]), context)
+
+    def render(self):
+        '''Everything in the Prometheus text exposition format'''
+        lines = []
+        def counter(name, help, values):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for (command, ns, context), value in sorted(values.items()):
+                lines.append('%s{command="%s",namespace="%s",context="%s"} %s' % (
+                    name, command, ns, context, value))
+        with self.lock:
+            counter('redis_commands_total', 'Redis commands sent.', self.calls)
+            counter('redis_sent_bytes_total', 'Approximate bytes of command arguments.', self.sent)
+            counter('redis_received_bytes_total', 'Approximate bytes of replies.', self.received)
+            name = 'redis_command_seconds'
+            lines.append('# HELP %s Redis command latency.' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for (command, ns, context), counts in sorted(self.histograms.items()):
+                labels = 'command="%s",namespace="%s",context="%s"' % (command, ns, context)
+                total = 0
+                for le, count in zip(buckets, counts):
+                    total += count
+                    le = '+Inf' if le == float('inf') else repr(le)
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, total))
+                lines.append('%s_sum{%s} %r' % (name, labels, self.seconds[(command, ns, context)]))
+                lines.append('%s_count{%s} %d' % (name, labels, total))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+class InstrumentedRedis(redis.Redis):
+    '''``redis.Redis`` that records every command in ``registry``'''
+
+    def execute_command(self, *args, **options):
+        start = time.time()
+        reply = super(InstrumentedRedis, self).execute_command(*args, **options)
+        registry.record(str(args[0]).upper(), args[1:], reply, current_context(), time.time() - start)
+        return reply
+
+    def pipeline(self, *args, **kwargs):
+        pipe = super(InstrumentedRedis, self).pipeline(*args, **kwargs)
+        execute = pipe.execute
+        def timed(*args, **kwargs):
+            context = current_context()
+            stack = [ (str(a[0]).upper(), a[1:]) for a, _ in pipe.command_stack ]
+            start = time.time()
+            replies = execute(*args, **kwargs)
+            registry.record_pipeline(stack, replies, context, time.time() - start)
+            return replies
+        pipe.execute = timed
+        return pipe
+
+def _state_path(pid):
+    return os.path.join(options.metrics_dir, '%d.json' % pid)
+
+def share():
+    '''Write our counts to ``--metrics_dir`` for the other workers' ``/metrics``'''
+    path = _state_path(os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.state(), f)
+    os.rename(path + '.tmp', path)
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def all_workers():
+    '''A ``Registry`` with our counts and every live worker's last shared ones'''
+    total = Registry()
+    total.add(registry.state())
+    for filename in os.listdir(options.metrics_dir):
+        pid, ext = os.path.splitext(filename)
+        if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        if not alive(int(pid)):
+            os.remove(_state_path(int(pid)))
+            continue
+        try:
+            with open(_state_path(int(pid))) as f:
+                total.add(json.load(f))
+        except (IOError, OSError, ValueError):
+            pass # went away while we looked
+    return total
+
+class MetricsHandler(tornado.web.RequestHandler):
+    '''Prometheus scrapes this, one target for all the workers with ``--metrics_dir``'''
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write((all_workers() if options.metrics_dir else registry).render())
@@ -1,35 +1,34 @@
 '''
 keys:
 
+The templates on User, Item and Group below are the source of truth, this
+is a map of them.  keyspace.py groups memory use by the same templates.
+
 ::site-wide keys::
-'users'
-    The set of usernames.
-    r.sismember('users', 'foouser')
-'users_ids'
-    The set of user_id s
-'users_incr'
-    The next user number
-'groups'
-    List of all groups
-'groups_incr'
-    The next group number
-'items'
-    List of all item ids
-'items_incr'
-    The next item number
-
-::get username from service::
-'services:<service>:<unique_id>'
-    Value is our username for the service and unique identifier.
+'___users'
+    The set of usernames claimed at signup.
+    r.sismember('___users', 'foouser')
+'users_incr', 'groups_incr', 'items_incr', 'updates_incr', 'comments_incr'
+    The id counters, handed out in blocks (see ``IdBlock``)
+'sessions:<token>'
+    hash of name and created, expires (see sessions.py)
+
+::login keys (app.py)::
+'<username>:<service>'
+    json from before 'users:profiles:<name>', see profiles.py
+'<service>:<unique_id>'
+    our username for the service's email / user id
 
 ::user data::
-'users:<username>'
+'users:id_for:<lowercase name>'
     returns the user id from the user name
-'users:<id>'
+'users:name_for:<id>'
     returns the username given the id
-
+'users:profiles:<name>'
+    hash of service -> the json from google, twitter or facebook, written
+    at login and read by every page in one HGETALL
 'users:<user_id>:<service>'
-    Value is the the json information associated with the username and the service.
+    json from before 'users:profiles:<name>', see profiles.py
 'users:<user_id>:set:created_items'
     Set of item ids created by the user
 'users:<user_id>:set:assigned_items'
@@ -40,52 +39,1012 @@ keys:
     The set of group ids that the user has permission to
 'users:<id>:updates'
     List of update ids for the user
+'timelines:users:<id>'
+    zset of update ids by time, capped (see ``fan_out``)
 
-::groups and items::
+::groups::
 'groups:<id>'
-    json dict of group attributes
+    the name
 'groups:<id>:creator'
-    username of the creator/leader (can change?)
+    id of the creator
 'groups:<id>:members'
-    Set of users who have permission with this group
-'groups:<id>:items'
+    Set of user ids who have permission with this group
+'groups:<id>:list:items'
     List of item ids for the group
+'groups:<id>:attrs:<key>'
+    string attrs
+'groups:<id>:keys'
+    set of the attr keys written, for delete
+'groups:<id>:hash'
+    name, creator and 'attr:<key>' when packed (see ``set_packed``)
+'timelines:groups:<id>'
+    zset of update ids by time
 
+::items::
 'items:<id>'
-    json dict of item attributes
-'items:<id>:creator'
+    the name
+'items:<id>:fk:creator'
     the id of the creator
-'items:<id>:group'
+'items:<id>:fk:group'
     the id of the group that the item belongs to
-'items:<id>:members'
-    set of usernames for watchers/privileged
+'items:<id>:mm:members'
+    set of user ids for watchers/privileged
+'items:<id>:sset:comments'
+    zset of comment ids by time
+'items:<id>:hash:comments'
+    comment id -> body
+'items:<id>:list:comments'
+    list of comment ids from before the zset, the bodies are their
+    'updates:<id>', see comments.py
+'items:<id>:sset:components'
+    zset of components
+'items:<id>:str:attrs:<key>', ':set:attrs:<key>', ':list:attrs:<key>', ':sset:attrs:<key>'
+    generic attrs of each type
+'items:<id>:keys'
+    set of the generic keys written, for delete
+'items:<id>:hash'
+    name, creator, group and 'attr:<key>' when packed
+'{search}:word:<word>'
+    zset of item id -> weight of the word in the item (see search.py)
 
 ::updates::
-'update:<update_id>'
+'updates:<update_id>'
     Returns the update string
+'events:<timeline key>'
+    pubsub channel for new entries on the timeline (see realtime.py)
 
 '''
 #from IPython.Shell import IPShellEmbed
 #ipython = IPShellEmbed()
 
+import os
 import re
+import time
+import atexit
+import logging
+import threading
+import itertools
+from collections import OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from tornado import gen
+from tornado.options import define, options
 from tornado.escape import json_decode as decode
 from tornado.escape import json_encode as encode
-import redis
-r = redis.Redis()
+from redis import asyncio as aioredis
+from bloom import BloomFilter
+import metrics
+import memory
+import search
+# every command through ``r`` is counted, see metrics.py
+define('packed', default=False, type=bool, help='store items and groups as one hash each, see pack.py')
+
+r = metrics.InstrumentedRedis(decode_responses=True)
+
+def use_client(client):
+    '''Swap the client every model talks through, eg a ``shard.ShardedRedis``'''
+    global r
+    r = client
+
+# Non-blocking clients all share this pool, a command holds a connection
+# only until its reply is in
+async_pool = aioredis.BlockingConnectionPool(max_connections=250, decode_responses=True)
+
+def async_pool_for(key):
+    '''The pool for the server ``key`` is on, shard.py puts in one that knows'''
+    return async_pool
+
+def async_client(key=None):
+    '''A ``redis.asyncio`` client for code running on the IOLoop, on the server
+    ``key`` is on if given
+
+    Its commands and pipeline ``execute`` return awaitables, a coroutine
+    yields them.'''
+    return aioredis.Redis(connection_pool=async_pool if key is None else async_pool_for(key))
+
+# Every username we know of, see ``load_usernames``.  A hint only: a name
+# another process created while our subscription was down can be missing.
+usernames = BloomFilter()
+usernames_lock = threading.Lock()
+growing = None # names added while a bigger filter is built, see ``remember_username``
+
+# the fields of 'users:profiles:<name>'
+services = ('google', 'twitter', 'facebook')
+
+@metrics.traced
+def build_usernames(capacity=100000):
+    '''A filter of '___users' and 'users:id_for:*', with SSCAN/SCAN so redis is never blocked'''
+    names = list(r.sscan_iter('___users', count=1000))
+    prefix = User._id % ''
+    names.extend(k[len(prefix):] for k in r.scan_iter(match=prefix + '*', count=1000))
+    bf = BloomFilter(capacity=max(capacity, 2 * len(names)))
+    bf.update(names)
+    return bf
+
+def load_usernames(capacity=100000):
+    '''Rebuild ``usernames``, call it at startup before the IOLoop is running'''
+    global usernames
+    usernames = build_usernames(capacity)
+    return usernames
+
+def _grow_usernames(capacity):
+    global usernames, growing
+    try:
+        bf = build_usernames(capacity)
+    except Exception:
+        logging.exception('could not rebuild the username filter')
+        bf = None
+    with usernames_lock:
+        if bf is not None:
+            bf.update(growing)
+            usernames = bf
+        growing = None
+
+def remember_username(name):
+    '''Add ``name`` to our ``usernames``
+
+    When the filter is full a bigger one is built on a thread, the names
+    added meanwhile go into both.'''
+    global growing
+    with usernames_lock:
+        usernames.add(name)
+        usernames.add(name.lower())
+        if growing is not None:
+            growing.extend([name, name.lower()])
+        elif usernames.full():
+            growing = []
+            thread = threading.Thread(target=_grow_usernames, args=(2 * usernames.capacity,),
+                    name='usernames')
+            thread.daemon = True
+            thread.start()
+
+@metrics.traced
+def add_username(name, client=None):
+    '''A user was created here: remember the name and publish it to the other
+    processes (realtime.py adds it to theirs).  ``client`` can be a pipeline
+    of either kind to queue the PUBLISH on.'''
+    remember_username(name)
+    if client is None:
+        client = r
+    client.publish(username_channel, name)
+
+@metrics.traced
+def mget(keys):
+    '''MGET that tolerates an empty list of keys
+
+    One round trip no matter how many keys are asked for.'''
+    if not keys:
+        return []
+    return r.mget(keys)
+
+def first(*values):
+    '''The first value that is not None'''
+    for v in values:
+        if v is not None:
+            return v
+
+@metrics.traced
+def names_for(template, ids):
+    '''dict of id -> name for the ids, ``template`` is a model's ``_name``'''
+    ids = list(ids)
+    return dict(zip(ids, mget([template % i for i in ids])))
+
+# Streaming and paging.  The iter_* generators hold one window in memory at a
+# time, the *_page functions return (page, cursor) where the cursor is an
+# opaque string to hand back for the next page, or None at the end.
+
+@metrics.traced
+def iter_list(key, window=100):
+    '''Every element of a list, LRANGE ``window`` at a time'''
+    start = 0
+    while True:
+        chunk = r.lrange(key, start, start + window - 1)
+        for x in chunk:
+            yield x
+        if len(chunk) < window:
+            return
+        start += window
+
+@metrics.traced
+def list_page(key, cursor=None, count=50, head=True):
+    '''A page of a list.  ``head`` says new elements are pushed on the head.
+
+    The cursor holds our offset, the list length and the last element handed
+    out, so pushes on the head (and a removal) since the last page don't
+    repeat or skip anything.'''
+    offset, last = 0, None
+    if cursor:
+        offset, length, last = cursor.split(':', 2)
+        offset = int(offset)
+        if head:
+            offset += max(0, r.llen(key) - int(length))
+    # one extra at the front to check our place against ``last``
+    start = max(0, offset - 1) if last is not None else offset
+    pipe = r.pipeline(transaction=False)
+    pipe.lrange(key, start, offset + count - 1)
+    pipe.llen(key)
+    window, length = pipe.execute()
+    if last is not None and offset > 0 and last in window:
+        window = window[window.index(last) + 1:]
+    # otherwise ``last`` or one before it went and what follows moved up one,
+    # so the extra one at the front is new to the caller
+    page = window[:count]
+    offset += len(page)
+    if not page or offset >= length:
+        return page, None
+    return page, '%d:%d:%s' % (offset, length, page[-1])
+
+@metrics.traced
+def set_page(key, cursor=None, count=50):
+    '''A page of a set with SSCAN, a member can (rarely) show up on two pages'''
+    cursor, members = r.sscan(key, int(cursor or 0), count=count)
+    return members, str(cursor) if cursor else None
+
+@metrics.traced
+def zset_page(key, cursor=None, count=50):
+    '''A page of (member, score) from a sorted set with ZSCAN'''
+    cursor, pairs = r.zscan(key, int(cursor or 0), count=count)
+    return pairs, str(cursor) if cursor else None
+
+@metrics.traced
+def zset_after(key, score, member=None, count=None):
+    '''(member, score) pairs after ``member`` at ``score`` in ZRANGE order, one
+    round trip.  Members with the same score come by member, so the ones
+    tied with ``member`` that sort after it are kept.  Without a ``member``
+    everything at ``score`` is skipped.'''
+    score = float(score)
+    pipe = r.pipeline(transaction=False)
+    pipe.zrangebyscore(key, repr(score), repr(score), withscores=True)
+    pipe.zrangebyscore(key, '(%r' % score, '+inf',
+            start=0 if count else None, num=count, withscores=True)
+    ties, newer = pipe.execute()
+    if member is None:
+        ties = []
+    pairs = [ p for p in ties if str(p[0]) > str(member) ] + newer
+    return pairs[:count] if count else pairs
+
+def score_cursor(pairs):
+    '''The cursor for ``zset_after`` to carry on after the last of ``pairs``'''
+    member, score = pairs[-1]
+    return '%r:%s' % (float(score), member)
+
+def parse_score_cursor(cursor):
+    '''(score, member), a cursor from before there were members has just the score'''
+    score, _, member = cursor.partition(':')
+    return float(score), member or None
+
+def _not_in(key, members):
+    pipe = r.pipeline(transaction=False)
+    for m in members:
+        pipe.sismember(key, m)
+    return [ m for m, seen in zip(members, pipe.execute()) if not seen ]
+
+@metrics.traced
+def iter_union(first_key, second_key, count=100):
+    '''SUNION without building it, members of both sets come out once'''
+    for m in r.sscan_iter(first_key, count=count):
+        yield m
+    for batch in chunked(r.sscan_iter(second_key, count=count), count):
+        for m in _not_in(first_key, batch):
+            yield m
+
+@metrics.traced
+def union_page(first_key, second_key, cursor=None, count=50):
+    '''A page of the union of two sets, the cursor is '<set>:<sscan cursor>' '''
+    which, cursor = (cursor or '0:0').split(':')
+    if which == '0':
+        cursor, members = r.sscan(first_key, int(cursor), count=count)
+    else:
+        cursor, members = r.sscan(second_key, int(cursor), count=count)
+        members = _not_in(first_key, members)
+    if cursor:
+        return members, '%s:%s' % (which, cursor)
+    return members, '1:0' if which == '0' else None
+
+@metrics.traced
+def scan_ids(template, count=500, pause=0):
+    '''Stream the id of every key matching ``template`` (one %s for the id)
+
+    Uses SCAN ``count`` keys at a time, sleeping ``pause`` between batches.'''
+    key = re.compile('^' + re.escape(template).replace(re.escape('%s'), r'(\d+)') + '$')
+    for batch in chunked(r.scan_iter(match=template % '*', count=count), count):
+        for k in batch:
+            m = key.match(k)
+            if m:
+                yield m.group(1)
+        if pause:
+            time.sleep(pause)
+
+def chunked(iterable, size):
+    '''Lists of up to ``size`` items from ``iterable``'''
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+@metrics.traced
+class Reaper(object):
+    '''Deletes batches of keys on a background thread
+
+    Each DEL is bounded to one batch so redis never stalls on a big cascade,
+    and we pause between batches to leave room for everyone else.'''
+
+    def __init__(self, pause=0.005):
+        self.pause = pause
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def delete(self, batches, background=True):
+        '''``batches`` is an iterable of lists of keys, it is consumed on the thread'''
+        if not background:
+            return self._run(batches)
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._work, name='reaper')
+                self.thread.daemon = True
+                self.thread.start()
+        self.jobs.put(batches)
+
+    def join(self):
+        '''Block until every queued delete has finished'''
+        self.jobs.join()
+
+    def drain(self, timeout=30):
+        '''``join`` for at most ``timeout`` seconds, before the process exits.
+        False if deletes were left unfinished.'''
+        deadline = time.time() + timeout
+        with self.jobs.all_tasks_done:
+            while self.jobs.unfinished_tasks:
+                left = deadline - time.time()
+                if left <= 0:
+                    logging.warning('reaper: exiting with %d deletes unfinished', self.jobs.unfinished_tasks)
+                    return False
+                self.jobs.all_tasks_done.wait(left)
+        return True
+
+    def _run(self, batches, pause=0):
+        deleted = 0
+        for keys in batches:
+            if keys:
+                deleted += r.delete(*keys)
+                if pause:
+                    time.sleep(pause)
+        return deleted
+
+    def _work(self):
+        while True:
+            batches = self.jobs.get()
+            try:
+                self._run(batches, self.pause)
+            except Exception:
+                logging.exception('reaper failed to finish a delete')
+            finally:
+                self.jobs.task_done()
+
+reaper = Reaper()
+# the thread is a daemon, don't let it die with deletes half done
+atexit.register(reaper.drain)
+
+# set by ``indexes.py --repair`` once every attr key is in its registry
+registries_filled = 'registries_filled'
+
+# Stands in for the id of the object being created in ``create_object`` ops
+NEW_ID = object()
+
+# How many ids a process reserves from a counter at a time
+id_block_size = 100
+
+class IdBlock(object):
+    '''Hands out ids from a range reserved with one INCRBY (hi/lo)
+
+    Ids a process reserved but never used, because it exited or crashed, are
+    simply skipped.  A forked child notices the pid change and reserves its
+    own range instead of sharing its parent's.'''
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.lock = threading.Lock()
+        self.pid = None
+        self.next, self.last = 1, 0 # empty
+        self.spare = []
+
+    def take(self, n=1, reserve=True, reserved=None):
+        '''A list of ``n`` unused ids, at most one INCRBY however many
+
+        With ``reserve`` False it returns None instead of making the INCRBY,
+        the caller reserves ``size(n)`` ids and passes ``reserved``, the
+        INCRBY's reply.'''
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid, self.next, self.last, self.spare = os.getpid(), 1, 0, []
+            if reserved is not None:
+                # what's left of this block is dropped, gaps are fine
+                self.last, self.next = int(reserved), int(reserved) - self.size(n) + 1
+            if not reserve and n > len(self.spare) + self.last - self.next + 1:
+                return None
+            ids = self.spare[:n]
+            del self.spare[:n]
+            n -= len(ids)
+            if n > self.last - self.next + 1:
+                size = self.size(n)
+                self.last = r.incr(self.counter, size)
+                self.next = self.last - size + 1
+            ids.extend(range(self.next, self.next + n))
+            self.next += n
+            return ids
+
+    def size(self, n):
+        '''How many ids to reserve when ``n`` are needed'''
+        return max(id_block_size, n)
+
+    def give_back(self, id):
+        '''An id taken but not used, it goes out again next'''
+        with self.lock:
+            if self.pid == os.getpid():
+                self.spare.append(id)
+
+id_blocks = {}
+
+@metrics.traced
+def new_ids(counter, n=1):
+    '''``n`` fresh ids for ``counter`` (eg 'items_incr'), usually without a round trip'''
+    if counter not in id_blocks:
+        id_blocks.setdefault(counter, IdBlock(counter))
+    return id_blocks[counter].take(n)
+
+@gen.coroutine
+def fetch_new_ids(counter, client, n=1):
+    '''Non-blocking ``new_ids``, a new block is reserved through ``client``'''
+    block = id_blocks.setdefault(counter, IdBlock(counter))
+    ids = block.take(n, reserve=False)
+    if ids is None:
+        last = yield client.incrby(counter, block.size(n))
+        ids = block.take(n, reserved=last)
+    raise gen.Return(ids)
+
+def async_pipeline(client, transaction=True):
+    '''A pipeline on an async client, yield its ``execute()``'''
+    return client.pipeline(transaction=transaction)
+
+def queue_ops(pipe, ops, id):
+    '''Queue ``create_object`` style ``ops`` for ``id`` on a pipeline of
+    either client, they take the same arguments'''
+    for op in ops:
+        command, template, values = op[0], op[1], op[2:]
+        key = template % id if '%s' in template else template
+        values = [ id if v is NEW_ID else v for v in values ]
+        getattr(pipe, command.lower())(key, *values)
+    return pipe
+
+@metrics.traced
+def create_object(counter, ops):
+    '''Allocate an id from ``counter`` and run ``ops`` with it in one MULTI/EXEC
+
+    ``ops`` are (command, key template, values...) where the template has
+    one %s for the id (or none) and any value may be ``NEW_ID``.'''
+    id = new_ids(counter)[0]
+    queue_ops(r.pipeline(transaction=True), ops, id).execute()
+    return id
+
+@gen.coroutine
+def async_create_object(client, counter, ops):
+    '''Non-blocking ``create_object`` through an async ``client``'''
+    id = (yield fetch_new_ids(counter, client))[0]
+    yield queue_ops(async_pipeline(client), ops, id).execute()
+    raise gen.Return(id)
+
+# Reverse indexes.  Every relationship is written from both ends in one
+# transaction, indexes.py finds and repairs anything that drifted anyway.
+
+@metrics.traced
+def old_comment_bodies(ids):
+    '''The texts of the ids in an old 'items:<id>:list:comments', comments
+    were updates then.  Ones since deleted are left out.'''
+    return [ body for body in mget([ User._update_str % id for id in ids ]) if body is not None ]
+
+@metrics.traced
+def link_member(members, user_id, assigned, object_id):
+    '''user_id into an object's ``members``, object_id into the user's ``assigned``'''
+    pipe = r.pipeline(transaction=True)
+    pipe.sadd(members, user_id)
+    pipe.sadd(assigned, object_id)
+    return pipe.execute()[0]
+
+@gen.coroutine
+def async_link_member(client, members, user_id, assigned, object_id):
+    '''Non-blocking ``link_member``'''
+    pipe = async_pipeline(client)
+    pipe.sadd(members, user_id)
+    pipe.sadd(assigned, object_id)
+    replies = yield pipe.execute()
+    raise gen.Return(replies[0])
+
+@metrics.traced
+def unlink_member(members, user_id, assigned, object_id):
+    pipe = r.pipeline(transaction=True)
+    pipe.srem(members, user_id)
+    pipe.srem(assigned, object_id)
+    return pipe.execute()[0]
+
+class Script(object):
+    '''A Lua script and the same steps written as plain commands
+
+    The Python version is what ``memory.MemoryRedis`` runs for the Lua, and,
+    unless the script is ``local`` to one node, what runs on clients that
+    can't run a script whose keys are built inside the Lua
+    (``cross_key_scripts`` is False, see shard.py).  There it is not atomic.
+    The Lua is registered on whatever ``r`` is now.'''
+    def __init__(self, lua, python=None, local=False):
+        self.lua = lua
+        self.python = python
+        self.local = local
+        self.registered = (None, None)
+        if python:
+            memory.python_scripts[lua] = python
+
+    def __call__(self, keys=[], args=[], client=None):
+        if client is None: # an empty pipeline is falsy
+            client = r
+        if self.python and not self.local and getattr(client, 'runs_lua', True) and \
+                not getattr(client, 'cross_key_scripts', True):
+            return self.python(client, list(keys), [ str(a) for a in args ])
+        if self.registered[0] is not r:
+            self.registered = (r, r.register_script(self.lua))
+        return self.registered[1](keys=keys, args=args, client=client)
+
+# Move an item between groups.  KEYS: the item's group key and hash, then
+# the items lists of the group it was in, the new one and the expected one
+# (the group key stands in for a group there isn't).  ARGV: item id, new
+# group id ('' for none), packed, push on head, group channel, event,
+# expected old group, the old group the caller read.  If the item has moved
+# since the caller read it nothing changes, the caller sees a different old
+# group come back and tries again.
+_set_group_lua = '''
+local old = redis.call('HGET', KEYS[2], 'group') or redis.call('GET', KEYS[1])
+if (old or '') ~= ARGV[8] then
+    return old
+end
+if ARGV[7] ~= '' and old ~= ARGV[7] then
+    redis.call('LREM', KEYS[5], 0, ARGV[1])
+    return old
+end
+if old then
+    redis.call('LREM', KEYS[3], 0, ARGV[1])
+end
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[2], 'group')
+    redis.call('DEL', KEYS[1])
+    return old
+end
+if ARGV[3] == '1' then
+    redis.call('HSET', KEYS[2], 'group', ARGV[2])
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+if ARGV[4] == '1' then
+    redis.call('LPUSH', KEYS[4], ARGV[1])
+else
+    redis.call('RPUSH', KEYS[4], ARGV[1])
+end
+redis.call('PUBLISH', ARGV[5], ARGV[6])
+return old
+'''
+
+def _set_group_python(client, keys, args):
+    group_key, hash_key, old_items, new_items, expected_items = keys
+    item, new, packed, head, channel, event, expected, seen = args
+    old = client.hget(hash_key, 'group') or client.get(group_key)
+    if (old or '') != seen:
+        return old
+    if expected and old != expected:
+        client.lrem(expected_items, 0, item)
+        return old
+    pipe = client.pipeline(transaction=True)
+    if old:
+        pipe.lrem(old_items, 0, item)
+    if not new:
+        pipe.hdel(hash_key, 'group')
+        pipe.delete(group_key)
+    else:
+        if packed:
+            pipe.hset(hash_key, 'group', new)
+            pipe.delete(group_key)
+        else:
+            pipe.set(group_key, new)
+        if head:
+            pipe.lpush(new_items, item)
+        else:
+            pipe.rpush(new_items, item)
+        pipe.publish(channel, event)
+    pipe.execute()
+    return old
+
+_set_group_script = Script(_set_group_lua, _set_group_python)
+
+# Which of ARGV[5..] (item ids) can the user see.  KEYS: the user's created
+# items, assigned items, created groups, assigned groups.  ARGV: user id, then
+# the item members, hash and group fk templates.
+_visible_items_lua = '''
+local visible = {}
+for i = 5, #ARGV do
+    local item = ARGV[i]
+    local ok = redis.call('SISMEMBER', KEYS[1], item) == 1
+        or redis.call('SISMEMBER', KEYS[2], item) == 1
+        or redis.call('SISMEMBER', string.format(ARGV[2], item), ARGV[1]) == 1
+    if not ok then
+        local group = redis.call('HGET', string.format(ARGV[3], item), 'group')
+            or redis.call('GET', string.format(ARGV[4], item))
+        ok = group and (redis.call('SISMEMBER', KEYS[3], group) == 1
+            or redis.call('SISMEMBER', KEYS[4], group) == 1)
+    end
+    if ok then
+        visible[#visible + 1] = item
+    end
+end
+return visible
+'''
+
+def _visible_items_queue(pipe, keys, user, items):
+    '''The reads for ``_visible_items_pick``, queued on a pipeline of either client'''
+    pipe.sunion([keys[2], keys[3]])
+    for item in items:
+        pipe.sismember(keys[0], item)
+        pipe.sismember(keys[1], item)
+        pipe.sismember(Item._members % item, user)
+        pipe.hget(Item._hash % item, 'group')
+        pipe.get(Item._group % item)
+    return pipe
+
+def _visible_items_pick(items, replies):
+    groups = replies[0]
+    visible = []
+    for n, item in enumerate(items):
+        created, assigned, member, packed_group, group = replies[1 + 5*n:6 + 5*n]
+        if created or assigned or member or (packed_group or group) in groups:
+            visible.append(item)
+    return visible
+
+def _visible_items_python(client, keys, args):
+    items = args[4:]
+    pipe = _visible_items_queue(client.pipeline(transaction=False), keys, args[0], items)
+    return _visible_items_pick(items, pipe.execute())
+
+_visible_items_script = Script(_visible_items_lua, _visible_items_python)
+
+# Look the name up and create the user if it is free, all in one step.
+# KEYS: id_for key  ARGV: name, name_for template, the id to use if new
+_create_user_lua = '''
+local id = redis.call('GET', KEYS[1])
+if id then
+    return {id, 0, redis.call('GET', string.format(ARGV[2], id))}
+end
+redis.call('SET', string.format(ARGV[2], ARGV[3]), ARGV[1])
+redis.call('SET', KEYS[1], ARGV[3])
+return {ARGV[3], 1, ARGV[1]}
+'''
+
+def _create_user_python(client, keys, args):
+    name, template, candidate = args
+    id = client.get(keys[0])
+    if id:
+        return [id, 0, client.get(template % id)]
+    client.set(template % candidate, name)
+    client.set(keys[0], candidate)
+    return [candidate, 1, name]
+
+# both keys stay on the home node when sharded
+_create_user_script = Script(_create_user_lua, _create_user_python, local=True)
 
 # Somehow we can abstract what is in these models
 # through metaclass or inheritance TODO
+class IdentityMap(object):
+    '''Bounded LRU of model instances keyed by (class, id)
+
+    One per request: BaseHandler makes it in ``prepare`` and passes it to the
+    models it loads (``Item(id, identity_map=...)``, ``fetch``), it goes away
+    with the handler so nothing stays stale for long.'''
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.objects = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, cls, id):
+        with self.lock:
+            obj = self.objects.pop((cls, str(id)), None)
+            if obj is not None:
+                self.objects[(cls, str(id))] = obj
+            return obj
+
+    def add(self, obj):
+        '''Remember ``obj``, unless we already have one for it, returns the one to use'''
+        key = (obj.__class__, str(obj.id))
+        with self.lock:
+            obj = self.objects.pop(key, obj)
+            self.objects[key] = obj
+            if len(self.objects) > self.size:
+                self.objects.popitem(last=False)
+            return obj
+
+    def load(self, cls, id):
+        '''The shared instance for ``id``, its name is read when first needed'''
+        obj = self.get(cls, id)
+        return obj if obj is not None else self.add(cls._hydrate(id))
+
+    def discard(self, cls, id):
+        with self.lock:
+            self.objects.pop((cls, str(id)), None)
+
+    def clear(self):
+        with self.lock:
+            self.objects.clear()
+
+# name of an instance that hasn't been read yet
+NOT_LOADED = object()
+
 class ModelBase(type):
+    '''Model(id, identity_map=m) hands out m's shared, lazily loaded instance
+    for that id
 
-    # This anti-idiom is a placeholder :P
-    pass
+    Anything else (creating, or passing extra fields) runs __init__ as usual
+    and the result goes into ``identity_map`` when there is one.
 
-class Model(object):
-    __metaclass__ = ModelBase
+    The redis commands a model's methods send are counted under
+    'Class.method', see ``metrics.traced``.'''
+
+    def __init__(cls, name, bases, attrs):
+        super(ModelBase, cls).__init__(name, bases, attrs)
+        metrics.traced(cls)
+
+    def __call__(cls, id=None, *args, **kwargs):
+        objects = kwargs.pop('identity_map', None)
+        if objects is None:
+            return super(ModelBase, cls).__call__(id, *args, **kwargs)
+        if id and not args and not kwargs:
+            return objects.load(cls, id)
+        return objects.add(super(ModelBase, cls).__call__(id, *args, **kwargs))
+
+# ``__metaclass__`` is ignored by python 3 and ``metaclass=`` is a syntax
+# error in python 2, so Model inherits the metaclass from a base made with it
+class Model(ModelBase('ModelRoot', (object,), {'__slots__': ()})):
+    __slots__ = ('id', '_loaded_name')
 
     def __eq__(self, other):
         return self.id == other.id and isinstance(other, self.__class__)
+    def __hash__(self):
+        return hash((self.__class__, str(self.id)))
+
+    @property
+    def name(self):
+        '''Read from redis the first time it is asked for'''
+        if self._loaded_name is NOT_LOADED:
+            name = self.names([self.id])[self.id]
+            if not name:
+                raise DoesNotExistException('%s %s does not exist' % (self.__class__.__name__, self.id))
+            self._loaded_name = name
+        return self._loaded_name
+    @name.setter
+    def name(self, value):
+        self._loaded_name = value
+
+    _fixed = () # key templates every instance has, see ``key_batches``
+    _registry = None # set of the other keys an instance has written
+    _generic = () # base key templates of the attrs, what the registry records
+    _scalars = () # (field, key template) for the one-value fields
+    _hash = None # where the scalars and string attrs live when packed
+    packed = False # see ``set_packed``
+
+    def _keys(self):
+        '''Compute the redis keys for this object from self.id'''
+        pass
+
+    @classmethod
+    def names(cls, ids):
+        '''dict of id -> name, one round trip for any number of ids'''
+        ids = list(ids)
+        if not cls.packed:
+            return names_for(cls._name, ids)
+        pipe = r.pipeline(transaction=False)
+        for id in ids:
+            pipe.hget(cls._hash % id, 'name')
+            pipe.get(cls._name % id)
+        values = pipe.execute()
+        return dict( (id, first(values[2*n], values[2*n + 1])) for n, id in enumerate(ids) )
+
+    def _read(self, field, key):
+        '''A scalar field or string attr.  When packed it comes from our hash,
+        falling back to the old ``key`` until the object has been migrated.'''
+        if not self.packed:
+            return r.get(key)
+        pipe = r.pipeline(transaction=False)
+        pipe.hget(self.rhash, field)
+        pipe.get(key)
+        return first(*pipe.execute())
+
+    def _write(self, field, key, value, command='set', register=False):
+        '''Write a scalar field or string attr, ``command`` can be 'getset'
+
+        Unpacked, ``register`` records ``key`` in our registry.  Packed, the old
+        ``key`` is dropped in the same transaction so it can't shadow the hash.'''
+        if not self.packed:
+            if register:
+                return self._register(key, command, value)
+            return getattr(r, command)(key, value)
+        pipe = r.pipeline(transaction=True)
+        pipe.hget(self.rhash, field)
+        pipe.get(key)
+        pipe.hset(self.rhash, field, value)
+        pipe.delete(key)
+        packed, old, _, _ = pipe.execute()
+        return first(packed, old) if command == 'getset' else True
+
+    def fields(self):
+        '''dict of the scalar fields (and string attrs when packed) in one read'''
+        templates = [ (f, t % self.id) for f, t in self._scalars ]
+        pipe = r.pipeline(transaction=False)
+        pipe.mget([ k for f, k in templates ])
+        if self.packed:
+            pipe.hgetall(self.rhash)
+        results = pipe.execute()
+        values = dict( (f, v) for (f, k), v in zip(templates, results[0]) if v is not None )
+        if self.packed:
+            values.update(results[1])
+        return values
+
+    def _register(self, key, command, *args):
+        '''Run ``command`` on ``key`` and record ``key`` in our registry, one round trip'''
+        pipe = r.pipeline()
+        getattr(pipe, command)(key, *args)
+        pipe.sadd(self.rkeys, key)
+        return pipe.execute()[0]
+
+    def key_batches(self, batch=100):
+        '''Every key this object owns, ``batch`` at a time: the fixed ones and
+        what is in our registry.  Keys written before there were registries
+        are added to them by ``indexes.py --repair``, until it has run an
+        empty registry means a SCAN for our attrs.'''
+        yield [ t % self.id for t in self._fixed ]
+        registered = False
+        for keys in chunked(r.sscan_iter(self.rkeys, count=batch), batch):
+            registered = True
+            yield keys
+        if not registered and self._generic and not r.exists(registries_filled):
+            for template in self._generic:
+                for keys in chunked(r.scan_iter(match=template % self.id + '*', count=batch), batch):
+                    yield keys
+        yield [self.rkeys]
+
+    def delete(self, background=True):
+        '''Remove every key of this object, by default on the reaper thread'''
+        return reaper.delete(self.key_batches(), background)
+
+    @classmethod
+    def _create(cls, name, created_set=None, **fields):
+        '''New id, name and ``fields`` written atomically in one round trip
+
+        ``fields`` are named after the key templates, creator= writes ``_creator``.
+        ``created_set`` also gets the new id.'''
+        return create_object(cls._pk, cls._create_ops(name, created_set, fields))
+
+    @classmethod
+    @gen.coroutine
+    def async_create(cls, client, name, created_set=None, **fields):
+        '''Non-blocking ``_create`` through an async ``client``'''
+        id = yield async_create_object(client, cls._pk, cls._create_ops(name, created_set, fields))
+        raise gen.Return(id)
+
+    @classmethod
+    def _create_ops(cls, name, created_set, fields):
+        if cls.packed:
+            ops = [ ('HSET', cls._hash, 'name', name) ]
+            for field, value in sorted(fields.items()):
+                if value:
+                    ops.append(('HSET', cls._hash, field, value))
+        else:
+            ops = [ ('SET', cls._name, name) ]
+            for field, value in sorted(fields.items()):
+                if value:
+                    ops.append(('SET', getattr(cls, '_' + field), value))
+        if created_set:
+            ops.append(('SADD', created_set, NEW_ID))
+        ops.extend(cls._reverse_ops(fields))
+        ops.extend(cls._name_ops(name))
+        return ops
+
+    @classmethod
+    def _reverse_ops(cls, fields):
+        '''(command, key, NEW_ID) for the reverse indexes a new object belongs in'''
+        return []
+
+    @classmethod
+    def _name_ops(cls, name):
+        '''(command, key, value, NEW_ID) for the indexes of a new object's name'''
+        return []
+
+    @classmethod
+    def create_many(cls, names, created_set=None, **fields):
+        '''Bulk ``_create``, the ids come from (at most) one INCRBY and the writes go
+        in one MULTI/EXEC'''
+        names = list(names)
+        if not names:
+            return []
+        ids = new_ids(cls._pk, len(names))
+        pipe = r.pipeline(transaction=True)
+        for id, name in zip(ids, names):
+            if cls.packed:
+                packed = dict( (f, v) for f, v in fields.items() if v )
+                packed['name'] = name
+                pipe.hset(cls._hash % id, mapping=packed)
+                continue
+            pipe.set(cls._name % id, name)
+            for field, value in sorted(fields.items()):
+                if value:
+                    pipe.set(getattr(cls, '_' + field) % id, value)
+        for command, key, _ in cls._reverse_ops(fields):
+            getattr(pipe, command.lower())(key, *ids)
+        for id, name in zip(ids, names):
+            for command, key, value, _ in cls._name_ops(name):
+                getattr(pipe, command.lower())(key, value, id)
+        if created_set:
+            pipe.sadd(created_set, *ids)
+        pipe.execute()
+        return ids
+
+    @classmethod
+    def _hydrate(cls, id, name=NOT_LOADED):
+        '''Build an instance from values we already have, no round trips'''
+        obj = cls.__new__(cls)
+        obj.id = id
+        obj.name = name
+        obj._keys()
+        return obj
+
+    @classmethod
+    @gen.coroutine
+    def fetch_names(cls, ids, client):
+        '''Non-blocking ``names``'''
+        ids = list(ids)
+        if not ids:
+            raise gen.Return({})
+        if not cls.packed:
+            values = yield client.mget([ cls._name % id for id in ids ])
+            raise gen.Return(dict(zip(ids, values)))
+        pipe = async_pipeline(client, transaction=False)
+        for id in ids:
+            pipe.hget(cls._hash % id, 'name')
+            pipe.get(cls._name % id)
+        values = yield pipe.execute()
+        raise gen.Return(dict( (id, first(values[2*n], values[2*n + 1])) for n, id in enumerate(ids) ))
+
+    @classmethod
+    @gen.coroutine
+    def fetch(cls, id, client, identity_map=None):
+        '''Non-blocking retrieve by id, for coroutine handlers
+
+        ``client`` is an async client (see ``async_client``), the
+        instance is shared through ``identity_map`` if one is given.'''
+        if cls.packed:
+            pipe = async_pipeline(client, transaction=False)
+            pipe.hget(cls._hash % id, 'name')
+            pipe.get(cls._name % id)
+            name = first(*(yield pipe.execute()))
+        else:
+            name = yield client.get(cls._name % id)
+        if not name:
+            raise DoesNotExistException('%s %s does not exist' % (cls.__name__, id))
+        obj = cls._hydrate(id, name)
+        if identity_map is not None:
+            obj = identity_map.add(obj)
+            obj.name = name
+        raise gen.Return(obj)
 
 # perhaps we can have a base manager like django that can be a class
 # thus we get User.objects.all() or some such TODO
@@ -97,7 +1056,8 @@ class User(Model):
     _pk = 'users_incr'
     _id = 'users:id_for:%s' # given name get id
     _name = 'users:name_for:%s' # given id get name
-    _service = 'users:{id}:{service}' # id and service get info
+    _profiles = 'users:profiles:%s' # given name, hash of service -> json
+    _service = 'users:{id}:{service}' # the old per service keys, profiles.py migrates them
     _created_items = 'users:%s:set:created_items' #items set
     _assigned_items = 'users:%s:set:assigned_items'
     _created_groups = 'users:%s:set:created_groups'
@@ -106,29 +1066,40 @@ class User(Model):
 
     _update_str = 'updates:%s'
 
-    def __init__(self, id=None, name=''):
-        '''pass in a name or id and we will try to retrieve (or create with name)
+    __slots__ = ('rname', 'rcreated_items', 'rassigned_items', 'rcreated_groups',
+            'rassigned_groups', 'rupdates')
+
+    def __init__(self, id=None, name='', create=False):
+        '''pass in an id, or a name and we will look the user up (``create=True``
+        makes one when there is none).  An id isn't read until ``name`` is.
 
         Name can not have spaces'''
         if re.search(r'\s', name): # no spaces allowed
             raise Exception('Name can not have spaces')
         if id:
-            name = r.get(self._name % id)
-            if not name:
-                raise Exception('There is no user with that id, use kwargs perhaps')
-        elif name:
+            name = NOT_LOADED
+        elif name and not create:
             id = r.get(self._id % name.lower())
-            if id:
-                db_name = r.get(self._name % id)
-                if db_name:
-                    name=db_name
-        if not id and name:
-            id = r.incr(self._pk)
-            r.set(self._name % id, name)
-            r.set(self._id % name.lower(), id)
+            if not id:
+                raise DoesNotExistException('There is no user named %s' % name)
+            name = NOT_LOADED # as it was signed up, which may differ in case
+        elif name:
+            # finds the user or creates it, one atomic round trip either way
+            candidate = new_ids(self._pk)[0]
+            found = _create_user_script(keys=[self._id % name.lower()],
+                    args=[name, self._name, candidate], client=r)
+            id = found[0]
+            if found[1]:
+                add_username(name)
+            else:
+                id_blocks[self._pk].give_back(candidate)
+                if len(found) > 2 and found[2]:
+                    name = found[2]
         self.id = id
         self.name = name
+        self._keys()
 
+    def _keys(self):
         self.rname = self._name % self.id
         self.rcreated_items = self._created_items % self.id
         self.rassigned_items = self._assigned_items % self.id
@@ -136,31 +1107,79 @@ class User(Model):
         self.rassigned_groups = self._assigned_groups % self.id
         self.rupdates = self._updates % self.id
 
-    # service read
+    @classmethod
+    @gen.coroutine
+    def fetch_by_name(cls, name, client, identity_map=None):
+        '''Non-blocking retrieve by name, never creates'''
+        id = yield client.get(cls._id % name.lower())
+        if not id:
+            raise DoesNotExistException('There is no user named %s' % name)
+        user = yield cls.fetch(id, client, identity_map)
+        raise gen.Return(user)
+
+    @classmethod
+    @gen.coroutine
+    def async_create(cls, client, name):
+        '''Non-blocking create through an async ``client``, the id of the new
+        user or None when there is one with that name in any case already.
+        Call ``add_username`` too, it can go in a pipeline with other writes.'''
+        if re.search(r'\s', name):
+            raise Exception('Name can not have spaces')
+        candidate = (yield fetch_new_ids(cls._pk, client))[0]
+        id, created, _ = yield client.eval(_create_user_lua, 1, cls._id % name.lower(),
+                name, cls._name, candidate)
+        if not int(created):
+            id_blocks[cls._pk].give_back(candidate)
+            raise gen.Return(None)
+        raise gen.Return(id)
+
+    @gen.coroutine
+    def fetch_update_texts(self, client, n=None):
+        '''Non-blocking ``update_texts``'''
+        end = n - 1 if n else -1
+        ids = yield client.lrange(self.rupdates, 0, end)
+        if not ids:
+            raise gen.Return([])
+        texts = yield client.mget([self._update_str % i for i in ids])
+        raise gen.Return(texts)
+
+    # services, one hash per username shared with app.py's logins
+    def profiles(self):
+        '''dict of service -> decoded json for every linked service, one round trip'''
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(self._profiles % self.name)
+        pipe.mget([ self._service.format(id=self.id, service=s) for s in services ])
+        profiles, old = pipe.execute()
+        # keys profiles.py hasn't moved yet
+        for service, json in zip(services, old):
+            if json and service not in profiles:
+                profiles[service] = json
+        return dict( (service, decode(json)) for service, json in profiles.items() )
     def get_service(self, service):
         '''Returns the dict associated with the user for a given service'''
-        rservice = self._service.format(id=self.id, service=service)
-        json = r.get(rservice) # convenient but not atomic
+        pipe = r.pipeline(transaction=False)
+        pipe.hget(self._profiles % self.name, service)
+        pipe.get(self._service.format(id=self.id, service=service))
+        json = first(*pipe.execute())
         if json:
             return decode(json)
         else: return None
-    # service C/U
     def set_service(self, service, json):
-        '''Given json string, we set this information to 'users:<id>:<service>' key'''
-        rservice = self._service.format(id=self.id, service=service)
-        return r.set(rservice, json)
-    # service D
+        '''Given json string, we set it as the ``service`` field of our profiles'''
+        return r.hset(self._profiles % self.name, service, json)
     def del_service(self, service):
-        '''Delete the key and value for this user/service'''
-        rservice = self._service.format(id=self.id, service=service)
-        return r.delete(rservice)
+        '''Delete the json for this user/service'''
+        pipe = r.pipeline(transaction=True)
+        pipe.hdel(self._profiles % self.name, service)
+        pipe.delete(self._service.format(id=self.id, service=service))
+        return sum(pipe.execute())
 
     def create_group(self, json_string):
         '''Get new id, create the group with the value (name or json)'''
-        g = Group(name=json_string)
-        g.set_creator(self.id)
-        r.sadd(self.rcreated_groups, g.id)
-        return g.id
+        return Group._create(json_string, created_set=self.rcreated_groups, creator=self.id)
+    def async_create_group(self, client, json_string):
+        '''Non-blocking ``create_group`` through an async ``client``'''
+        return Group.async_create(client, json_string, created_set=self.rcreated_groups, creator=self.id)
 
     def created_groups(self):
         '''Returns set of created groups'''
@@ -171,30 +1190,161 @@ class User(Model):
     def groups(self):
         '''Returns set of created groups (ids)'''
         return r.sunion(self.rcreated_groups, self.rassigned_groups)
+    def iter_groups(self, count=100):
+        '''Stream ``groups`` with SSCAN'''
+        return iter_union(self.rcreated_groups, self.rassigned_groups, count)
+    def groups_page(self, cursor=None, count=50):
+        return union_page(self.rcreated_groups, self.rassigned_groups, cursor, count)
+    def group_names(self):
+        '''dict of group id -> name for all of our groups'''
+        return Group.names(self.groups())
 
     def add_to_group(self, group_id):
-        r.sadd('groups:%s:members' % group_id, self.id)
-        return r.sadd(self.rassigned_groups, self.id)
+        return link_member(Group._members % group_id, self.id, self.rassigned_groups, group_id)
+    def leave_group(self, group_id):
+        return unlink_member(Group._members % group_id, self.id, self.rassigned_groups, group_id)
 
     def del_group(self, id, cascade=True):
+        '''The group is gone right away, with ``cascade`` its keys and items are
+        deleted in the background
+
+        Its members, and with ``cascade`` its items' creators and members, lose
+        the ids in the same transaction.'''
         if r.sismember(self.rcreated_groups, id):
-            r.delete('groups:%s' % id)
-            r.srem(self.rcreated_groups, id)
-            if cascade: # need to test this and think it through TODO
-                [ r.delete(k) for k in r.keys('groups:%s:*' % id ) ]
-                #[ r.delete(k) for k in r.keys('items:
+            pipe = r.pipeline(transaction=False)
+            pipe.smembers(Group._members % id)
+            pipe.lrange(Group._items % id, 0, -1)
+            members, items = pipe.execute()
+            items = items if cascade else []
+            links = Item.links(items)
+            pipe = r.pipeline()
+            pipe.delete(Group._name % id)
+            pipe.hdel(Group._hash % id, 'name') # a packed group is named in its hash
+            pipe.srem(self.rcreated_groups, id)
+            for member in members:
+                pipe.srem(User._assigned_groups % member, id)
+            for item, (creator, _, item_members) in zip(items, links):
+                # the group list goes with the group
+                Item.unlink(pipe, item, creator, None, item_members)
+            pipe.execute()
+            if cascade:
+                Group._hydrate(id).delete()
+
+    # permissions, answered with SISMEMBER rather than fetching whole sets
+    def visible_groups(self, group_ids):
+        '''The ids in ``group_ids`` we created or belong to, one round trip'''
+        group_ids = list(group_ids)
+        pipe = r.pipeline(transaction=False)
+        for id in group_ids:
+            pipe.sismember(self.rcreated_groups, id)
+            pipe.sismember(self.rassigned_groups, id)
+        found = pipe.execute()
+        return [ id for n, id in enumerate(group_ids) if found[2*n] or found[2*n + 1] ]
+    def can_access_group(self, group_id):
+        return bool(self.visible_groups([group_id]))
+    @gen.coroutine
+    def fetch_visible_groups(self, client, group_ids):
+        '''Non-blocking ``visible_groups``'''
+        group_ids = list(group_ids)
+        pipe = async_pipeline(client, transaction=False)
+        for id in group_ids:
+            pipe.sismember(self.rcreated_groups, id)
+            pipe.sismember(self.rassigned_groups, id)
+        found = (yield pipe.execute()) if group_ids else []
+        raise gen.Return([ id for n, id in enumerate(group_ids) if found[2*n] or found[2*n + 1] ])
+
+    def visible_items(self, item_ids):
+        '''The ids in ``item_ids`` we can see, one round trip however many
+
+        We can see items we created, are assigned to, are a member of, or that
+        belong to one of our groups.'''
+        item_ids = list(item_ids)
+        if not item_ids:
+            return []
+        return _visible_items_script(keys=[self.rcreated_items, self.rassigned_items,
+                self.rcreated_groups, self.rassigned_groups],
+            args=[self.id, Item._members, Item._hash, Item._group] + item_ids, client=r)
+    def can_access_item(self, item_id):
+        return bool(self.visible_items([item_id]))
+
+    def search_items(self, text, cursor=None, count=20):
+        '''(item ids best match first, cursor) for the items we can see with every word of ``text``
+
+        Reads the ranked ids a window at a time and filters each window with
+        ``visible_items``.  The cursor is a position in the ranking, None at the end.'''
+        if count < 1:
+            raise ValueError('count must be at least 1')
+        key, temp = search.query(r, text)
+        if key is None:
+            return [], None
+        start, found = int(cursor or 0), []
+        window = max(count * 2, 50)
+        try:
+            while len(found) < count:
+                ids = search.ranked(r, key, start, window)
+                if not ids:
+                    return found, None
+                start += search.pick(ids, set(self.visible_items(ids)), found, count)
+            return found, str(start)
+        finally:
+            if temp:
+                r.delete(temp)
+
+    @gen.coroutine
+    def fetch_visible_items(self, client, item_ids):
+        '''Non-blocking ``visible_items``, one pipelined round trip'''
+        item_ids = list(item_ids)
+        if not item_ids:
+            raise gen.Return([])
+        pipe = async_pipeline(client, transaction=False)
+        _visible_items_queue(pipe, [self.rcreated_items, self.rassigned_items,
+                self.rcreated_groups, self.rassigned_groups], self.id, item_ids)
+        replies = yield pipe.execute()
+        raise gen.Return(_visible_items_pick(item_ids, replies))
+
+    @gen.coroutine
+    def fetch_search_items(self, client, text, cursor=None, count=20):
+        '''Non-blocking ``search_items``, a round trip to rank each window
+        (the first one intersects the words too) and one to filter it'''
+        if count < 1:
+            raise ValueError('count must be at least 1')
+        keys = search.word_keys(text)
+        if not keys:
+            raise gen.Return(([], None))
+        key, temp = keys[0], None
+        if len(keys) > 1:
+            key = temp = search.temp_key()
+        start, found, more = int(cursor or 0), [], True
+        window = max(count * 2, 50)
+        stored = not temp
+        while more and len(found) < count:
+            pipe = async_pipeline(client, transaction=False)
+            if not stored:
+                pipe.zinterstore(temp, keys)
+                pipe.expire(temp, 60) # in case we die before deleting it
+                stored = True
+            pipe.zrevrange(key, start, start + window - 1)
+            ids = (yield pipe.execute())[-1]
+            more = bool(ids)
+            if ids:
+                visible = yield self.fetch_visible_items(client, ids)
+                start += search.pick(ids, set(visible), found, count)
+        if temp:
+            yield client.delete(temp)
+        raise gen.Return((found, str(start) if more else None))
 
     def set_attribute_to_group(self, id, key, value):
-        if id in self.groups():
-            return r.set('groups:%s:attr:%s' % (id, key), value)
+        if self.can_access_group(id):
+            return Group._hydrate(id).set_attr(key, value)
         else:
             raise Exception('This is not one of your groups if it exists')
 
     def create_item(self, item_name):
         '''Add an item to the created set'''
-        i = Item(name=item_name, creator=self.id)
-        r.sadd(self.rcreated_items, i.id)
-        return i.id
+        return Item._create(item_name, created_set=self.rcreated_items, creator=self.id)
+    def create_items(self, item_names):
+        '''Bulk create_item, returns the new ids'''
+        return Item.create_many(item_names, created_set=self.rcreated_items, creator=self.id)
 
     def created_items(self):
         '''Ids for items created by the user'''
@@ -205,38 +1355,104 @@ class User(Model):
     def items(self):
         '''Union of created and assigned'''
         return r.sunion(self.rcreated_items, self.rassigned_items)
+    def item_names(self):
+        '''dict of item id -> name for created and assigned items'''
+        return Item.names(self.items())
+    def iter_items(self, count=100):
+        '''Stream ``items`` with SSCAN instead of one big SUNION'''
+        return iter_union(self.rcreated_items, self.rassigned_items, count)
+    def items_page(self, cursor=None, count=50):
+        '''(item ids, cursor) for paging through ``items``'''
+        return union_page(self.rcreated_items, self.rassigned_items, cursor, count)
 
     def assign_item(self, item_id):
-        '''Add the item_id to our assigned items set'''
-        return r.sadd(self.rassigned_items, item_id)
+        '''Add the item_id to our assigned items set (and us to its members)'''
+        return link_member(Item._members % item_id, self.id, self.rassigned_items, item_id)
+    def async_assign_item(self, client, item_id):
+        '''Non-blocking ``assign_item``'''
+        return async_link_member(client, Item._members % item_id, self.id, self.rassigned_items, item_id)
     def unclaim_item(self, item_id):
-        return r.srem(self.rassigned_items, item_id)
+        return unlink_member(Item._members % item_id, self.id, self.rassigned_items, item_id)
 
     def destroy_item(self, item_id):
+        '''Delete an item we created, its keys are removed in the background'''
         if r.sismember(self.rcreated_items, item_id):
-            return s.srem(self.rassigned_items, item_id)
+            (creator, group, members), = Item.links([item_id])
+            pipe = r.pipeline()
+            pipe.srem(self.rassigned_items, item_id)
+            Item.unlink(pipe, item_id, self.id, group, members)
+            pipe.execute()
+            Item._hydrate(item_id).delete()
+            return True
 
     def update_ids(self, n=None):
         '''List of updates for the user, limit to 'n' if provided'''
         if not n:
             return r.lrange(self.rupdates, 0, -1)
         else:
-            return r.lrange(self.rupdates, 0, n+1)
-    def add_update(self, message):
-        '''Create the update and add to the users updates'''
-        update_id = r.incr('updates_incr')
-        r.set('updates:%s' % update_id, message)
-        return r.push(self.rupdates, update_id, head=True)
+            return r.lrange(self.rupdates, 0, n - 1)
+    def _update_ops(self, message):
+        return [ ('SET', self._update_str, message), ('LPUSH', self.rupdates, NEW_ID) ]
+    def add_update(self, message, group_id=None, item_id=None):
+        '''Create the update, add it to the users updates and fan it out
+
+        With a ``group_id`` it goes to the group's timeline, its creator's and
+        every member's, with an ``item_id`` to every member of the item.
+        Returns the update id.'''
+        update_id = create_object('updates_incr', self._update_ops(message))
+        keys = [ Timeline._user % self.id ]
+        if group_id:
+            keys.append(Timeline._group % group_id)
+            # the creator isn't always in the members set
+            creator = Group._hydrate(group_id).get_creator()
+            if creator:
+                keys.append(Timeline._user % creator)
+            keys = itertools.chain(keys, (Timeline._user % m for m in
+                    r.sscan_iter(Group._members % group_id, count=500)))
+        if item_id:
+            keys = itertools.chain(keys, (Timeline._user % m for m in
+                    r.sscan_iter(Item._members % item_id, count=500)))
+        fan_out(update_id, keys, text=message)
+        return update_id
+    @gen.coroutine
+    def async_add_update(self, client, message, group_id=None, item_id=None):
+        '''Non-blocking ``add_update`` through an async ``client``'''
+        update_id = yield async_create_object(client, 'updates_incr', self._update_ops(message))
+        keys = [ Timeline._user % self.id ]
+        if group_id:
+            keys.append(Timeline._group % group_id)
+            pipe = async_pipeline(client, transaction=False)
+            pipe.hget(Group._hash % group_id, 'creator')
+            pipe.get(Group._creator % group_id)
+            pipe.smembers(Group._members % group_id)
+            packed, creator, members = yield pipe.execute()
+            if first(packed, creator):
+                keys.append(Timeline._user % first(packed, creator))
+            keys.extend( Timeline._user % m for m in members )
+        if item_id:
+            members = yield client.smembers(Item._members % item_id)
+            keys.extend( Timeline._user % m for m in members )
+        yield async_fan_out(client, update_id, keys, text=message)
+        raise gen.Return(update_id)
     def del_update(self, id):
-        '''Delete the update from the user and the global updates'''
-        if id in self.rupdates():
-            r.lrem(self.rupdates, id)
-            return r.delete('updates:%s' % id)
+        '''Delete the update from the user and the global updates
+
+        Copies on other timelines are skipped when read, see ``Timeline.page``'''
+        if r.lrem(self.rupdates, 0, id):
+            pipe = r.pipeline()
+            pipe.zrem(Timeline._user % self.id, id)
+            pipe.delete(self._update_str % id)
+            return pipe.execute()[-1]
         else:
             raise Exception('This is not the User\'s update if it exists')
     def update_texts(self, n=None):
+        '''Texts of the updates, in order, fetched with one MGET'''
         ids = self.update_ids(n=n)
-        return [ r.get('updates:%s' % i) for i in ids ]
+        return mget([self._update_str % i for i in ids])
+
+    def timeline(self):
+        '''Our updates plus those of our groups and items'''
+        return Timeline(Timeline._user % self.id)
 
 
 class Item(Model):
@@ -246,37 +1462,52 @@ class Item(Model):
     _creator = 'items:%s:fk:creator' # get user_id of the creator (str)
     _group = 'items:%s:fk:group' # id of the group (str)
     _members = 'items:%s:mm:members' # set of member ids
-    _comments = 'items:%s:list:comments' # comment_ids --REVERSE fk?
+    _comments = 'items:%s:sset:comments' # comment ids scored by time
+    _comment_bodies = 'items:%s:hash:comments' # comment id -> body
+    _comment_list = 'items:%s:list:comments' # the old comment list, comments.py migrates it
+    _comment_pk = 'comments_incr'
     _components = 'items:%s:sset:components' # score is priority perhaps, just score/string
     # generic keyspaces
     _attrs = 'items:%s:str:attrs:' # base key for any number of string attributes
     _lattrs = 'items:%s:set:attrs:' # base key for any number of list attributes
     _sattrs = 'items:%s:list:attrs:' # base key for any number of set attributes
     _ssattrs = 'items:%s:sset:attrs:' # base key for any number of sorted set attributes
+    _registry = 'items:%s:keys' # set of the generic keys above that have been used
+    _generic = (_attrs, _lattrs, _sattrs, _ssattrs)
+    _hash = 'items:%s:hash' # name, creator, group and 'attr:<key>' when packed
+    _fixed = (_name, _creator, _group, _members, _comments, _comment_bodies, _comment_list,
+            _components, _hash)
+    _scalars = (('name', _name), ('creator', _creator), ('group', _group))
+
+    __slots__ = ('rcreator', 'rgroup', 'rmembers', 'rcomments', 'rcomment_bodies', 'rcomponents',
+            'attrs', 'lattrs', 'sattrs', 'ssattrs', 'rkeys', 'rhash')
 
     def __init__(self, id=None, name=None, creator=None, group=None): #, owner_id=None, group=None, members=None):
-        '''if instantiated with an id, then we retrieve, else we create
+        '''if instantiated with an id, the name is read when first asked for,
+        else we create
 
         name will not be in a key so it can have spaces even in redis 1.1'''
         if id:
             # if id and name are given, well, id wins
-            name = r.get(self._name % id)
-            if not name:
-                raise Exception('Item does not exist')
+            name = NOT_LOADED
         if not id and name:
             # name is not unique so we won't fetch by that
-            id = r.incr(self._pk)
-            r.set(self._name % id, name)
+            id = self._create(name, creator=creator, group=group)
+            creator = group = None # already written
         self.id = id
         self.name = name
-        self.rcreator = self._creator % self.id
+        self._keys()
         if creator:
-            r.set(self.rcreator, creator)
-        self.rgroup = self._group % self.id
+            self._write('creator', self.rcreator, creator)
         if group:
-            r.set(self.rgroup, group)
+            self.set_group(group)
+
+    def _keys(self):
+        self.rcreator = self._creator % self.id
+        self.rgroup = self._group % self.id
         self.rmembers = self._members % self.id
         self.rcomments = self._comments % self.id
+        self.rcomment_bodies = self._comment_bodies % self.id
         self.rcomponents = self._components % self.id
         # generic
         # certainly we can move these out into parent of metaclass?
@@ -284,72 +1515,220 @@ class Item(Model):
         self.lattrs = self._lattrs % self.id
         self.sattrs = self._sattrs % self.id
         self.ssattrs = self._ssattrs % self.id
+        self.rkeys = self._registry % self.id
+        self.rhash = self._hash % self.id
 
     def get_creator(self):
-        return r.get(self.rcreator)
+        return self._read('creator', self.rcreator)
     def set_creator(self, user_id):
         if not r.sismember('user_ids', user_id):
             raise Exception('User does not exist')
-        return r.set(self.rcreator, user_id)
+        return self._write('creator', self.rcreator, user_id)
 
     def get_group(self):
         '''Returns the id of the group that owns the Item'''
-        return r.get(self.rgroup)
-    def set_group(self, group_id):
-        '''Assigns this item to the group'''
-        return r.set(self.rgroup, group_id)
-        # We should add the group items set/list?
+        return self._read('group', self.rgroup)
+    def set_group(self, group_id, head=True, expected=None):
+        '''Assigns this item to the group, None takes it out of its group
+
+        The group fk and both groups' item lists change in one atomic step.
+        With ``expected`` nothing changes unless we are in that group now, apart
+        from dropping us from its list.  Returns the previous group id.
+
+        Two round trips, the script has to be told every key it touches.'''
+        def items(group):
+            return Group._items % group if group else self.rgroup
+        event = encode({'type': 'item', 'group': group_id, 'id': self.id})
+        while True:
+            pipe = r.pipeline(transaction=False)
+            pipe.hget(self.rhash, 'group')
+            pipe.get(self.rgroup)
+            old = first(*pipe.execute())
+            found = _set_group_script(keys=[self.rgroup, self.rhash, items(old), items(group_id), items(expected)],
+                args=[self.id, group_id or '', '1' if self.packed else '', '1' if head else '',
+                    event_channel(Timeline._group % group_id) if group_id else '', event,
+                    expected or '', old or ''], client=r)
+            if (found or '') == (old or ''):
+                return found
+
+    @classmethod
+    def _reverse_ops(cls, fields):
+        if fields.get('group'):
+            return [ ('LPUSH', Group._items % fields['group'], NEW_ID) ]
+        return []
+
+    @classmethod
+    def _name_ops(cls, name):
+        changes = search.postings(name, search.name_weight)
+        return [ ('ZINCRBY', key, amount, NEW_ID) for key, amount in sorted(changes.items()) ]
+
+    def rename(self, name):
+        '''Change the name, the search index follows'''
+        old = self.name
+        self._write('name', self._name % self.id, name)
+        self.name = name
+        self._index(search.postings(old, search.name_weight, -1), search.postings(name, search.name_weight))
+
+    def _index(self, *changes):
+        '''Apply search index ``changes`` (see ``search.postings``) in one round trip'''
+        changes = search.merge(*changes)
+        if changes:
+            search.apply(r.pipeline(transaction=False), self.id, changes).execute()
+
+    def index_changes(self, times=1):
+        '''``search.postings`` for our name, components and comments, two round trips'''
+        name = self.names([self.id])[self.id]
+        pipe = r.pipeline(transaction=False)
+        pipe.zrange(self.rcomponents, 0, -1)
+        pipe.hvals(self.rcomment_bodies)
+        pipe.lrange(self._comment_list % self.id, 0, -1)
+        components, comments, old = pipe.execute()
+        return search.item_postings(name, components, comments + old_comment_bodies(old), times)
+
+    def unindex(self):
+        '''Take everything of ours out of the search index'''
+        self._index(self.index_changes(-1))
+
+    def delete(self, background=True):
+        self.unindex()
+        return super(Item, self).delete(background)
+
+    @classmethod
+    def links(cls, ids):
+        '''(creator, group, member ids) of each item, one round trip'''
+        pipe = r.pipeline(transaction=False)
+        for id in ids:
+            pipe.hmget(cls._hash % id, 'creator', 'group')
+            pipe.get(cls._creator % id)
+            pipe.get(cls._group % id)
+            pipe.smembers(cls._members % id)
+        values = pipe.execute()
+        return [ (first(values[4*n][0], values[4*n + 1]), first(values[4*n][1], values[4*n + 2]),
+            values[4*n + 3]) for n in range(len(ids)) ]
+
+    @classmethod
+    def unlink(cls, pipe, id, creator, group, members):
+        '''Queue taking item ``id`` out of everything that points at it, see ``links``'''
+        if creator:
+            pipe.srem(User._created_items % creator, id)
+        if group:
+            pipe.lrem(Group._items % group, 0, id)
+        for member in members:
+            pipe.srem(User._assigned_items % member, id)
+        return pipe
 
     def get_members(self):
         return r.smembers(self.rmembers)
     def add_member(self, user_id):
-        return r.sadd(self.rmembers, user_id)
+        return link_member(self.rmembers, user_id, User._assigned_items % user_id, self.id)
     def rm_member(self, user_id):
-        return r.srem(self.rmembers, user_id)
+        return unlink_member(self.rmembers, user_id, User._assigned_items % user_id, self.id)
     def user_is_member(self, user_id):
-        return user_id in self.members()
+        return r.sismember(self.rmembers, user_id)
 
     def add_comment(self, comment_id, head=False):
-        return r.push(self.rcomments, comment_id, head=head)
+        '''The old way in: the update ``comment_id`` becomes a comment, now
+        as well.  Returns the new comment's id, None if there is no such update.
+
+        ``head`` is ignored, comments are in time order.'''
+        bodies = old_comment_bodies([comment_id])
+        if bodies:
+            return self.post_comment(bodies[0])
+    def post_comment(self, body, when=None):
+        '''New comment at ``when`` (now by default), returns its id
+
+        Its words go in the search index.'''
+        id = new_ids(self._comment_pk)[0]
+        pipe = r.pipeline(transaction=True)
+        pipe.zadd(self.rcomments, {id: when or time.time()})
+        pipe.hset(self.rcomment_bodies, id, body)
+        search.apply(pipe, self.id, search.postings(body, search.comment_weight))
+        pipe.execute()
+        return id
     def get_comments(self, num=-1):
-        return r.lrange(self.rcomments, 0, num)
-    def rm_comment(self, comment_id, num=0):
-        '''Delete all comments of the given id'''
-        return r.lrem(self.rcomments, comment_id, num=num)
+        '''Comment ids, oldest first'''
+        return r.zrange(self.rcomments, 0, num)
+    def comments_since(self, when, count=None, last_id=None):
+        '''(comment id, time) pairs newer than ``when``, oldest first.  Pass the
+        ``last_id`` seen at ``when`` to get the others at that same time too.'''
+        return zset_after(self.rcomments, when, last_id, count)
+    def comment_bodies(self, comment_ids):
+        '''dict of comment id -> body, one HMGET however many'''
+        comment_ids = list(comment_ids)
+        if not comment_ids:
+            return {}
+        return dict(zip(comment_ids, r.hmget(self.rcomment_bodies, comment_ids)))
+    def iter_comments(self, count=100):
+        '''(comment id, time) pairs with ZSCAN, in no particular order'''
+        return r.zscan_iter(self.rcomments, count=count)
+    def comments_page(self, cursor=None, count=50):
+        '''((comment id, time) pairs, cursor) oldest first, the cursor is the
+        last time and id seen so comments at the same time aren't skipped'''
+        if cursor:
+            when, last_id = parse_score_cursor(cursor)
+            pairs = self.comments_since(when, count, last_id)
+        else:
+            pairs = r.zrange(self.rcomments, 0, count - 1, withscores=True)
+        return pairs, score_cursor(pairs) if len(pairs) == count else None
+    def num_comments(self):
+        return r.zcard(self.rcomments)
+    def rm_comment(self, comment_id):
+        '''Delete the comment, O(log n) in the number of comments'''
+        body = r.hget(self.rcomment_bodies, comment_id)
+        pipe = r.pipeline(transaction=True)
+        pipe.zrem(self.rcomments, comment_id)
+        pipe.hdel(self.rcomment_bodies, comment_id)
+        removed = pipe.execute()[0]
+        if removed:
+            self._index(search.postings(body, search.comment_weight, -1))
+        return removed
 
     def add_component(self, json):
         '''json can just be text for name'''
-        return r.zadd(self.rcomponents, json, 1)
+        added = r.zadd(self.rcomponents, {json: 1})
+        if added:
+            self._index(search.postings(search.component_text(json), search.component_weight))
+        return added
     def rm_component(self, json):
-        return r.zrem(self.rcomponents, json)
+        removed = r.zrem(self.rcomponents, json)
+        if removed:
+            self._index(search.postings(search.component_text(json), search.component_weight, -1))
+        return removed
     def components(self, start=0, end=-1, desc=True):
-        return r.zrange(self, start, end, desc)
+        return r.zrange(self.rcomponents, start, end, desc=desc)
     def components_by_score(self, min, max):
         return r.zrangebyscore(self.rcomponents, min, max)
     def component_score_tuples(self, start=0, end=-1, desc=True):
-        s = self.rcomponents
-        zip(
-            [r.zscore(s, m) for m in r.zrange(s, 0, -1, desc=desc)],
-            r.zrange(s, 0, -1, desc=desc)
-        )
+        '''List of (score, component) in one ZRANGE ... WITHSCORES'''
+        pairs = r.zrange(self.rcomponents, start, end, desc=desc, withscores=True)
+        return [ (score, member) for member, score in pairs ]
+    def iter_components(self, count=100):
+        '''(component, score) pairs with ZSCAN, in no particular order'''
+        return r.zscan_iter(self.rcomponents, count=count)
+    def components_page(self, cursor=None, count=50):
+        return zset_page(self.rcomponents, cursor, count)
     def num_components(self):
         return r.zcard(self.rcomponents)
 
     def set_string_attr(self, key, value):
-        return r.set(self.attrs + key, value)
+        return self._write('attr:' + key, self.attrs + key, value, register=True)
     def getset_string_attr(self, key, value):
-        return r.getset(self.attrs + key, value)
+        return self._write('attr:' + key, self.attrs + key, value, 'getset', register=True)
     def get_string_attr(self, key):
-        return r.get(self.attrs + key)
+        return self._read('attr:' + key, self.attrs + key)
 
     # maybe we will do all of the methods for the types but,
     # for now, let's just return the redis keys for manual manipulation.
+    # They go in the registry since the caller is about to write them.
     def list_key(self, key):
-        return self.lattrs + key
+        return self._owned_key(self.lattrs + key)
     def set_key(self, key):
-        return self.sattrs + key
+        return self._owned_key(self.sattrs + key)
     def sset_key(self, key):
-        return self.ssattrs + key
+        return self._owned_key(self.ssattrs + key)
+    def _owned_key(self, key):
+        r.sadd(self.rkeys, key)
+        return key
 
 class Group(Model):
     _pk = 'groups_incr'
@@ -358,73 +1737,236 @@ class Group(Model):
     _members = 'groups:%s:members'
     _items = 'groups:%s:list:items'
     _attrs = 'groups:%s:attrs:' # maybe we don't need a separate keyspace for each type
+    _registry = 'groups:%s:keys' # set of the attr keys that have been used
+    _generic = (_attrs,)
+    _hash = 'groups:%s:hash' # name, creator and 'attr:<key>' when packed
+    _fixed = (_name, _creator, _members, _items, _hash)
+    _scalars = (('name', _name), ('creator', _creator))
+
+    __slots__ = ('rname', 'rcreator', 'rmembers', 'ritems', 'rattrs', 'rkeys', 'rhash')
 
     def __init__(self, id=None, name=None):
-        '''pass an id and we will try to fetch the group. Pass a name and we will create.
+        '''pass an id and the group is fetched when its name is first asked for.
+        Pass a name and we will create.
 
         name (json string if you prefer) does not need to be unique and we will not retrieve based
         on this string.'''
         if not (id or name):
             raise Exception('pass an id or a name(json if you want)')
         if id:
-            name = r.get(self._name % id)
-            if not name:
-                raise Exception('group does not exist')
+            name = NOT_LOADED
         if not id and name:
-            id = r.incr(self._pk)
-            r.set(self._name % id, name)
+            id = self._create(name)
         self.id = id
         self.name = name
-        self.rname = self._name % id
-        self.rcreator = self._creator % id
-        self.rmembers = self._members % id
-        self.ritems = self._items % id
-        self.rattrs = self._attrs % id
+        self._keys()
+
+    def _keys(self):
+        self.rname = self._name % self.id
+        self.rcreator = self._creator % self.id
+        self.rmembers = self._members % self.id
+        self.ritems = self._items % self.id
+        self.rattrs = self._attrs % self.id
+        self.rkeys = self._registry % self.id
+        self.rhash = self._hash % self.id
+
+    def key_batches(self, batch=100):
+        '''Our items go first, they are found through our item list'''
+        for id in iter_list(self.ritems, batch):
+            item = Item._hydrate(id)
+            item.unindex()
+            for keys in item.key_batches(batch):
+                yield keys
+        for keys in super(Group, self).key_batches(batch):
+            yield keys
 
     #info CRUD
     def get_name(self):
         '''Returns the dictionary of keys/values for this Group'''
-        return decode(r.get(self.rinfo))
+        return decode(self._read('name', self.rname))
     def set_name(self, **kwargs):
         '''Takes a kwargs and updates the group information with them'''
-        return r.set(self.rname, encode(kwargs))
+        self.name = encode(kwargs)
+        return self._write('name', self.rname, self.name)
 
     def get_items(self):
         '''Returns the list of items for this Group'''
         return r.lrange(self.ritems, 0, -1)
+    def iter_items(self, window=100):
+        '''Stream the item ids, ``window`` at a time'''
+        return iter_list(self.ritems, window)
+    def items_page(self, cursor=None, count=50):
+        '''(item ids, cursor), stable while new items are added at the top'''
+        return list_page(self.ritems, cursor, count, head=True)
+    def item_names(self):
+        '''dict of item id -> name for the items in this Group'''
+        return Item.names(self.get_items())
     def add_item(self, item_id, head=True):
-        '''Add and item to the top of the list '''
-        return r.push(self.ritems, item_id, head=head)
+        '''Add and item to the top of the list, moving it from any other group'''
+        return Item(item_id).set_group(self.id, head=head)
     def rm_item(self, item_id):
         '''Remove the item by item_id'''
-        r.lrem(self.ritems, item_id)
+        return Item(item_id).set_group(None, expected=self.id)
     def get_item(self, index):
         '''Return the item by the index of group-list:items list'''
         return r.lindex(self.ritems, index)
 
+    def timeline(self):
+        '''Updates posted to this group'''
+        return Timeline(Timeline._group % self.id)
+
     def members(self):
         '''Returns the set of members for this Group'''
         return r.smembers(self.rmembers)
     def add_member(self, user_id):
         '''Adds a member to the set'''
-        return r.sadd(self.rmembers, user_id)
+        return link_member(self.rmembers, user_id, User._assigned_groups % user_id, self.id)
     def rm_member(self, user_id):
-        return r.srem(self.rmembers, user_id)
+        return unlink_member(self.rmembers, user_id, User._assigned_groups % user_id, self.id)
 
     def get_creator(self):
         '''Returns the username of the leader'''
-        return r.get(self.rcreator)
+        return self._read('creator', self.rcreator)
     def set_creator(self, user_id):
-        return r.set(self.rcreator, user_id)
+        return self._write('creator', self.rcreator, user_id)
 
     def get_attr(self, key):
-        return r.get(self.rattrs + key)
+        return self._read('attr:' + key, self.rattrs + key)
 
     def set_attr(self, key, value):
         '''Concatentate to the base keyspace (for this object's attributes) the passed key
 
         and set the value of the computed key to ``value``'''
-        return r.set(self.rattrs + key, value)
+        return self._write('attr:' + key, self.rattrs + key, value, register=True)
+
+# How many updates a timeline keeps, older ones are trimmed on write
+timeline_length = 1000
+
+def event_channel(key):
+    '''pub/sub channel for a timeline key, realtime.py listens on 'events:*' '''
+    return 'events:' + key
+
+# new usernames for the other processes' ``usernames``
+username_channel = event_channel('usernames')
+
+@metrics.traced
+def fan_out(update_id, keys, when=None, text=None, batch=500):
+    '''Add the update to each timeline in ``keys`` and trim them to ``timeline_length``
+
+    Pipelined ``batch`` timelines at a time so a big group costs
+    members / batch round trips.  A timeline listed twice is harmless.
+    Every timeline's channel is told about the update too.'''
+    when = when or time.time()
+    event = encode({'type': 'update', 'id': update_id, 'time': when, 'text': text})
+    for chunk in chunked(keys, batch):
+        pipe = r.pipeline(transaction=False)
+        for key in chunk:
+            pipe.zadd(key, {update_id: when})
+            pipe.zremrangebyrank(key, 0, -timeline_length - 1)
+            pipe.publish(event_channel(key), event)
+        pipe.execute()
+
+@gen.coroutine
+def async_fan_out(client, update_id, keys, when=None, text=None, batch=500):
+    '''Non-blocking ``fan_out``'''
+    when = when or time.time()
+    event = encode({'type': 'update', 'id': update_id, 'time': when, 'text': text})
+    for chunk in chunked(keys, batch):
+        pipe = async_pipeline(client, transaction=False)
+        for key in chunk:
+            pipe.zadd(key, {update_id: when})
+            pipe.zremrangebyrank(key, 0, -timeline_length - 1)
+            pipe.publish(event_channel(key), event)
+        yield pipe.execute()
+
+# KEYS[1] is the timeline, ARGV is the score and id of the last update seen
+# ('+inf' and '' for the first page), count and the update key template.
+# Updates at that score come newest first by id, like ZREVRANGE has them.
+# Returns id, score, text triples newest first.
+_timeline_page_lua = '''
+local count = tonumber(ARGV[3])
+local ids = {}
+local found = 0
+local top = ARGV[1]
+if ARGV[2] ~= '' then
+    local ties = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1], 'WITHSCORES')
+    for i = 1, #ties, 2 do
+        if ties[i] < ARGV[2] and found < count then
+            ids[#ids + 1] = ties[i]
+            ids[#ids + 1] = ties[i + 1]
+            found = found + 1
+        end
+    end
+    top = '(' .. ARGV[1]
+end
+if found < count then
+    local older = redis.call('ZREVRANGEBYSCORE', KEYS[1], top, '-inf', 'WITHSCORES', 'LIMIT', 0, count - found)
+    for i = 1, #older do
+        ids[#ids + 1] = older[i]
+    end
+end
+local result = {}
+for i = 1, #ids, 2 do
+    result[#result + 1] = ids[i]
+    result[#result + 1] = ids[i + 1]
+    result[#result + 1] = redis.call('GET', string.format(ARGV[4], ids[i])) or ''
+end
+return result
+'''
+
+def _timeline_page_python(client, keys, args):
+    top, last, count, template = args
+    count = int(count)
+    entries = []
+    if last:
+        ties = client.zrevrangebyscore(keys[0], top, top, withscores=True)
+        entries = [ e for e in ties if str(e[0]) < last ][:count]
+        top = '(' + top
+    if len(entries) < count:
+        entries += client.zrevrangebyscore(keys[0], top, '-inf', start=0, num=count - len(entries), withscores=True)
+    texts = client.mget([ template % id for id, _ in entries ]) if entries else []
+    flat = []
+    for (id, score), text in zip(entries, texts):
+        flat.extend([id, score, text or ''])
+    return flat
+
+_timeline_page_script = Script(_timeline_page_lua, _timeline_page_python)
+
+@metrics.traced
+class Timeline(object):
+    '''A capped sorted set of update ids scored by the time they were posted'''
+    _user = 'timelines:users:%s'
+    _group = 'timelines:groups:%s'
+
+    def __init__(self, key):
+        self.key = key
+
+    def page(self, cursor=None, count=20):
+        '''([(update id, time, text)], cursor) newest first, one round trip
+
+        Deleted updates are left out, so a page can come back a little short.
+        The cursor is the time and id of the last update, so updates posted
+        at the same time aren't skipped.'''
+        top, last = '+inf', None
+        if cursor:
+            top, last = parse_score_cursor(cursor)
+            # a cursor from before ids were in it: everything older than that
+            top = repr(top) if last else '(%r' % top
+        flat = _timeline_page_script(keys=[self.key], args=[top, last or '', count, User._update_str], client=r)
+        entries = [ (flat[i], float(flat[i + 1]), flat[i + 2]) for i in range(0, len(flat), 3) ]
+        cursor = score_cursor([ e[:2] for e in entries ]) if len(entries) == count else None
+        return [ e for e in entries if e[2] ], cursor
+
+    def __len__(self):
+        return r.zcard(self.key)
+
+def set_packed(packed=True):
+    '''Store Items and Groups as one hash per object
+
+    Reads fall back to the old keys, so this can be switched on before
+    pack.py has migrated everything.  app.py and server.py's workers call it
+    with ``--packed``.'''
+    Item.packed = Group.packed = packed
 
 class Update(Model):
     pass
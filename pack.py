@@ -0,0 +1,143 @@
+'''Migrate Items and Groups to packed storage, one hash per object
+
+    python pack.py [--batch=500] [--pause=0.01] [--sample=200] [--scan_attrs]
+
+Switch the app over first by restarting it with ``--packed``.  Reads fall back to
+the old keys until an object is converted, so the site keeps working while
+this runs.  It is safe to stop and run again, converted objects are skipped.
+
+String attrs are found through each object's registry.  Attrs written before
+the registry existed need ``--scan_attrs``, one extra SCAN pass over the
+keyspace.
+
+At the end it prints how much memory the first ``--sample`` objects used
+before and after packing, along with redis' used_memory.
+'''
+import re
+import time
+from tornado.options import define, options, parse_command_line
+
+import memory
+import models
+from models import Item, Group
+
+define('batch', default=500, type=int, help='objects converted per round trip')
+define('pause', default=0.01, type=float, help='seconds to sleep between batches')
+define('sample', default=200, type=int, help='objects to compare MEMORY USAGE for')
+define('scan_attrs', default=False, type=bool, help='also SCAN for attrs missing from registries')
+
+# KEYS[1] is the hash and KEYS[2] the registry, the rest are old string keys
+# with their hash field in the matching ARGV.  Anything already in the hash
+# was written by the packed models and wins.
+_pack_lua = '''
+local moved = 0
+for i = 3, #KEYS do
+    local v = redis.call('GET', KEYS[i])
+    if v then
+        redis.call('HSETNX', KEYS[1], ARGV[i - 2], v)
+        redis.call('DEL', KEYS[i])
+        redis.call('SREM', KEYS[2], KEYS[i])
+        moved = moved + 1
+    end
+end
+return moved
+'''
+
+def _pack_python(client, keys, args):
+    moved = 0
+    for key, field in zip(keys[2:], args):
+        v = client.get(key)
+        if v is not None:
+            client.hsetnx(keys[0], field, v)
+            client.delete(key)
+            client.srem(keys[1], key)
+            moved += 1
+    return moved
+
+# registered on ``models.r`` when first called, so --memory_store works too
+pack_script = models.Script(_pack_lua, _pack_python, local=True)
+
+def pattern(template):
+    '''Regex for a key template, the id is group 1'''
+    return re.compile('^' + template.replace('%s', r'(\d+)'))
+
+def memory_usage(keys):
+    pipe = models.r.pipeline(transaction=False)
+    for k in keys:
+        pipe.execute_command('MEMORY', 'USAGE', k)
+    return sum(v or 0 for v in pipe.execute())
+
+def unpacked_ids(cls):
+    '''ids that still have an old style name key'''
+    return models.scan_ids(cls._name, options.batch)
+
+def string_keys(cls, ids):
+    '''For each id, the (field, old key) pairs to move into its hash'''
+    pipe = models.r.pipeline(transaction=False)
+    for id in ids:
+        pipe.smembers(cls._registry % id)
+    pairs = []
+    for id, registry in zip(ids, pipe.execute()):
+        base = cls._attrs % id
+        p = [ (field, t % id) for field, t in cls._scalars ]
+        p.extend(('attr:' + k[len(base):], k) for k in registry if k.startswith(base))
+        pairs.append(p)
+    return pairs
+
+def pack_batch(cls, ids, pairs):
+    pipe = models.r.pipeline(transaction=False)
+    for id, p in zip(ids, pairs):
+        pack_script(keys=[cls._hash % id, cls._registry % id] + [ k for f, k in p ],
+                args=[ f for f, k in p ], client=pipe)
+    return sum(pipe.execute())
+
+def pack(cls):
+    '''Convert every unpacked ``cls``, returns (objects, keys moved, bytes before, bytes after)'''
+    objects = moved = before = after = sampled = 0
+    for ids in models.chunked(unpacked_ids(cls), options.batch):
+        pairs = string_keys(cls, ids)
+        measure = max(0, min(len(ids), options.sample - sampled))
+        if measure:
+            before += memory_usage([ k for p in pairs[:measure] for f, k in p ])
+        moved += pack_batch(cls, ids, pairs)
+        if measure:
+            after += memory_usage([ cls._hash % id for id in ids[:measure] ])
+            sampled += measure
+        objects += len(ids)
+        time.sleep(options.pause)
+    return objects, moved, before, after
+
+def pack_loose_attrs(cls):
+    '''Attrs that never made it into a registry, found with one SCAN pass'''
+    attr = pattern(cls._attrs + '(.*)$')
+    moved = 0
+    keys = models.r.scan_iter(match=cls._attrs % '*' + '*', count=options.batch)
+    for batch in models.chunked(keys, options.batch):
+        found = [ (attr.match(k), k) for k in batch ]
+        found = [ (m.group(1), m.group(2), k) for m, k in found if m ]
+        moved += pack_batch(cls, [ id for id, a, k in found ],
+                [ [('attr:' + a, k)] for id, a, k in found ])
+        time.sleep(options.pause)
+    return moved
+
+def used_memory():
+    return models.r.info().get('used_memory', 0)
+
+def main():
+    parse_command_line()
+    memory.install()
+    models.set_packed()
+    for cls in (Item, Group):
+        start, used = time.time(), used_memory()
+        objects, moved, before, after = pack(cls)
+        if options.scan_attrs:
+            moved += pack_loose_attrs(cls)
+        print('%s: packed %d objects (%d keys) in %.1fs' % (
+            cls.__name__, objects, moved, time.time() - start))
+        if before:
+            print('  sample: %d bytes as keys, %d bytes packed (%.0f%%)' % (
+                before, after, 100.0 * after / before))
+        print('  used_memory: %d -> %d bytes' % (used, used_memory()))
+
+if __name__ == '__main__':
+    main()
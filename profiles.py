@@ -0,0 +1,70 @@
+'''Migrate service json into one 'users:profiles:<name>' hash per user
+
+    python profiles.py [--batch=500] [--pause=0.01]
+
+Logins used to write '<name>:<service>' and ``User.set_service`` wrote
+'users:<id>:<service>'.  Both move into the user's profiles hash, the
+service is the field, and the old keys are deleted.  Nothing already in the
+hash is overwritten: the app writes there at every login now, so it is
+newer than any old key.  Where a user had both old keys the login one wins,
+it is moved first.
+
+The login lookups ('<service>:<unique id>' -> name) stay where they are.
+Deploy the new code first, it reads the old keys until they are gone.  Safe
+to stop and run again.
+'''
+import re
+import time
+from tornado.options import define, options, parse_command_line
+
+import memory
+import models
+from models import User
+
+define('batch', default=500, type=int, help='keys moved per round trip')
+define('pause', default=0.01, type=float, help='seconds to sleep between batches')
+
+services = '|'.join(models.services)
+# '<name>:<service>' from app.py, names have no ':'
+login_key = re.compile(r'^([^:]+):(%s)$' % services)
+# 'users:<id>:<service>' from User.set_service
+user_key = re.compile(r'^users:(\d+):(%s)$' % services)
+
+def found(pattern):
+    '''(key, first group, service) for every key ``pattern`` matches'''
+    for service in models.services:
+        for key in models.r.scan_iter(match='*:%s' % service, count=options.batch):
+            m = pattern.match(key)
+            if m:
+                yield key, m.group(1), m.group(2)
+
+def move(batch, by_id=False):
+    '''Move (key, name or user id, service) into the profiles, returns how many moved'''
+    if by_id:
+        names = User.names([ id for key, id, service in batch ])
+        batch = [ (key, names[id], service) for key, id, service in batch if names[id] ]
+    values = models.mget([ key for key, name, service in batch ])
+    pipe = models.r.pipeline(transaction=True)
+    moved = 0
+    for (key, name, service), json in zip(batch, values):
+        if json is None:
+            continue
+        pipe.hsetnx(User._profiles % name, service, json)
+        pipe.delete(key)
+        moved += 1
+    pipe.execute()
+    return moved
+
+def main():
+    parse_command_line()
+    memory.install()
+    start = time.time()
+    moved = 0
+    for pattern, by_id in ((login_key, False), (user_key, True)):
+        for batch in models.chunked(found(pattern), options.batch):
+            moved += move(batch, by_id)
+            time.sleep(options.pause)
+    print('moved %d profiles in %.1fs' % (moved, time.time() - start))
+
+if __name__ == '__main__':
+    main()
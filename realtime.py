@@ -0,0 +1,287 @@
+'''Push new updates and items to connected browsers
+
+The model write paths publish to 'events:<timeline key>' (see
+``models.fan_out`` and ``Group.add_item``).  Each process PSUBSCRIBEs to
+'events:*' once on every redis server (see shard.py) and hands messages to
+its connections through ``hub``.  New usernames come the same way, on
+``models.username_channel``.
+
+Connections don't get written to per message.  Messages wait in a bounded
+queue and go out as one JSON list every ``--push_interval`` ms.  A
+connection that can't keep up loses its oldest messages and gets an
+'overflow' event telling it to reload.
+'''
+import time
+import logging
+from collections import defaultdict, deque
+
+import tornado.web
+import tornado.websocket
+from redis import asyncio as aioredis
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.escape import json_encode as encode
+from tornado.escape import to_unicode
+from tornado.options import define, options
+
+import models
+import sessions
+import shard
+from models import Timeline, User
+
+define('push_interval', default=50, type=int, help='ms between pushes to each client')
+define('push_queue', default=200, type=int, help='messages held per client before dropping')
+define('poll_timeout', default=30, type=int, help='seconds a long poll waits for news')
+
+OVERFLOW = encode({'type': 'overflow'})
+
+class Listener(object):
+    '''One client's queue, ``send`` gets a list of json strings
+
+    An update to a group is published on the group's channel and on each
+    member's, a client on both gets the same message twice.  The last
+    ``--push_queue`` messages are remembered and repeats dropped.'''
+
+    def __init__(self, send, ready=lambda: True):
+        self.send = send
+        self.ready = ready
+        self.queue = deque(maxlen=options.push_queue)
+        self.overflowed = False
+        self.recent = deque(maxlen=options.push_queue)
+        self.seen = set()
+
+    def push(self, message):
+        if message in self.seen:
+            return
+        if len(self.recent) == self.recent.maxlen:
+            self.seen.discard(self.recent[0])
+        self.recent.append(message)
+        self.seen.add(message)
+        if len(self.queue) == self.queue.maxlen:
+            self.overflowed = True
+        self.queue.append(message)
+
+    def flush(self):
+        if not self.queue or not self.ready():
+            return
+        batch = list(self.queue)
+        self.queue.clear()
+        if self.overflowed:
+            batch.append(OVERFLOW)
+            self.overflowed = False
+        self.send(batch)
+
+class Hub(object):
+    '''Routes messages from our one subscription to the listeners'''
+
+    def __init__(self):
+        self.listeners = defaultdict(set) # channel -> listeners
+        self.listening = []
+        self.flusher = None
+
+    def start(self):
+        # a message is published on one server, whichever it is we hear it once
+        self.listening = [ gen.convert_yielded(self.listen(host, port)) for host, port in shard.addresses() ]
+        self.flusher = PeriodicCallback(self.flush, options.push_interval)
+        self.flusher.start()
+        self.add(Usernames(), [models.username_channel])
+
+    def stop(self):
+        '''Unsubscribe and stop pushing'''
+        for task in self.listening:
+            task.cancel()
+        self.listening = []
+        if self.flusher:
+            self.flusher.stop()
+
+    # a native coroutine, so ``stop`` can cancel it while it waits
+    async def listen(self, host, port):
+        '''Hear 'events:*' on one server, subscribing again if the connection drops'''
+        client = aioredis.Redis(host=host, port=port, decode_responses=True)
+        while True:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(models.event_channel('*'))
+                while True:
+                    message = await pubsub.get_message(timeout=None)
+                    if message:
+                        self.on_message(message)
+            except aioredis.ConnectionError:
+                logging.warning('lost the subscription on %s:%s, trying again', host, port)
+            finally:
+                await pubsub.aclose()
+            await gen.sleep(1)
+
+    def on_message(self, message):
+        if message['type'] != 'pmessage':
+            return
+        for listener in self.listeners.get(message['channel'], ()):
+            listener.push(message['data'])
+
+    def flush(self):
+        pending = set()
+        for listeners in self.listeners.values():
+            pending.update(l for l in listeners if l.queue)
+        for listener in pending:
+            try:
+                listener.flush()
+            except Exception:
+                logging.exception('could not push to a client')
+
+    def add(self, listener, channels):
+        listener.channels = channels
+        for c in channels:
+            self.listeners[c].add(listener)
+
+    def remove(self, listener):
+        for c in getattr(listener, 'channels', ()):
+            self.listeners[c].discard(listener)
+            if not self.listeners[c]:
+                del self.listeners[c]
+
+class Usernames(object):
+    '''Takes the names other processes publish into ``models.usernames``'''
+
+    queue = ()
+
+    def push(self, name):
+        models.remember_username(name)
+
+hub = Hub()
+
+@gen.coroutine
+def on_node(client, key, command, *args, **kwargs):
+    '''``command`` on the server ``key`` is on.  ``client`` (for the home
+    node, where the sessions are) does it when that is the same one.'''
+    if models.async_pool_for(key) is not models.async_pool:
+        client = models.async_client(key)
+    reply = yield getattr(client, command)(*args, **kwargs)
+    raise gen.Return(reply)
+
+@gen.coroutine
+def mget(client, keys):
+    '''MGET ``keys`` from whichever servers they are on, all at once'''
+    by_pool = defaultdict(list)
+    for key in keys:
+        by_pool[models.async_pool_for(key)].append(key)
+    groups = list(by_pool.values())
+    found = yield [ on_node(client, group[0], 'mget', group) for group in groups ]
+    values = {}
+    for group, replies in zip(groups, found):
+        values.update(zip(group, replies))
+    raise gen.Return([ values[k] for k in keys ])
+
+@gen.coroutine
+def channels_for(client, name):
+    '''Channels a user hears: their own timeline and their groups\' '''
+    if not name:
+        raise gen.Return(None)
+    id = yield client.get(User._id % name.lower())
+    if not id:
+        raise gen.Return([])
+    # both sets are the user's, on one server
+    groups = yield on_node(client, User._created_groups % id, 'sunion',
+            [User._created_groups % id, User._assigned_groups % id])
+    keys = [ Timeline._user % id ] + [ Timeline._group % g for g in groups ]
+    raise gen.Return([ models.event_channel(k) for k in keys ])
+
+class UpdatesSocket(tornado.websocket.WebSocketHandler):
+    '''Pushes batches of events as JSON lists'''
+
+    def open(self):
+        self.listener = None
+        token = to_unicode(self.get_secure_cookie('session'))
+        if not token:
+            self.close()
+            return
+        IOLoop.current().add_future(self.subscribe(token), lambda f: f.result())
+
+    @gen.coroutine
+    def subscribe(self, token):
+        ar = models.async_client()
+        name = yield sessions.lookup(ar, token)
+        channels = yield channels_for(ar, name)
+        if channels is None:
+            self.close()
+            return
+        if self.ws_connection is None: # went away while we looked
+            return
+        self.listener = Listener(self.send, self.ready)
+        hub.add(self.listener, channels)
+
+    def ready(self):
+        # don't pile more onto a socket that hasn't drained, the queue
+        # keeps (a bounded number of) messages for the next flush
+        return self.ws_connection is not None and not self.ws_connection.stream.writing()
+
+    def send(self, batch):
+        self.write_message('[%s]' % ','.join(batch))
+
+    def on_close(self):
+        if self.listener:
+            hub.remove(self.listener)
+
+class UpdatesPoll(tornado.web.RequestHandler):
+    '''Long-poll fallback.  Pass ``since`` (the time of the last update seen)
+    and anything newer on your timeline comes back right away.'''
+
+    @gen.coroutine
+    def get(self):
+        token = to_unicode(self.get_secure_cookie('session'))
+        since = self.get_argument('since', None)
+        missed = None
+        # no connection is held while we wait
+        self.ar = models.async_client()
+        name = (yield sessions.lookup(self.ar, token)) if token else None
+        channels = yield channels_for(self.ar, name)
+        if since and channels:
+            # channels[0] is for the user's own timeline
+            timeline = channels[0][len(models.event_channel('')):]
+            missed = yield self.missed(timeline, since)
+        if channels is None:
+            raise tornado.web.HTTPError(403)
+        if missed:
+            self.send(missed)
+            return
+        self.listener = Listener(self.send)
+        hub.add(self.listener, channels)
+        self.timeout = IOLoop.current().add_timeout(time.time() + options.poll_timeout,
+                lambda: self.send([]))
+        # until send or the client goes away
+        self.done = Future()
+        yield self.done
+
+    @gen.coroutine
+    def missed(self, key, since):
+        pairs = yield on_node(self.ar, key, 'zrangebyscore', key, '(%s' % since, '+inf', withscores=True)
+        if not pairs:
+            raise gen.Return([])
+        texts = yield mget(self.ar, [ User._update_str % id for id, when in pairs ])
+        raise gen.Return([ encode({'type': 'update', 'id': id, 'time': when, 'text': text})
+            for (id, when), text in zip(pairs, texts) if text ])
+
+    def send(self, batch):
+        if self._finished:
+            return
+        self.cleanup()
+        self.set_header('Content-Type', 'application/json')
+        self.finish('[%s]' % ','.join(batch))
+        if getattr(self, 'done', None) and not self.done.done():
+            self.done.set_result(None)
+
+    def cleanup(self):
+        if getattr(self, 'listener', None):
+            hub.remove(self.listener)
+            self.listener = None
+        if getattr(self, 'timeout', None):
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def on_connection_close(self):
+        self.cleanup()
+        if getattr(self, 'done', None) and not self.done.done():
+            self.done.set_result(None)
+
+    def on_finish(self):
+        self.cleanup()
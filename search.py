@@ -0,0 +1,174 @@
+'''Full-text search over item names, components and comments
+
+    python search.py --rebuild_search    # index every item, after an upgrade
+
+An inverted index: one sorted set of postings per word, the members are
+item ids and the score is how much the word counts for that item
+
+    {search}:word:pycon    7 -> 3.0, 12 -> 1.0 ...
+
+A word in the name counts 3, in a component 2 and in a comment 1, each
+time it appears.  The ``Item`` write paths add and take away their
+weights as they go (ZINCRBY) and a posting that falls to 0 is dropped, so
+the index never needs rebuilding in normal running.
+
+A query is the ZINTERSTORE of its words' postings, summing the weights, so
+it costs the postings of those words however many items there are.  The
+``{search}`` tag keeps every posting on one node when sharded.
+'''
+import re
+import uuid
+from collections import defaultdict
+from tornado.escape import json_decode as decode
+from tornado.options import define, options, parse_command_line
+
+import memory
+
+_word = '{search}:word:%s'
+_query = '{search}:query:%s' # ZINTERSTORE result while a query pages through it
+
+name_weight, component_weight, comment_weight = 3, 2, 1
+
+_words = re.compile(r'\w+', re.UNICODE)
+stop_words = frozenset(('a', 'an', 'and', 'the', 'of', 'to', 'in', 'on', 'for', 'is', 'it', 'at', 'by', 'or'))
+
+def words(text):
+    '''dict of word -> times it appears, lower cased, short and stop words left out'''
+    if not text:
+        return {}
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    counts = defaultdict(int)
+    for word in _words.findall(text.lower()):
+        if 1 < len(word) <= 40 and word not in stop_words:
+            counts[word] += 1
+    return counts
+
+def component_text(json):
+    '''A component is a json object or just text, index the strings in it'''
+    try:
+        value = decode(json)
+    except ValueError:
+        return json
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return ' '.join(v for v in value if isinstance(v, type(u'')))
+    return value if isinstance(value, type(u'')) else json
+
+def postings(text, weight, times=1):
+    '''dict of posting key -> score change for ``text`` added ``times`` (negative to remove)'''
+    return dict( (_word % word, count * weight * times) for word, count in words(text).items() )
+
+def item_postings(name, components, comments, times=1):
+    '''``postings`` for everything of one item'''
+    changes = [postings(name, name_weight, times)]
+    changes.extend( postings(component_text(c), component_weight, times) for c in components )
+    changes.extend( postings(c, comment_weight, times) for c in comments )
+    return merge(*changes)
+
+def merge(*changes):
+    total = defaultdict(int)
+    for change in changes:
+        for key, amount in change.items():
+            total[key] += amount
+    return dict( (k, v) for k, v in total.items() if v )
+
+def apply(pipe, item_id, changes):
+    '''Queue ``changes`` (from ``postings``) to ``item_id``'s postings on ``pipe``'''
+    for key, amount in sorted(changes.items()):
+        pipe.zincrby(key, amount, item_id)
+        if amount < 0:
+            # anything at 0 was ours, other items keep a positive score
+            pipe.zremrangebyscore(key, '-inf', 0)
+    return pipe
+
+def word_keys(text):
+    '''The postings to intersect for ``text``'''
+    return sorted(set( _word % w for w in words(text) ))
+
+def temp_key():
+    return _query % uuid.uuid4().hex
+
+def query(client, text):
+    '''The key to page ranked item ids from and the temporary key to delete, if any'''
+    keys = word_keys(text)
+    if not keys:
+        return None, None
+    if len(keys) == 1:
+        return keys[0], None
+    temp = temp_key()
+    pipe = client.pipeline(transaction=True)
+    pipe.zinterstore(temp, keys)
+    pipe.expire(temp, 60) # in case we die before deleting it
+    if not pipe.execute()[0]:
+        return None, None
+    return temp, temp
+
+def ranked(client, key, start, count):
+    '''Item ids, best match first'''
+    return client.zrevrange(key, start, start + count - 1)
+
+def pick(ids, visible, found, count):
+    '''Append the ``visible`` of ``ids`` to ``found`` until it has ``count``,
+    returns how many of ``ids`` were looked at'''
+    for n, id in enumerate(ids):
+        if id in visible:
+            found.append(id)
+            if len(found) == count:
+                return n + 1
+    return len(ids)
+
+def item_ids(batch):
+    '''Packed items only have a hash, older ones only a name key'''
+    import models # models imports us
+    Item = models.Item
+    for id in models.scan_ids(Item._hash, batch):
+        yield id
+    for ids in models.chunked(models.scan_ids(Item._name, batch), batch):
+        pipe = models.r.pipeline(transaction=False)
+        for id in ids:
+            pipe.exists(Item._hash % id)
+        for id, packed in zip(ids, pipe.execute()):
+            if not packed:
+                yield id
+
+def rebuild(batch=200):
+    '''Drop the index and index every item again, two reads and a write per batch'''
+    import models
+    r = models.r
+    for keys in models.chunked(r.scan_iter(match=_word % '*', count=batch), batch):
+        r.delete(*keys)
+    indexed = 0
+    for ids in models.chunked(item_ids(batch), batch):
+        names = models.Item.names(ids)
+        pipe = r.pipeline(transaction=False)
+        for id in ids:
+            pipe.zrange(models.Item._components % id, 0, -1)
+            pipe.hvals(models.Item._comment_bodies % id)
+            pipe.lrange(models.Item._comment_list % id, 0, -1)
+        texts = pipe.execute()
+        # an old comment list holds update ids, the text is the update's
+        old_ids = set( u for n in range(len(ids)) for u in texts[3*n + 2] )
+        old = dict(zip(old_ids, models.mget([ models.User._update_str % u for u in old_ids ])))
+        pipe = r.pipeline(transaction=False)
+        for n, id in enumerate(ids):
+            components, comments, old_comments = texts[3*n:3*n + 3]
+            comments = comments + [ old[u] for u in old_comments if old[u] is not None ]
+            apply(pipe, id, item_postings(names[id], components, comments))
+        pipe.execute()
+        indexed += len(ids)
+    return indexed
+
+def main():
+    # here rather than at import, running this file imports it a second time through models
+    define('rebuild_search', default=False, type=bool, help='clear the search index and index every item')
+    parse_command_line()
+    memory.install()
+    if not options.rebuild_search:
+        options.print_help()
+        return
+    print('indexed %d items' % rebuild())
+
+if __name__ == '__main__':
+    main()
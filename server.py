@@ -0,0 +1,224 @@
+'''Pre-fork server: one supervisor and ``--workers`` processes on one socket
+
+    python server.py [--port=8000] [--workers=16] [--grace=10]
+    kill -HUP <supervisor pid>     # rolling reload onto new code
+    kill -TERM <supervisor pid>    # finish requests and stop
+
+The supervisor binds the socket and forks the workers.  It never imports
+app (or models), so every worker imports the code fresh after the fork and
+gets its own redis connection pools, and a reload picks up new code.
+A worker that dies is replaced.
+
+On SIGHUP the workers are replaced one at a time.  The new worker says when
+it is serving, then the old one stops accepting and gets ``--grace``
+seconds to finish what it has.  The socket stays open in the supervisor
+the whole time, so no connection is refused.
+
+Options for app, realtime, shard, metrics and memory (``--push_interval``,
+``--redis_nodes`` ...) are passed through to the workers.  Give the workers
+a ``--metrics_dir`` so whichever one Prometheus reaches reports for all.
+'''
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import logging
+import multiprocessing
+from tornado.options import define, options, parse_command_line
+from tornado.netutil import bind_sockets
+
+define('port', default=8000, type=int)
+define('address', default='', help='address to bind, all interfaces by default')
+define('workers', default=0, type=int, help='worker processes, 0 for one per cpu')
+define('grace', default=10.0, type=float, help='seconds a stopping worker has to finish requests')
+define('ready_timeout', default=30.0, type=float, help='seconds to wait for a new worker to serve')
+
+ours = ('port', 'address', 'workers', 'grace', 'ready_timeout', 'help', 'logging')
+
+def parse_our_options():
+    '''The supervisor hasn't defined the app's options, leave those to the workers'''
+    args = [ a for a in sys.argv[1:] if a.lstrip('-').split('=')[0].replace('-', '_') in ours ]
+    parse_command_line([sys.argv[0]] + args)
+
+def serve(sockets, ready):
+    '''Run in the forked worker, never returns'''
+    # importing here is what gives each worker its own connection pools
+    import tornado.ioloop
+    import tornado.httpserver
+    import app
+    import metrics
+    import models
+    import realtime
+    import shard
+    import memory
+    parse_command_line()
+    shard.install()
+    memory.install()
+    models.set_packed(options.packed)
+    models.load_usernames()
+    realtime.hub.start()
+    io_loop = tornado.ioloop.IOLoop.instance()
+    http_server = tornado.httpserver.HTTPServer(app.application, xheaders=True)
+    http_server.add_sockets(sockets)
+
+    def shutdown():
+        logging.info('worker %s stopping', os.getpid())
+        http_server.stop()
+        io_loop.add_timeout(time.time() + options.grace, io_loop.stop)
+    def on_term(signum, frame):
+        io_loop.add_callback_from_signal(shutdown)
+    signal.signal(signal.SIGTERM, on_term)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    parent = os.getppid()
+    def orphaned():
+        if os.getppid() != parent:
+            shutdown()
+    tornado.ioloop.PeriodicCallback(orphaned, 1000).start()
+    if options.metrics_dir:
+        # so /metrics on any worker covers all of them
+        tornado.ioloop.PeriodicCallback(metrics.share, options.metrics_interval * 1000).start()
+
+    def tell_supervisor():
+        os.write(ready, b'1')
+        os.close(ready)
+    io_loop.add_callback(tell_supervisor)
+    io_loop.start()
+    # we leave with os._exit, atexit won't do this for us
+    models.reaper.drain(options.grace)
+
+class Supervisor(object):
+
+    def __init__(self, sockets, count):
+        self.sockets = sockets
+        self.count = count
+        self.workers = {} # pid -> started
+        self.retiring = set() # pids told to stop, not to be replaced
+        self.reloading = self.stopping = False
+
+    def spawn(self):
+        '''Fork a worker, returns (pid, fd that becomes readable when it serves)'''
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            try:
+                serve(self.sockets, write)
+            except Exception:
+                logging.exception('worker %s failed', os.getpid())
+                os._exit(1)
+            os._exit(0)
+        os.close(write)
+        self.workers[pid] = time.time()
+        return pid, read
+
+    def wait_ready(self, pid, fd):
+        deadline = time.time() + options.ready_timeout
+        while True:
+            try:
+                ready = select.select([fd], [], [], max(deadline - time.time(), 0))[0]
+                break
+            except (select.error, OSError) as e:
+                # a SIGCHLD or SIGHUP while we wait, python 2 doesn't retry for us
+                if e.args[0] != errno.EINTR:
+                    raise
+        ok = bool(ready) and os.read(fd, 1) == b'1'
+        os.close(fd)
+        if not ok:
+            logging.error('worker %s did not start serving', pid)
+        return ok
+
+    def start(self):
+        fds = [ self.spawn() for _ in range(self.count) ]
+        for pid, fd in fds:
+            self.wait_ready(pid, fd)
+        logging.info('supervisor %s serving with %d workers', os.getpid(), self.count)
+
+    def reload(self):
+        '''Swap each worker for a new one, one at a time'''
+        self.reloading = False
+        logging.info('rolling reload of %d workers', len(self.workers))
+        for old in list(self.workers):
+            if self.stopping:
+                return
+            if old not in self.workers:
+                continue # died on its own and was replaced already
+            pid, fd = self.spawn()
+            if not self.wait_ready(pid, fd):
+                # keep the old code serving rather than take it down, and
+                # don't let reap start the new code again
+                logging.error('reload stopped, the old workers keep serving')
+                self.retire(pid)
+                return
+            self.retire(old)
+            self.reap()
+
+    def retire(self, pid):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def reap(self):
+        '''Collect dead workers, replacing the ones we didn't stop'''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            started = self.workers.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if started is None or self.stopping:
+                continue
+            logging.warning('worker %s died with status %s, restarting', pid, status)
+            if time.time() - started < 1:
+                # don't spin if it dies on startup
+                time.sleep(1)
+            self.wait_ready(*self.spawn())
+
+    def stop(self):
+        logging.info('stopping %d workers', len(self.workers))
+        for pid in list(self.workers):
+            self.retire(pid)
+        deadline = time.time() + options.grace + 5
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            os.kill(pid, signal.SIGKILL)
+
+    def run(self):
+        def on_hup(signum, frame):
+            self.reloading = True
+        def on_term(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGHUP, on_hup)
+        signal.signal(signal.SIGTERM, on_term)
+        signal.signal(signal.SIGINT, on_term)
+        self.start()
+        while not self.stopping:
+            if self.reloading:
+                self.reload()
+            self.reap()
+            time.sleep(0.5)
+        self.stop()
+
+def main():
+    parse_our_options()
+    if options.workers != 1 and any(a.lstrip('-').startswith('memory_store') for a in sys.argv[1:]):
+        raise Exception('--memory_store keeps the data in one process, use --workers=1')
+    sockets = bind_sockets(options.port, options.address or None)
+    Supervisor(sockets, options.workers or multiprocessing.cpu_count()).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+'''Server side sessions
+
+The ``session`` cookie holds a random token (signed like any other secure
+cookie).  'sessions:<token>' is a hash with the username in it that expires
+after ``SESSION_TTL`` seconds without a request, so checking a session is a
+single O(1) round trip no matter how many users we have.
+'''
+import os
+import time
+import binascii
+from tornado import gen
+
+SESSION_TTL = 60 * 60 * 24 * 14 # two weeks of inactivity
+
+_session = 'sessions:%s'
+
+def new_token():
+    return binascii.hexlify(os.urandom(20)).decode('ascii')
+
+@gen.coroutine
+def start(client, name):
+    '''Create a session for ``name`` and return its token'''
+    token = new_token()
+    key = _session % token
+    pipe = client.pipeline(transaction=True)
+    pipe.hset(key, mapping={'name': name, 'created': int(time.time())})
+    pipe.expire(key, SESSION_TTL)
+    yield pipe.execute()
+    raise gen.Return(token)
+
+@gen.coroutine
+def lookup(client, token):
+    '''Returns the username for the token (or None) and slides the expiry'''
+    key = _session % token
+    pipe = client.pipeline(transaction=False)
+    pipe.hget(key, 'name')
+    pipe.expire(key, SESSION_TTL)
+    name, _ = yield pipe.execute()
+    raise gen.Return(name)
+
+@gen.coroutine
+def end(client, token):
+    '''Forget the session, the cookie is worthless after this'''
+    yield client.delete(_session % token)
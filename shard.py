@@ -0,0 +1,319 @@
+'''Spread the model keyspace over several redis servers
+
+    python server.py --redis_nodes=localhost:6379,localhost:6380,localhost:6381
+    python shard.py --redis_nodes=localhost:6379,localhost:6380 --add_node=localhost:6381
+
+Keys are put on a consistent hash ring by their tag.  A key with a {tag} in
+it uses that, otherwise the tag is the object it belongs to, so
+'items:7:fk:creator', 'items:7:hash' and 'timelines:users:3' go with
+'items:7', 'items:7' and 'users:3'.  Every key of an object is on one node
+and a pipeline or script over one object is one round trip to one server.
+
+Keys that aren't an object's (the counters, sessions, '___users', login
+keys, the 'users:id_for' / 'users:name_for' directory) and PUBLISH stay on
+the first node, the home node.  The app's async clients talk to it, so list
+the server they use first.  ``models.async_client(key)`` gives a client on
+the node of ``key`` for the reads that need one, and realtime.py listens on
+every node so a message published anywhere gets through.
+
+A pipeline over several objects becomes one pipeline per node, and a MULTI
+becomes one MULTI per node: atomic per node, not across them.  Scripts that
+build key names inside Lua can't be routed, the models run those through
+their Python versions (``ShardedRedis.cross_key_scripts`` is False).
+
+Adding a node moves about 1/n of the objects.  ``--add_node`` (or ``--remove_node``)
+walks each node with SCAN and moves the keys that belong elsewhere on the
+new ring with DUMP/RESTORE.  Run it before the app is restarted with the new
+``--redis_nodes``, with writes stopped or accepting that keys written while
+it runs may need a second pass.  It is safe to run again.
+'''
+import re
+import time
+import bisect
+import hashlib
+from collections import OrderedDict
+from tornado.options import define, options, parse_command_line
+import redis
+from redis import asyncio as aioredis
+
+import metrics
+import models
+
+define('redis_nodes', default='', help='host:port[/db],... to shard over, home node first')
+define('add_node', default='', help='rebalance onto the ring with this node added')
+define('remove_node', default='', help='rebalance onto the ring with this node taken out')
+define('move_batch', default=500, type=int, help='keys moved per round trip')
+define('move_pause', default=0, type=float, help='seconds to sleep between batches')
+
+class CrossSlotError(redis.exceptions.ResponseError):
+    '''The keys of one command live on different nodes'''
+
+_braces = re.compile(r'\{([^}]+)\}')
+_object = re.compile(r'^(?:timelines:)?(users|items|groups|updates):(\d+)(?::|$)')
+
+def tag(key):
+    '''Keys with the same tag live on the same node, None for the home node'''
+    if not isinstance(key, str):
+        key = key.decode('utf-8', 'replace') if isinstance(key, bytes) else str(key)
+    m = _braces.search(key)
+    if m:
+        return m.group(1)
+    m = _object.match(key)
+    if m:
+        return '%s:%s' % m.groups()
+    return None
+
+def point(s):
+    return int(hashlib.md5(s.encode('utf-8')).hexdigest()[:8], 16)
+
+class Ring(object):
+    '''Consistent hash ring of node names, ``replicas`` points per node'''
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = sorted( (point('%s-%d' % (node, i)), node) for node in self.nodes for i in range(replicas) )
+        self.points = [ p for p, _ in points ]
+        self.owners = [ node for _, node in points ]
+
+    def node_for(self, key):
+        t = tag(key)
+        if t is None:
+            return self.nodes[0]
+        return self.owners[bisect.bisect(self.points, point(t)) % len(self.points)]
+
+def address(name):
+    '''(host, port, db) of 'host:port[/db]' '''
+    where, _, db = name.partition('/')
+    host, _, port = where.partition(':')
+    return host or 'localhost', int(port or 6379), int(db or 0)
+
+def node_names():
+    '''``--redis_nodes`` when there are nodes to shard over'''
+    nodes = [ n for n in options.redis_nodes.split(',') if n ]
+    return nodes if len(nodes) > 1 else []
+
+def addresses():
+    '''(host, port) of every node, the home node first, or of the one server'''
+    return [ address(n)[:2] for n in node_names() ] or [('localhost', 6379)]
+
+def connect(name):
+    '''A client for 'host:port[/db]', counted in metrics like ``models.r``'''
+    host, port, db = address(name)
+    return metrics.InstrumentedRedis(host=host, port=port, db=db, decode_responses=True)
+
+def async_pool(name):
+    host, port, db = address(name)
+    return aioredis.BlockingConnectionPool(max_connections=250, host=host, port=port, db=db,
+            decode_responses=True)
+
+# where commands that don't take a key go
+_everywhere = frozenset(('FLUSHDB', 'FLUSHALL', 'SCRIPT'))
+_home = frozenset(('INFO', 'PING', 'ECHO', 'PUBLISH', 'TIME', 'MULTI', 'EXEC', 'WATCH', 'UNWATCH'))
+_summed = frozenset(('DEL', 'EXISTS', 'UNLINK', 'TOUCH', 'DBSIZE'))
+
+def keys_of(command, args):
+    if command in ('EVAL', 'EVALSHA'):
+        return args[3:3 + int(args[2])]
+    if command in ('MGET', 'DEL', 'EXISTS', 'UNLINK', 'TOUCH', 'SUNION', 'SINTER', 'SDIFF',
+            'SUNIONSTORE', 'SINTERSTORE', 'SDIFFSTORE'):
+        return args[1:]
+    if command in ('SMOVE', 'RPOPLPUSH', 'RENAME', 'RENAMENX'):
+        return args[1:3]
+    if command in ('ZUNIONSTORE', 'ZINTERSTORE'):
+        return (args[1],) + tuple(args[3:3 + int(args[2])])
+    if command in ('MSET', 'MSETNX'):
+        return args[1::2]
+    return args[1:2]
+
+class ShardedRedis(redis.Redis):
+    '''Looks like ``redis.Redis``, routes each command to the node for its keys'''
+
+    cross_key_scripts = False
+
+    def __init__(self, nodes, replicas=160):
+        self.ring = Ring(nodes, replicas)
+        self.clients = OrderedDict( (node, connect(node)) for node in self.ring.nodes )
+        self.home = self.clients[self.ring.nodes[0]]
+        # anything that goes around execute_command (pubsub) gets the home node
+        super(ShardedRedis, self).__init__(connection_pool=self.home.connection_pool)
+        self.scripts = {} # sha -> lua
+        self.loaded = set() # (node, sha)
+
+    def client_for(self, key):
+        return self.clients[self.ring.node_for(key)]
+
+    def plan(self, args):
+        '''[(client, args)] to send and a function merging {client: reply}'''
+        command = str(args[0]).split()[0].upper()
+        first = lambda replies: list(replies.values())[0]
+        if command in _everywhere:
+            return [ (c, args) for c in self.clients.values() ], lambda replies: replies[self.home]
+        if command == 'DBSIZE':
+            return [ (c, args) for c in self.clients.values() ], lambda replies: sum(replies.values())
+        keys = keys_of(command, args)
+        if command in _home or not keys:
+            return [(self.home, args)], first
+        by_client = OrderedDict()
+        for key in keys:
+            by_client.setdefault(self.client_for(key), []).append(key)
+        if len(by_client) == 1:
+            return [(list(by_client)[0], args)], first
+        pieces = [ (c, (args[0],) + tuple(ks)) for c, ks in by_client.items() ]
+        if command == 'MGET':
+            def merge(replies):
+                values = {}
+                for c, ks in by_client.items():
+                    values.update(zip(ks, replies[c]))
+                return [ values[k] for k in keys ]
+            return pieces, merge
+        if command in _summed:
+            return pieces, lambda replies: sum(int(v) for v in replies.values())
+        raise CrossSlotError('CROSSSLOT %s keys are on more than one node: %s' % (command, ' '.join(map(str, keys))))
+
+    def prepare(self, client, args):
+        '''Load a script on the node before its first EVALSHA there'''
+        if str(args[0]).upper() == 'EVALSHA':
+            sha = args[1]
+            if (client, sha) not in self.loaded and sha in self.scripts:
+                client.script_load(self.scripts[sha])
+                self.loaded.add((client, sha))
+
+    def execute_command(self, *args, **kwargs):
+        pieces, merge = self.plan(args)
+        replies = {}
+        for client, command in pieces:
+            self.prepare(client, command)
+            replies[client] = client.execute_command(*command, **kwargs)
+        return merge(replies)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def scan_iter(self, match=None, count=None):
+        for client in self.clients.values():
+            for key in client.scan_iter(match=match, count=count):
+                yield key
+
+    def keys(self, pattern='*'):
+        return [ k for c in self.clients.values() for k in c.keys(pattern) ]
+
+class ShardedScript(object):
+    '''Runs on the node of its keys, loaded there the first time'''
+
+    def __init__(self, registered_client, script):
+        self.registered_client = registered_client
+        self.script = script
+        self.sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        registered_client.scripts[self.sha] = script
+
+    def __call__(self, keys=[], args=[], client=None):
+        client = client or self.registered_client
+        return client.evalsha(self.sha, len(keys), *(list(keys) + list(args)))
+
+class ShardedPipeline(redis.Redis):
+    '''Queues commands, then sends one pipeline to each node that has any'''
+
+    cross_key_scripts = False
+
+    def __init__(self, sharded, transaction=True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.command_stack = []
+
+    def execute_command(self, *args, **kwargs):
+        self.command_stack.append((args, kwargs))
+        return self
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        self.command_stack = []
+
+    def execute(self):
+        stack, self.command_stack = self.command_stack, []
+        plans = [ self.sharded.plan(args) for args, _ in stack ]
+        per_client = OrderedDict() # client -> [(position, args, kwargs)]
+        for n, ((pieces, _), (_, kwargs)) in enumerate(zip(plans, stack)):
+            for client, args in pieces:
+                per_client.setdefault(client, []).append((n, args, kwargs))
+        replies = [ {} for _ in stack ]
+        for client, commands in per_client.items():
+            pipe = client.pipeline(transaction=self.transaction)
+            for n, args, kwargs in commands:
+                self.sharded.prepare(client, args)
+                pipe.execute_command(*args, **kwargs)
+            for (n, _, _), reply in zip(commands, pipe.execute()):
+                replies[n][client] = reply
+        return [ merge(r) for (_, merge), r in zip(plans, replies) ]
+
+def install():
+    '''Shard ``models.r`` over ``--redis_nodes`` when more than one is given'''
+    nodes = node_names()
+    if not nodes:
+        return
+    sharded = ShardedRedis(nodes)
+    models.use_client(sharded)
+    pools = dict( (node, async_pool(node)) for node in nodes )
+    models.async_pool = pools[nodes[0]]
+    models.async_pool_for = lambda key: pools[sharded.ring.node_for(key)]
+
+def move(source, target, keys):
+    '''DUMP/RESTORE ``keys`` from ``source`` to ``target``, then delete them'''
+    pipe = source.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    dumped = pipe.execute()
+    pipe = target.pipeline(transaction=False)
+    moved = []
+    for n, key in enumerate(keys):
+        value, ttl = dumped[2*n], dumped[2*n + 1]
+        if value is None:
+            continue # gone since the SCAN
+        pipe.execute_command('RESTORE', key, max(ttl, 0), value, 'REPLACE')
+        moved.append(key)
+    pipe.execute()
+    if moved:
+        source.delete(*moved)
+    return len(moved)
+
+def rebalance(old, new):
+    '''Move every key that ``new`` puts on a different node than ``old``'''
+    clients = dict( (node, connect(node)) for node in set(old.nodes) | set(new.nodes) )
+    total = 0
+    for node in old.nodes:
+        source = clients[node]
+        for batch in models.chunked(source.scan_iter(count=options.move_batch), options.move_batch):
+            moving = {}
+            for key in batch:
+                owner = new.node_for(key)
+                if owner != node:
+                    moving.setdefault(owner, []).append(key)
+            for owner, keys in moving.items():
+                total += move(source, clients[owner], keys)
+            if options.move_pause:
+                time.sleep(options.move_pause)
+        print('%s done, %d keys moved so far' % (node, total))
+    return total
+
+def main():
+    parse_command_line()
+    nodes = [ n for n in options.redis_nodes.split(',') if n ]
+    if options.add_node:
+        new_nodes = nodes + [options.add_node]
+    elif options.remove_node:
+        new_nodes = [ n for n in nodes if n != options.remove_node ]
+        if new_nodes and new_nodes[0] != nodes[0]:
+            raise Exception("the home node can't be removed, its keys aren't on the ring")
+    else:
+        options.print_help()
+        return
+    moved = rebalance(Ring(nodes), Ring(new_nodes))
+    print('moved %d keys, restart with --redis_nodes=%s' % (moved, ','.join(new_nodes)))
+
+if __name__ == '__main__':
+    main()
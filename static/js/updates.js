@@ -0,0 +1,26 @@
+// Listen for new updates, over a WebSocket when we can and long polling when not.
+// Pass a function that takes each event ({type: 'update'|'item'|'overflow', ...}).
+function listenForUpdates(onEvent) {
+    var since = null;
+    function handle(events) {
+        $.each(events, function(i, e) {
+            if (e.time) since = e.time;
+            onEvent(e);
+        });
+    }
+    function poll() {
+        $.ajax({url: '/updates/poll', data: since ? {since: since} : {}, dataType: 'json',
+            success: function(events) { handle(events); poll(); },
+            error: function() { setTimeout(poll, 5000); }});
+    }
+    if (window.WebSocket) {
+        var scheme = location.protocol == 'https:' ? 'wss://' : 'ws://';
+        var ws = new WebSocket(scheme + location.host + '/updates/socket');
+        var opened = false;
+        ws.onopen = function() { opened = true; };
+        ws.onmessage = function(m) { handle($.parseJSON(m.data)); };
+        ws.onclose = function() { opened ? setTimeout(function() { listenForUpdates(onEvent); }, 5000) : poll(); };
+    } else {
+        poll();
+    }
+}
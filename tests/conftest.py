@@ -0,0 +1,128 @@
+'''Every test that takes ``r`` runs twice: on ``memory.MemoryRedis`` and on a
+throwaway redis-server (skipped when there is none on the PATH)
+
+    python -m pytest tests
+'''
+import os
+import sys
+import time
+import socket
+import subprocess
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import redis
+from redis import asyncio as aioredis
+import metrics
+import memory
+import models
+
+def which(program):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.access(candidate, os.X_OK):
+            return candidate
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_redis():
+    '''(port, process) of a new redis-server, skips the test when there is none'''
+    binary = which('redis-server')
+    if not binary:
+        pytest.skip('no redis-server on the PATH')
+    port = free_port()
+    server = subprocess.Popen([binary, '--port', str(port), '--save', '', '--appendonly', 'no'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    client = redis.Redis(port=port)
+    for _ in range(100):
+        try:
+            client.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.05)
+    return port, server
+
+def stop_redis(server):
+    server.terminate()
+    server.wait()
+
+@pytest.fixture(scope='session')
+def redis_port():
+    port, server = start_redis()
+    yield port
+    stop_redis(server)
+
+@pytest.fixture(scope='session')
+def redis_ports():
+    '''Ports of three more servers, for sharding'''
+    started = [ start_redis() for _ in range(3) ]
+    yield [ port for port, _ in started ]
+    for _, server in started:
+        stop_redis(server)
+
+def using(client):
+    '''Point the models at ``client``, the counters start again with it'''
+    models.use_client(client)
+    models.id_blocks.clear()
+    models.usernames = models.BloomFilter()
+
+@pytest.fixture(params=['memory', 'redis'])
+def r(request):
+    '''``models.r`` on an empty backend'''
+    if request.param == 'memory':
+        client = memory.MemoryRedis()
+    else:
+        client = metrics.InstrumentedRedis(port=request.getfixturevalue('redis_port'), decode_responses=True)
+        client.flushdb()
+    old = models.r
+    using(client)
+    yield client
+    models.reaper.join()
+    models.use_client(old)
+
+@pytest.fixture
+def ar(r, monkeypatch):
+    '''An async client on ``r``'s server, the kind the handlers use.  Skips
+    on memory, the async client only talks to redis.'''
+    if isinstance(r, memory.MemoryRedis):
+        pytest.skip('the async client talks to a redis-server')
+    monkeypatch.setattr(models, 'async_pool', aioredis.BlockingConnectionPool(
+        port=r.connection_pool.connection_kwargs['port'], decode_responses=True))
+    return models.async_client()
+
+class Store(object):
+    '''A ``MemoryRedis`` logged to disk that the command line tools can run on'''
+
+    def __init__(self, path):
+        self.path = path
+        self.engine = memory.MemoryRedis(path)
+        using(self.engine)
+
+    def run(self, script, *args):
+        '''Run ``script`` with ``args`` on what the models wrote, returns its
+        output.  The models move on to what it left behind.'''
+        models.reaper.join()
+        self.engine.wait()
+        self.engine.aof.close()
+        output = subprocess.check_output([sys.executable, script, '--memory_store=' + self.path] + list(args),
+                cwd=root, stderr=subprocess.STDOUT)
+        self.engine = memory.MemoryRedis(self.path)
+        using(self.engine)
+        return output.decode('utf-8')
+
+@pytest.fixture
+def store(tmpdir):
+    '''For the migrations and repairs, which are run as they would be by hand'''
+    old = models.r
+    s = Store(str(tmpdir.join('data')))
+    yield s
+    models.reaper.join()
+    models.use_client(old)
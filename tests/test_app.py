@@ -0,0 +1,159 @@
+'''The handlers, signed up and logged in like a browser would be'''
+try:
+    from http.cookies import SimpleCookie
+except ImportError:
+    from Cookie import SimpleCookie
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+import pytest
+from tornado.escape import json_decode
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.websocket import websocket_connect
+from tornado import gen
+
+import app
+import models
+import realtime
+import shard
+from models import User, Item, Group
+
+xsrf = 'testxsrftoken'
+
+class Browser(object):
+    '''Keeps the cookies it is sent, posts with the xsrf token'''
+
+    def __init__(self, port):
+        self.base = 'http://127.0.0.1:%d' % port
+        self.cookies = {'_xsrf': xsrf}
+
+    def post(self, path, **fields):
+        return self.fetch(path, 'POST', urlencode(dict(fields, _xsrf=xsrf)))
+
+    def get(self, path, **args):
+        return self.fetch(path + ('?' + urlencode(args) if args else ''), 'GET')
+
+    def fetch(self, path, method, body=None):
+        request = HTTPRequest(self.base + path, method=method, body=body,
+                headers=self.headers(), follow_redirects=False)
+        response = IOLoop.current().run_sync(lambda: AsyncHTTPClient().fetch(request, raise_error=False))
+        for header in response.headers.get_list('Set-Cookie'):
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        return response
+
+    def headers(self):
+        return {'Cookie': '; '.join('%s=%s' % kv for kv in self.cookies.items())}
+
+    def socket(self, path):
+        request = HTTPRequest(self.base.replace('http', 'ws', 1) + path, headers=self.headers())
+        return IOLoop.current().run_sync(lambda: websocket_connect(request))
+
+    def json(self, path, method='POST', **fields):
+        response = getattr(self, method.lower())(path, **fields)
+        assert response.code == 200, response.code
+        return json_decode(response.body)
+
+@pytest.fixture
+def browser(r, ar):
+    sock, port = bind_unused_port()
+    server = HTTPServer(app.application)
+    server.add_sockets([sock])
+    yield Browser(port)
+    server.stop()
+
+def sign_up(browser, name):
+    response = browser.post('/create', key=name, next='/')
+    assert response.code == 302 and 'session' in browser.cookies
+    return User(name=name)
+
+def test_signup_creates_the_user(r, browser):
+    user = sign_up(browser, 'Sam')
+    assert r.sismember('___users', 'Sam')
+    assert r.get(User._id % 'sam') == user.id and user.name == 'Sam'
+
+def test_signup_with_a_taken_name(r, browser):
+    User(name='sam', create=True)
+    assert browser.post('/create', key='Sam', next='/').code == 403
+    assert not r.sismember('___users', 'Sam') and 'session' not in browser.cookies
+    sign_up(browser, 'tia')
+    assert browser.post('/create', key='tia', next='/').code == 403
+
+def test_groups_and_updates_after_signup(r, browser):
+    user = sign_up(browser, 'tess')
+    g = browser.json('/groups', name='choir')['id']
+    assert Group(g).name == 'choir' and r.sismember(user.rcreated_groups, g)
+    u = browser.json('/updates', text='practice at 8', group=g)['id']
+    assert user.update_texts() == ['practice at 8']
+    assert r.zscore(models.Timeline._group % g, u)
+    other = User(name='uri', create=True).create_group('band')
+    assert browser.post('/updates', text='hi', group=other).code == 403
+
+def test_assign_after_signup(r, browser):
+    user = sign_up(browser, 'vera')
+    owner = User(name='walt', create=True)
+    g = owner.create_group('shop')
+    Group(g).add_member(user.id)
+    i = Item(name='lathe', creator=owner.id, group=g).id
+    assert browser.json('/items/%s/assign' % i) == {'id': str(i)}
+    assert r.sismember(user.rassigned_items, i) and r.sismember(Item._members % i, user.id)
+    hidden = owner.create_item('safe')
+    assert browser.post('/items/%s/assign' % hidden).code == 403
+
+def test_logged_out(browser):
+    assert browser.post('/groups', name='choir').code == 403
+
+def test_search_after_signup(r, browser):
+    user = sign_up(browser, 'xena')
+    ids = [ user.create_item('red kite %d' % n) for n in range(3) ]
+    found = browser.json('/search', 'GET', q='kite', count=2)
+    assert len(found['items']) == 2 and found['cursor']
+    rest = browser.json('/search', 'GET', q='kite', count=2, cursor=found['cursor'])
+    seen = [ i['id'] for i in found['items'] + rest['items'] ]
+    assert sorted(seen) == sorted(str(i) for i in ids) and rest['cursor'] is None
+
+def test_search_count(r, browser):
+    user = sign_up(browser, 'yuri')
+    for n in range(3):
+        user.create_item('blue kite %d' % n)
+    # 0 and below would hand the same cursor back forever
+    page = browser.json('/search', 'GET', q='kite', count=0)
+    assert len(page['items']) == 1 and page['cursor'] != '0'
+    assert len(browser.json('/search', 'GET', q='kite', count=1000)['items']) == 3
+    assert browser.get('/search', q='kite', count='lots').code == 400
+
+@pytest.fixture
+def hub(r, monkeypatch):
+    '''``realtime.hub`` listening on the test server'''
+    port = r.connection_pool.connection_kwargs['port']
+    monkeypatch.setattr(shard, 'addresses', lambda: [('127.0.0.1', port)])
+    hub = realtime.Hub()
+    monkeypatch.setattr(realtime, 'hub', hub)
+    hub.start()
+    wait_for(lambda: r.pubsub_numpat())
+    yield hub
+    hub.stop()
+
+def wait_for(condition, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        IOLoop.current().run_sync(lambda: gen.sleep(0.01))
+    raise AssertionError('timed out')
+
+def test_push_after_signup(r, browser, hub):
+    user = sign_up(browser, 'zed')
+    g = browser.json('/groups', name='band')['id']
+    socket = browser.socket('/updates/socket')
+    mine = [ models.event_channel(k) for k in (models.Timeline._user % user.id, models.Timeline._group % g) ]
+    wait_for(lambda: all(hub.listeners.get(c) for c in mine))
+    u = browser.json('/updates', text='gig on friday', group=g)['id']
+    batch = json_decode(IOLoop.current().run_sync(socket.read_message, timeout=5))
+    # on our timeline and the group's, sent once
+    assert [ (e['id'], e['text']) for e in batch ] == [(u, 'gig on friday')]
+    socket.close()
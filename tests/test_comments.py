@@ -0,0 +1,58 @@
+'''Item comments and their migration from the old lists'''
+import search
+from models import User, Item
+
+def search_words(changes):
+    return [ key[len(search._word % ''):] for key in changes ]
+
+def test_pages_keep_comments_at_the_same_time(r):
+    i = Item(User(name='abe', create=True).create_item('quilt'))
+    ids = [ i.post_comment('patch %d' % n, when=100) for n in range(5) ]
+    ids.append(i.post_comment('binding', when=200))
+    seen, cursor = [], None
+    while True:
+        pairs, cursor = i.comments_page(cursor, count=2)
+        seen.extend( int(c) for c, when in pairs )
+        if not cursor:
+            break
+    assert sorted(seen) == sorted(ids) and len(seen) == len(ids)
+    first = i.comments_since(0, count=1)
+    (last_id, when), = first
+    assert [ c for c, _ in i.comments_since(when, last_id=last_id) ] == \
+        [ c for c, _ in r.zrange(i.rcomments, 1, -1, withscores=True) ]
+    assert [ int(c) for c, _ in i.comments_since(100) ] == [ids[-1]]
+
+def test_comment_bodies_and_removal(r):
+    owner = User(name='bea', create=True)
+    i = Item(owner.create_item('loom'))
+    c = i.post_comment('warp threads')
+    assert i.comment_bodies([c]) == {c: 'warp threads'}
+    assert owner.search_items('warp')[0] == [str(i.id)]
+    assert i.rm_comment(c)
+    assert i.num_comments() == 0
+    assert owner.search_items('warp')[0] == []
+
+def test_add_comment_takes_an_update(r):
+    u = User(name='cal', create=True)
+    i = Item(u.create_item('kiln'))
+    update = u.add_update('fired the kiln')
+    c = i.add_comment(update)
+    assert list(i.comment_bodies([c]).values()) == ['fired the kiln']
+    assert i.add_comment(99999) is None
+
+def test_migrate_old_lists(store):
+    u = User(name='dee', create=True)
+    i = Item(u.create_item('mill'))
+    first, gone, second = [ u.add_update(text) for text in ('grind', 'old news', 'sift') ]
+    r = store.engine
+    r.rpush(Item._comment_list % i.id, first, gone, second)
+    u.del_update(gone)
+    # an unmigrated list is indexed by the updates' texts
+    assert set(search_words(i.index_changes())) == set(['mill', 'grind', 'sift'])
+    assert 'moved 2 comments of 1 items' in store.run('comments.py', '--pause=0')
+    i = Item(i.id)
+    pairs = i.comments_page()[0]
+    assert [ when for c, when in pairs ] == [1.0, 2.0]
+    assert [ i.comment_bodies([c])[c] for c, _ in pairs ] == ['grind', 'sift']
+    assert not store.engine.exists(Item._comment_list % i.id)
+    assert store.engine.get(User._update_str % first) == 'grind'
@@ -0,0 +1,31 @@
+'''dump.py export and load on both backends'''
+import io
+
+import dump
+from models import User, Item
+
+def export():
+    out = io.StringIO()
+    dump.export(out)
+    return sorted(out.getvalue().splitlines())
+
+def test_round_trip(r):
+    owner, other = User(name='wes', create=True), User(name='xan', create=True)
+    g = owner.create_group('garden')
+    other.add_to_group(g)
+    i = owner.create_item('seeds')
+    Item(i).set_group(g)
+    Item(i).post_comment('tomatoes first')
+    owner.add_update('planted')
+    r.sadd('___users', 'wes', 'xan')
+    r.set('twitter:1234', 'wes')
+    r.set('google:xan@example.com', 'xan')
+    before = export()
+    assert '{"type": "login", "key": "twitter:1234", "name": "wes"}' in before
+    assert '{"type": "username", "name": "xan"}' in before
+    r.flushdb()
+    dump.load(before)
+    assert export() == before
+    assert r.get('google:xan@example.com') == 'xan'
+    assert r.sismember('___users', 'wes')
+    assert owner.search_items('seeds')[0] == [str(i)]
@@ -0,0 +1,36 @@
+'''keyspace.py sorting every key under its template and finding orphans'''
+import json
+
+import sessions
+from models import User, Item, Group
+
+def test_profile_and_orphans(store, tmpdir):
+    u = User(name='olga', create=True)
+    g = u.create_group('walkers')
+    i = u.create_item('boots')
+    Item(i).set_group(g)
+    Item(i).set_string_attr('size', '6')
+    u.add_update('new boots')
+    r = store.engine
+    r.set(sessions._session % 'abc', u.id)
+    r.set('leftover', 'x')
+    # the objects these belonged to are gone
+    r.set(Item._attrs % 999 + 'size', '9')
+    r.sadd(Item._members % 999, u.id)
+    r.rpush(Group._items % 998, 999)
+    out = tmpdir.join('report.json')
+    store.run('keyspace.py', '--orphans', '--sample=1', '--rate=100000', '--json=' + str(out))
+    report = json.loads(out.read())
+    patterns = report['patterns']
+    assert patterns['Item._name']['keys'] == 1 and patterns['Group._name']['keys'] == 1
+    assert patterns['Item._attrs']['keys'] == 2 and patterns['Item._attrs']['measured'] == 2
+    assert patterns['Update._update_str']['keys'] == 1
+    assert patterns['sessions']['keys'] == 1 and patterns['counters']['keys'] >= 3
+    assert patterns['unknown']['keys'] == 1
+    assert report['orphans'] == {
+        'Item._attrs': [Item._attrs % 999 + 'size'],
+        'Item._members': [Item._members % 999],
+        'Group._items': [Group._items % 998],
+    }
+    assert patterns['Item._name']['orphans'] == 0
+    assert set(report['types']) >= set(['User', 'Item', 'Group'])
@@ -0,0 +1,107 @@
+'''The in-process engine against the same model calls as redis'''
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+from redis.exceptions import ResponseError
+
+import dump
+import memory
+import models
+from models import User, Item, Group
+
+def test_scripts_run_on_both(r):
+    u = User(name='alice', create=True)
+    assert u.id == User(name='ALICE').id
+    g = u.create_group('speakers')
+    i = u.create_item('talk')
+    Item(i).set_group(g)
+    assert Group(g).get_items() == [str(i)]
+    assert u.visible_items([i, 999]) == [str(i)]
+    u.add_update('hello')
+    entries, cursor = u.timeline().page()
+    assert [ text for _, _, text in entries ] == ['hello']
+
+def test_script_in_a_pipeline(r):
+    raise_counter = dump.raise_counter
+    r.set('c', 5)
+    pipe = r.pipeline()
+    raise_counter(keys=['c'], args=[9], client=pipe)
+    raise_counter(keys=['c'], args=[7], client=pipe)
+    pipe.get('c')
+    assert pipe.execute()[-1] == '9'
+
+def test_unknown_lua():
+    with pytest.raises(ResponseError):
+        memory.MemoryRedis().register_script("return 1")
+
+def test_reload_from_disk():
+    path = os.path.join(tempfile.mkdtemp(), 'data')
+    engine = memory.MemoryRedis(path)
+    old = models.r
+    models.use_client(engine)
+    try:
+        u = User(name='bob', create=True)
+        i = u.create_item('persisted')
+        Item(i).add_component('wheels')
+        engine.snapshot()
+        u.add_update('after the snapshot')
+        models.reaper.join()
+    finally:
+        models.use_client(old)
+    engine.aof.close()
+    again = memory.MemoryRedis(path)
+    assert again.smembers(User._created_items % u.id) == set([str(i)])
+    assert again.zrange(Item._components % i, 0, -1) == ['wheels']
+    assert again.lrange(User._updates % u.id, 0, -1)
+
+def test_snapshot_written_off_the_lock(monkeypatch):
+    path = os.path.join(tempfile.mkdtemp(), 'data')
+    engine = memory.MemoryRedis(path, snapshot_every=3)
+    started, finish = threading.Event(), threading.Event()
+    write = engine.write_snapshot
+    def slow(saved):
+        started.set()
+        finish.wait(5)
+        write(saved)
+    monkeypatch.setattr(engine, 'write_snapshot', slow)
+    for key in 'abc': # the third is due a snapshot
+        engine.set(key, key)
+    assert started.wait(5)
+    writer = threading.Thread(target=engine.set, args=('d', 'd'))
+    writer.start()
+    writer.join(5)
+    assert not writer.is_alive()
+    # dying now loses nothing, the log the snapshot replaces is still there
+    crashed = os.path.join(tempfile.mkdtemp(), 'data')
+    for suffix in ('.snapshot', '.aof.old', '.aof'):
+        shutil.copy(path + suffix, crashed + suffix)
+    assert memory.MemoryRedis(crashed).mget(list('abcd')) == list('abcd')
+    finish.set()
+    engine.wait()
+    assert not os.path.exists(path + '.aof.old')
+    engine.aof.close()
+    assert memory.MemoryRedis(path).mget(list('abcd')) == list('abcd')
+
+def test_log_from_redis_py_2():
+    '''Logs written before they had a version used the old argument orders'''
+    path = os.path.join(tempfile.mkdtemp(), 'data')
+    with open(path + '.aof', 'w') as f:
+        f.write('{"generation": 0}\n')
+        f.write('["zadd", ["z", "a", 1, "b", 2], {}]\n')
+        f.write('["zincrby", ["z", "a", 5], {}]\n')
+        f.write('["rpush", ["l", "x", "y", "x"], {}]\n')
+        f.write('["lrem", ["l", "x", 1], {}]\n')
+    engine = memory.MemoryRedis(path)
+    assert engine.zrange('z', 0, -1, withscores=True) == [('b', 2.0), ('a', 6.0)]
+    assert engine.lrange('l', 0, -1) == ['y', 'x']
+
+def test_pack_on_the_memory_store(store):
+    u = User(name='carol', create=True)
+    i = u.create_item('bike')
+    Item(i).set_string_attr('colour', 'red')
+    store.run('pack.py')
+    assert store.engine.hgetall(Item._hash % i) == {'name': 'bike', 'creator': str(u.id), 'attr:colour': 'red'}
+    assert not store.engine.exists(Item._name % i)
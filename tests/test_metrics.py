@@ -0,0 +1,70 @@
+'''Where metrics.py puts the commands down to'''
+import os
+import json
+
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import app
+import metrics
+import models
+from models import User, Item
+
+@pytest.fixture
+def registry(r, request):
+    if request.node.callspec.params['r'] == 'memory':
+        pytest.skip('MemoryRedis is not instrumented')
+    metrics.registry.clear()
+    return metrics.registry
+
+def contexts(registry, command):
+    return set( c for (cmd, ns, c) in registry.calls if cmd == command )
+
+def test_outermost_model_method(r, registry):
+    u = User(name='yul', create=True)
+    g = u.create_group('crew')
+    registry.clear()
+    u.add_update('hello', group_id=g)
+    assert contexts(registry, 'ZADD') == set(['User.add_update'])
+    registry.clear()
+    models.Group._create('band') # a Model classmethod, named after who called it
+    assert contexts(registry, 'SET') == set(['Group._create'])
+
+def test_generators_and_outside_calls(r, registry):
+    u = User(name='zed', create=True)
+    i = u.create_item('lamp')
+    registry.clear()
+    assert list(models.scan_ids(Item._name)) == [str(i)]
+    assert contexts(registry, 'SCAN') == set(['scan_ids'])
+    registry.clear()
+    r.get('anything')
+    assert contexts(registry, 'GET') == set(['other'])
+
+def test_a_pipeline_is_one_call(r, ar, registry):
+    client = app.CountingClient(models.async_client(), 'Test')
+    @gen.coroutine
+    def go():
+        for n in range(3):
+            pipe = client.pipeline()
+            pipe.set('lamp', n)
+            pipe.get('lamp')
+            yield pipe.execute()
+    IOLoop.current().run_sync(go)
+    ns = metrics.namespace('GET', ['lamp'])
+    assert client.calls == 3
+    assert registry.calls[('SET', ns, 'Test')] == registry.calls[('GET', ns, 'Test')] == 3
+    assert sum(registry.histograms[('PIPELINE', ns, 'Test')]) == 3
+
+def test_workers_add_up(tmpdir, monkeypatch):
+    monkeypatch.setattr(metrics.options, 'metrics_dir', str(tmpdir))
+    other = metrics.Registry()
+    other.record('GET', ['items:1'], 'x', 'Item.name', 0.001)
+    tmpdir.join('%d.json' % os.getppid()).write(json.dumps(other.state()))
+    tmpdir.join('999999999.json').write('{}') # no such worker
+    before = metrics.registry.calls[('GET', 'items', 'Item.name')]
+    total = metrics.all_workers()
+    assert total.calls[('GET', 'items', 'Item.name')] == before + 1
+    assert total.histograms[('GET', 'items', 'Item.name')][1] >= 1
+    assert not tmpdir.join('999999999.json').exists()
+    assert 'context="Item.name"' in total.render()
@@ -0,0 +1,219 @@
+'''The models on both backends, see conftest.py'''
+import threading
+
+import pytest
+
+import models
+from models import User, Item, Group
+
+def test_del_group_packed_without_cascade(r):
+    models.set_packed()
+    try:
+        u = User(name='erin', create=True)
+        g = u.create_group('book club')
+        assert Group(g).name == 'book club'
+        u.del_group(g, cascade=False)
+        assert not r.hget(Group._hash % g, 'name')
+        assert Group.names([g])[g] is None
+    finally:
+        models.set_packed(False)
+
+def test_destroy_item_cleans_every_index(r):
+    owner, other = User(name='fay', create=True), User(name='gus', create=True)
+    g = owner.create_group('crew')
+    i = owner.create_item('tent')
+    Item(i).set_group(g)
+    other.assign_item(i)
+    assert owner.destroy_item(i)
+    models.reaper.join()
+    assert not r.sismember(other.rassigned_items, i)
+    assert not r.sismember(owner.rcreated_items, i)
+    assert Group(g).get_items() == []
+    assert not r.exists(Item._members % i)
+
+def test_del_group_cleans_members_and_item_creators(r):
+    owner, other = User(name='hal', create=True), User(name='ida', create=True)
+    g = owner.create_group('band')
+    other.add_to_group(g)
+    i = other.create_item('drum')
+    Item(i).set_group(g)
+    owner.assign_item(i)
+    owner.del_group(g)
+    models.reaper.join()
+    assert not r.sismember(other.rassigned_groups, g)
+    assert not r.sismember(other.rcreated_items, i)
+    assert not r.sismember(owner.rassigned_items, i)
+    assert not r.exists(Item._name % i) and not r.exists(Group._items % g)
+
+def test_delete_uses_the_registry_not_scan(r, monkeypatch):
+    i = User(name='jo', create=True).create_item('lamp')
+    item = Item(i)
+    item.set_string_attr('colour', 'green')
+    key = item.set_key('tags')
+    r.sadd(key, 'old')
+    def no_scan(*args, **kwargs):
+        raise AssertionError('SCAN while deleting')
+    monkeypatch.setattr(r, 'scan_iter', no_scan)
+    item.delete(background=False)
+    assert not r.exists(item.attrs + 'colour') and not r.exists(key)
+    assert not r.exists(Item._registry % i)
+
+def test_delete_scans_for_attrs_before_the_repair(r):
+    i = User(name='jody', create=True).create_item('lamp')
+    legacy = [ t % i + 'old' for t in Item._generic ]
+    for key in legacy: # written before there were registries
+        r.set(key, 'x')
+    Item(i).delete(background=False)
+    assert not any(r.exists(k) for k in legacy)
+    r.set(models.registries_filled, 1)
+    j = User(name='jody').create_item('lamp')
+    r.set(Item._attrs % j + 'old', 'x')
+    Item(j).delete(background=False)
+    assert r.exists(Item._attrs % j + 'old')
+
+def test_reaper_drains(r):
+    i = User(name='kai', create=True).create_item('kite')
+    reaper = models.Reaper(pause=0.01)
+    reaper.delete(Item(i).key_batches(batch=1))
+    assert reaper.drain(timeout=5)
+    assert not r.exists(Item._name % i)
+    stuck = threading.Event()
+    def slow():
+        stuck.wait(5)
+        yield []
+    reaper.delete(slow())
+    assert not reaper.drain(timeout=0.05)
+    stuck.set()
+    assert reaper.drain(timeout=5)
+
+def test_repair_fills_registries(store):
+    i = User(name='kit', create=True).create_item('desk')
+    # an attr written before there were registries
+    store.engine.set(Item._attrs % i + 'legacy', 'yes')
+    assert 'attr keys missing from their registry' in store.run('indexes.py', '--repair', '--pause=0')
+    assert store.engine.smembers(Item._registry % i) == set([Item._attrs % i + 'legacy'])
+    assert store.engine.exists(models.registries_filled)
+    Item(i).delete(background=False)
+    assert not store.engine.exists(Item._attrs % i + 'legacy')
+
+def test_repair_group_lists(store):
+    owner = User(name='lea', create=True)
+    kept, gone = owner.create_group('kept'), owner.create_group('gone')
+    listed, dangling = owner.create_item('map'), owner.create_item('rope')
+    Item(listed).set_group(kept)
+    Item(dangling).set_group(gone)
+    r = store.engine
+    r.delete(Group._items % kept)
+    r.delete(Group._name % gone, Group._items % gone) # the group went, the fk stayed
+    out = store.run('indexes.py', '--repair', '--pause=0')
+    assert '1 items missing from their group list' in out
+    assert store.engine.lrange(Group._items % kept, 0, -1) == [str(listed)]
+    assert not store.engine.exists(Group._items % gone)
+
+def test_repair_long_group_lists_in_small_batches(store):
+    owner = User(name='lou', create=True)
+    groups = [ owner.create_group('shelf %d' % n) for n in range(3) ]
+    items = dict( (g, [ owner.create_item('book') for _ in range(5) ]) for g in groups )
+    for g in groups:
+        for i in items[g]:
+            Item(i).set_group(g)
+    r = store.engine
+    missing = [ items[g][n] for n, g in enumerate(groups) ]
+    for g, i in zip(groups, missing):
+        r.lrem(Group._items % g, 0, i)
+    out = store.run('indexes.py', '--repair', '--pause=0', '--count=2', '--cached_groups=1')
+    assert '3 items missing from their group list' in out
+    for g in groups:
+        assert sorted(store.engine.lrange(Group._items % g, 0, -1)) == sorted(str(i) for i in items[g])
+
+def test_set_group_moves_between_lists(r):
+    owner = User(name='max', create=True)
+    first, second = owner.create_group('first'), owner.create_group('second')
+    i = Item(owner.create_item('lamp'))
+    assert i.set_group(first) is None
+    assert i.set_group(second) == str(first)
+    assert Group(first).get_items() == [] and Group(second).get_items() == [str(i.id)]
+    # not in ``expected``: nothing moves, only the stale list entry goes
+    r.rpush(Group._items % first, i.id)
+    assert i.set_group(None, expected=first) == str(second)
+    assert Group(first).get_items() == [] and Item(i.id).get_group() == str(second)
+    i.set_group(None)
+    assert Group(second).get_items() == [] and Item(i.id).get_group() is None
+
+def test_usernames_grow_off_the_request_path(r):
+    models.usernames = models.BloomFilter(capacity=20)
+    for n in range(30):
+        User(name='user%d' % n, create=True)
+    for thread in threading.enumerate():
+        if thread.name == 'usernames':
+            thread.join()
+    assert models.growing is None and models.usernames.capacity > 20
+    for n in range(30):
+        assert 'user%d' % n in models.usernames
+
+def test_new_usernames_are_published(r, request):
+    if request.node.callspec.params['r'] == 'memory':
+        pytest.skip('one process, nothing to publish to')
+    pubsub = r.pubsub()
+    pubsub.subscribe(models.username_channel)
+    pubsub.get_message(timeout=1)
+    User(name='Quinn', create=True)
+    message = pubsub.get_message(timeout=1)
+    assert message['data'] == 'Quinn'
+    pubsub.close()
+
+def test_identity_map_is_per_request(r):
+    i = User(name='sam', create=True).create_item('mug')
+    first, second = models.IdentityMap(), models.IdentityMap()
+    mug = Item(i, identity_map=first)
+    assert Item(i, identity_map=first) is mug
+    assert Item(i, identity_map=second) is not mug
+    assert Item(i) is not mug and Item(i).name == 'mug'
+    assert Item(999, identity_map=first).id == 999 # lazy, nothing read yet
+    with pytest.raises(models.DoesNotExistException):
+        Item(999).name
+
+def test_constructors_read_nothing(r, monkeypatch):
+    u = User(name='Una', create=True)
+    g = u.create_group('crew')
+    i = u.create_item('rope')
+    monkeypatch.setattr(models, 'r', None) # any read would fail
+    assert User(u.id).id == u.id and Item(i).id == i and Group(g).id == g
+    monkeypatch.undo()
+    assert User(u.id).name == 'Una' and Item(i).name == 'rope' and Group(g).name == 'crew'
+    with pytest.raises(models.DoesNotExistException):
+        User(999).name
+
+def test_name_lookup_does_not_create(r):
+    with pytest.raises(models.DoesNotExistException):
+        User(name='nobody')
+    assert not r.exists(User._id % 'nobody')
+    u = User(name='Vic', create=True)
+    assert User(name='VIC').id == u.id and User(name='VIC').name == 'Vic'
+    assert User(name='vic', create=True).id == u.id
+
+def test_update_ids_limit(r):
+    u = User(name='tia', create=True)
+    for n in range(5):
+        u.add_update('note %d' % n)
+    assert len(u.update_ids(3)) == 3
+    assert u.update_texts(2) == ['note 4', 'note 3']
+    assert len(u.update_ids()) == 5
+
+def test_async_writes(r, ar):
+    from tornado.ioloop import IOLoop
+    owner, other = User(name='uma', create=True), User(name='vic', create=True)
+    client = ar
+    run = IOLoop.current().run_sync
+    g = run(lambda: owner.async_create_group(client, 'choir'))
+    assert Group(g).name == 'choir' and r.sismember(owner.rcreated_groups, g)
+    other.add_to_group(g)
+    assert run(lambda: other.fetch_visible_groups(client, [g, 999])) == [g]
+    i = owner.create_item('hymn book')
+    assert run(lambda: other.async_assign_item(client, i))
+    assert r.sismember(other.rassigned_items, i) and r.sismember(Item._members % i, other.id)
+    u = run(lambda: owner.async_add_update(client, 'practice at 8', group_id=g))
+    assert owner.update_texts() == ['practice at 8']
+    for key in (models.Timeline._group % g, models.Timeline._user % other.id):
+        assert r.zscore(key, u)
+    assert run(lambda: owner.async_create_group(client, 'band')) > g
@@ -0,0 +1,28 @@
+'''pack.py moving Items and Groups into their hashes, read back with --packed'''
+import models
+from models import User, Item, Group
+
+def test_pack_then_read_packed(store):
+    u = User(name='pam', create=True)
+    g = u.create_group('quilters')
+    Group(g).set_attr('motto', 'stitch')
+    i = u.create_item('thimble')
+    Item(i).set_group(g)
+    Item(i).set_string_attr('colour', 'silver')
+    assert 'Item: packed 1 objects (4 keys)' in store.run('pack.py', '--pause=0')
+    r = store.engine
+    assert not r.exists(Item._name % i) and not r.exists(Group._name % g)
+    models.set_packed()
+    try:
+        item = Item(i)
+        assert item.name == 'thimble' and item.get_string_attr('colour') == 'silver'
+        assert item.fields() == {'name': 'thimble', 'creator': u.id, 'group': str(g), 'attr:colour': 'silver'}
+        assert Group(g).name == 'quilters' and Group(g).get_attr('motto') == 'stitch'
+        assert Group(g).get_creator() == u.id
+        assert Item.names([i])[i] == 'thimble'
+        # written packed from here on
+        Item(i).rename('brass thimble')
+        assert r.hget(Item._hash % i, 'name') == 'brass thimble' and not r.exists(Item._name % i)
+    finally:
+        models.set_packed(False)
+    assert 'Item: packed 0 objects' in store.run('pack.py', '--pause=0')
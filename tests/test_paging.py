@@ -0,0 +1,53 @@
+'''Streaming and paging big collections on both backends'''
+import models
+from models import User, Item, Group
+
+def all_pages(page, count):
+    seen, cursor = [], None
+    while True:
+        found, cursor = page(cursor, count)
+        seen.extend(found)
+        if not cursor:
+            return seen
+
+def test_group_items_page_while_items_are_added(r):
+    owner = User(name='hana', create=True)
+    g = Group(owner.create_group('library'))
+    ids = [ owner.create_item('book %d' % n) for n in range(7) ]
+    for id in ids:
+        g.add_item(id)
+    first, cursor = g.items_page(count=3)
+    newer = owner.create_item('new book')
+    g.add_item(newer) # on the head, before what we have seen
+    rest = all_pages(lambda c, n: g.items_page(c or cursor, n), 3)
+    assert [ int(i) for i in first + rest ] == ids[::-1]
+    assert [ int(i) for i in g.iter_items(window=2) ] == [newer] + ids[::-1]
+
+def test_user_items_union_comes_out_once(r):
+    u, other = User(name='ivo', create=True), User(name='jan', create=True)
+    mine = [ u.create_item('mine %d' % n) for n in range(6) ]
+    theirs = [ other.create_item('theirs %d' % n) for n in range(6) ]
+    for id in mine[:3] + theirs:
+        u.assign_item(id) # some of our own too
+    expected = sorted(mine + theirs)
+    assert sorted( int(i) for i in all_pages(u.items_page, 4) ) == expected
+    assert sorted( int(i) for i in u.iter_items(count=4) ) == expected
+    assert sorted( int(i) for i in u.items() ) == expected
+
+def test_components_and_comments(r):
+    i = Item(User(name='kai', create=True).create_item('recipe'))
+    for n in range(9):
+        i.add_component('step %d' % n)
+        i.post_comment('yum %d' % n, when=n + 1)
+    assert sorted( c for c, _ in all_pages(i.components_page, 4) ) == [ 'step %d' % n for n in range(9) ]
+    assert sorted( c for c, _ in i.iter_components(count=4) ) == [ 'step %d' % n for n in range(9) ]
+    assert [ when for _, when in all_pages(i.comments_page, 4) ] == [ float(n + 1) for n in range(9) ]
+    assert len(list(i.iter_comments(count=4))) == 9
+
+def test_list_page_when_items_go(r):
+    for n in range(10):
+        r.rpush('stream', n)
+    first, cursor = models.list_page('stream', count=4, head=False)
+    r.lrem('stream', 0, '2') # already seen
+    rest = all_pages(lambda c, n: models.list_page('stream', c or cursor, n, head=False), 4)
+    assert first + rest == [ str(n) for n in range(10) ]
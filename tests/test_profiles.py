@@ -0,0 +1,36 @@
+'''Service profiles in one hash per user, and profiles.py moving the old keys'''
+import json
+
+from models import User
+
+def test_services_in_one_hash(r):
+    u = User(name='lou', create=True)
+    u.set_service('twitter', json.dumps({'screen_name': 'lou'}))
+    u.set_service('google', json.dumps({'email': 'lou@example.com'}))
+    assert u.get_service('twitter') == {'screen_name': 'lou'}
+    assert u.profiles() == {'twitter': {'screen_name': 'lou'}, 'google': {'email': 'lou@example.com'}}
+    assert u.del_service('twitter')
+    assert u.get_service('twitter') is None and list(u.profiles()) == ['google']
+
+def test_old_keys_are_read_until_moved(r):
+    u = User(name='mae', create=True)
+    r.set(User._service.format(id=u.id, service='facebook'), json.dumps({'uid': 1}))
+    assert u.get_service('facebook') == {'uid': 1}
+    assert u.profiles() == {'facebook': {'uid': 1}}
+
+def test_migrate(store):
+    u, v = User(name='ned', create=True), User(name='ora', create=True)
+    r = store.engine
+    r.set('ned:twitter', json.dumps({'from': 'login'}))
+    r.set(User._service.format(id=u.id, service='twitter'), json.dumps({'from': 'user key'}))
+    r.set(User._service.format(id=u.id, service='google'), json.dumps({'from': 'user key'}))
+    v.set_service('facebook', json.dumps({'from': 'app'}))
+    r.set('ora:facebook', json.dumps({'from': 'login'})) # older than what the app wrote
+    r.set('twitter:1234', 'ned') # a login lookup, it stays
+    assert 'moved 4 profiles' in store.run('profiles.py', '--pause=0')
+    r = store.engine
+    assert User(name='ned').profiles() == {'twitter': {'from': 'login'}, 'google': {'from': 'user key'}}
+    assert User(name='ora').profiles() == {'facebook': {'from': 'app'}}
+    assert not r.keys('*:twitter') and not r.keys('users:*:google') and not r.exists('ora:facebook')
+    assert r.get('twitter:1234') == 'ned'
+    assert 'moved 0 profiles' in store.run('profiles.py', '--pause=0')
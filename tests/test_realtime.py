@@ -0,0 +1,75 @@
+'''What connected browsers are sent'''
+import pytest
+from redis import asyncio as aioredis
+from tornado.escape import json_encode as encode
+from tornado.ioloop import IOLoop
+
+import models
+import realtime
+
+def test_group_update_is_sent_once():
+    sent = []
+    listener = realtime.Listener(sent.extend)
+    hub = realtime.Hub()
+    channels = [ models.event_channel(k) for k in (models.Timeline._user % 1, models.Timeline._group % 2) ]
+    hub.add(listener, channels)
+    event = encode({'type': 'update', 'id': '7', 'time': 1.0, 'text': 'hi'})
+    for channel in channels:
+        hub.on_message({'type': 'pmessage', 'pattern': 'events:*', 'channel': channel, 'data': event})
+    hub.flush()
+    assert sent == [event]
+
+def test_listener_forgets_old_messages():
+    sent = []
+    listener = realtime.Listener(sent.extend)
+    for n in range(listener.recent.maxlen + 1):
+        listener.push(str(n))
+    listener.flush()
+    listener.push('0')
+    listener.flush()
+    assert sent[-1] == '0' and len(listener.seen) == listener.recent.maxlen
+
+def test_usernames_from_other_processes():
+    hub = realtime.Hub()
+    hub.add(realtime.Usernames(), [models.username_channel])
+    message = {'type': 'pmessage', 'pattern': 'events:*', 'channel': models.username_channel, 'data': 'Rita'}
+    old = models.usernames
+    models.usernames = models.BloomFilter()
+    try:
+        hub.on_message(message)
+        hub.flush()
+        assert 'rita' in models.usernames
+    finally:
+        models.usernames = old
+
+def test_async_clients_follow_the_ring(monkeypatch):
+    import shard
+    monkeypatch.setattr(shard.options, 'redis_nodes', 'localhost:7001,localhost:7002,localhost:7003')
+    old = models.r, models.async_pool, models.async_pool_for
+    try:
+        shard.install()
+        ring = models.r.ring
+        assert shard.addresses() == [('localhost', 7001), ('localhost', 7002), ('localhost', 7003)]
+        assert models.async_pool_for('sessions:abc') is models.async_pool
+        pools = set()
+        for id in range(50):
+            key = models.User._created_groups % id
+            pool = models.async_pool_for(key)
+            assert pool.connection_kwargs['port'] == int(ring.node_for(key).split(':')[1])
+            pools.add(pool)
+        assert len(pools) == 3
+    finally:
+        models.use_client(old[0])
+        models.async_pool, models.async_pool_for = old[1:]
+
+def test_mget_across_servers(r, ar, monkeypatch):
+    home = models.async_pool
+    other = aioredis.BlockingConnectionPool(port=r.connection_pool.connection_kwargs['port'],
+            decode_responses=True)
+    monkeypatch.setattr(models, 'async_pool_for', lambda key: other if key.endswith('odd') else home)
+    r.set('a:odd', 1)
+    r.set('b:even', 2)
+    r.set('c:odd', 3)
+    keys = ['a:odd', 'b:even', 'missing:odd', 'c:odd']
+    values = IOLoop.current().run_sync(lambda: realtime.mget(ar, keys))
+    assert values == ['1', '2', None, '3']
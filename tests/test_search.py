@@ -0,0 +1,79 @@
+'''The search index and queries over it'''
+import json
+
+import pytest
+from tornado.ioloop import IOLoop
+
+import dump
+import models
+import search
+from models import User, Item
+
+@pytest.fixture
+def items(r):
+    owner, other = User(name='lee', create=True), User(name='max', create=True)
+    ids = dict(
+        bike=owner.create_item('red bike'),
+        trike=owner.create_item('red trike'),
+        hidden=other.create_item('red bike for max'),
+    )
+    Item(ids['trike']).add_component('{"note": "bike with three wheels"}')
+    Item(ids['bike']).post_comment('a bike bike bike')
+    return owner, ids
+
+def test_ranked_and_visible(items):
+    owner, ids = items
+    found, cursor = owner.search_items('red bike')
+    assert found == [str(ids['bike']), str(ids['trike'])] and cursor is None
+    assert owner.search_items('nothing')[0] == []
+    assert owner.search_items('the')[0] == []
+
+def test_pages(items):
+    owner, ids = items
+    first, cursor = owner.search_items('red', count=1)
+    second, _ = owner.search_items('red', cursor, count=1)
+    assert len(first) == len(second) == 1 and first != second
+    with pytest.raises(ValueError):
+        owner.search_items('red', count=0)
+
+def test_edits_update_the_index(r, items):
+    owner, ids = items
+    Item(ids['bike']).rename('blue cycle')
+    assert owner.search_items('red bike')[0] == [str(ids['trike'])]
+    assert owner.search_items('cycle')[0] == [str(ids['bike'])]
+    owner.destroy_item(ids['trike'])
+    models.reaper.join()
+    assert owner.search_items('wheels')[0] == []
+    assert not r.keys(search._word % 'wheels')
+    assert not r.keys(search._query % '*')
+
+def test_async_search(r, items, ar):
+    owner, ids = items
+    client = ar
+    def run():
+        return owner.fetch_search_items(client, 'red bike', count=1)
+    found, cursor = IOLoop.current().run_sync(run)
+    assert found == owner.search_items('red bike', count=1)[0] == [str(ids['bike'])]
+    names = IOLoop.current().run_sync(lambda: Item.fetch_names(found, client))
+    assert names == {str(ids['bike']): 'red bike'}
+    assert not r.keys(search._query % '*')
+
+def test_load_indexes(r):
+    record = {'type': 'item', 'id': '40', 'name': 'old kettle', 'creator': '1', 'group': None,
+        'attrs': {}, 'members': [], 'components': [['{"a": "copper"}', 1]],
+        'comments': [['3', 1.0, 'still boils']], 'old_comments': [['8', 'whistles']]}
+    dump.load([json.dumps(record)])
+    user = User(name='ned', create=True)
+    r.sadd(user.rcreated_items, '40')
+    for word in ('kettle', 'copper', 'boils', 'whistles'):
+        assert user.search_items(word)[0] == ['40']
+    assert r.lrange(Item._comment_list % 40, 0, -1) == ['8']
+
+def test_rebuild(store):
+    owner = User(name='oz', create=True)
+    i = owner.create_item('green lantern')
+    Item(i).post_comment('still lit')
+    store.engine.delete(*store.engine.keys(search._word % '*'))
+    assert owner.search_items('lantern')[0] == []
+    assert 'indexed 1 items' in store.run('search.py', '--rebuild_search')
+    assert owner.search_items('green lantern lit')[0] == [str(i)]
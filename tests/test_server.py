@@ -0,0 +1,75 @@
+'''The supervisor with forked stand-ins for the workers'''
+import os
+import time
+import signal
+
+import pytest
+
+import server
+
+def fake_serve(sockets, ready):
+    '''A worker that serves until SIGTERM, or dies at once when told to'''
+    if os.environ.get('FAKE_WORKER') == 'broken':
+        os._exit(1)
+    signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    os.write(ready, b'1')
+    os.close(ready)
+    while True:
+        time.sleep(1)
+
+@pytest.fixture
+def supervisor(monkeypatch):
+    monkeypatch.setattr(server, 'serve', fake_serve)
+    monkeypatch.setattr(server.options, 'ready_timeout', 5.0)
+    monkeypatch.setattr(server.options, 'grace', 1.0)
+    monkeypatch.delenv('FAKE_WORKER', raising=False)
+    s = server.Supervisor([], 2)
+    s.start()
+    yield s
+    s.stop()
+
+def reap_until(supervisor, done):
+    for _ in range(100):
+        supervisor.reap()
+        if done():
+            return
+        time.sleep(0.05)
+    raise AssertionError('timed out')
+
+def alive(pid):
+    try:
+        return os.waitpid(pid, os.WNOHANG) == (0, 0)
+    except OSError:
+        return False
+
+def test_a_dead_worker_is_replaced(supervisor):
+    dead, kept = list(supervisor.workers)
+    os.kill(dead, signal.SIGKILL)
+    reap_until(supervisor, lambda: dead not in supervisor.workers)
+    assert len(supervisor.workers) == 2 and kept in supervisor.workers
+
+def test_a_retired_worker_is_not(supervisor):
+    gone, kept = list(supervisor.workers)
+    supervisor.retire(gone)
+    reap_until(supervisor, lambda: gone not in supervisor.workers)
+    assert list(supervisor.workers) == [kept] and not supervisor.retiring
+
+def test_reload_replaces_every_worker(supervisor):
+    old = set(supervisor.workers)
+    supervisor.reload()
+    reap_until(supervisor, lambda: not supervisor.retiring)
+    assert len(supervisor.workers) == 2 and not old & set(supervisor.workers)
+    assert all(alive(pid) for pid in supervisor.workers)
+
+def test_reload_onto_broken_code_keeps_the_old_workers(supervisor, monkeypatch):
+    old = set(supervisor.workers)
+    monkeypatch.setenv('FAKE_WORKER', 'broken')
+    supervisor.reload()
+    reap_until(supervisor, lambda: not supervisor.retiring)
+    supervisor.reap()
+    assert set(supervisor.workers) == old
+
+def test_stop(supervisor):
+    pids = list(supervisor.workers)
+    supervisor.stop()
+    assert not supervisor.workers and not any(alive(pid) for pid in pids)
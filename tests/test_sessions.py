@@ -0,0 +1,28 @@
+'''Server side sessions, see sessions.py'''
+from tornado.ioloop import IOLoop
+
+import sessions
+
+def test_start_lookup_end(r, ar):
+    run = IOLoop.current().run_sync
+    token = run(lambda: sessions.start(ar, 'sam'))
+    assert isinstance(token, str) and len(token) == 40
+    key = sessions._session % token
+    assert r.hgetall(key)['name'] == 'sam'
+    assert 0 < r.ttl(key) <= sessions.SESSION_TTL
+    r.expire(key, 10)
+    assert run(lambda: sessions.lookup(ar, token)) == 'sam'
+    assert r.ttl(key) > 10 # slid forward
+    run(lambda: sessions.end(ar, token))
+    assert not r.exists(key)
+    assert run(lambda: sessions.lookup(ar, token)) is None
+
+def test_start_is_one_transaction(r, ar, monkeypatch):
+    sent = []
+    pipeline = ar.pipeline
+    def spy(transaction=True):
+        sent.append(transaction)
+        return pipeline(transaction=transaction)
+    monkeypatch.setattr(ar, 'pipeline', spy)
+    IOLoop.current().run_sync(lambda: sessions.start(ar, 'sam'))
+    assert sent == [True]
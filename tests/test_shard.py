@@ -0,0 +1,87 @@
+'''The models sharded over several redis-servers, and shard.py moving keys'''
+import pytest
+
+import models
+import shard
+from models import User, Item, Group, Timeline
+from conftest import using
+
+def names(ports):
+    return [ 'localhost:%d' % port for port in ports ]
+
+@pytest.fixture
+def nodes(redis_ports):
+    for node in names(redis_ports):
+        shard.connect(node).flushdb()
+    return names(redis_ports)
+
+@pytest.fixture
+def sharded(nodes):
+    '''``models.r`` sharded over every node'''
+    old = models.r
+    client = shard.ShardedRedis(nodes)
+    using(client)
+    yield client
+    models.reaper.join()
+    models.use_client(old)
+
+def test_routing_is_stable():
+    nodes = ['a:1', 'b:2', 'c:3']
+    ring, again = shard.Ring(nodes), shard.Ring(list(nodes))
+    keys = [ t % id for id in range(200) for t in (Item._name, Item._hash, User._created_items, Timeline._group) ]
+    assert [ ring.node_for(k) for k in keys ] == [ again.node_for(k) for k in keys ]
+    for id in range(200):
+        assert ring.node_for(Item._name % id) == ring.node_for(Item._hash % id) == ring.node_for(Item._attrs % id + 'x')
+        assert ring.node_for(User._created_items % id) == ring.node_for(Timeline._user % id)
+    assert ring.node_for('sessions:abc') == ring.node_for(User._id % 'ann') == 'a:1'
+    # a fourth node takes about a quarter of the keys, nothing else moves
+    bigger = shard.Ring(nodes + ['d:4'])
+    moved = [ k for k in keys if bigger.node_for(k) != ring.node_for(k) ]
+    assert all(bigger.node_for(k) == 'd:4' for k in moved)
+    assert 0.1 < len(moved) / float(len(keys)) < 0.4
+
+def test_pipeline_over_every_node(sharded, nodes):
+    keys = [ Item._name % id for id in range(30) ]
+    assert len(set( sharded.ring.node_for(k) for k in keys )) == 3
+    pipe = sharded.pipeline()
+    for n, key in enumerate(keys):
+        pipe.set(key, n)
+        pipe.incr(key)
+    pipe.mget(keys)
+    replies = pipe.execute()
+    assert replies[:-1] == [ reply for n in range(30) for reply in (True, n + 1) ]
+    assert replies[-1] == [ str(n + 1) for n in range(30) ]
+    for key in keys:
+        assert shard.connect(sharded.ring.node_for(key)).get(key) == sharded.get(key)
+    assert sharded.delete(*keys) == 30
+
+def test_models_on_shards(sharded):
+    u = User(name='mona', create=True)
+    g = u.create_group('potters')
+    ids = [ u.create_item('bowl %d' % n) for n in range(10) ]
+    for i in ids:
+        Item(i).set_group(g)
+    assert sorted(Group(g).get_items()) == sorted(str(i) for i in ids)
+    assert sorted(u.items()) == sorted(str(i) for i in ids)
+    update = u.add_update('kiln is hot', group_id=g)
+    assert sharded.zscore(Timeline._group % g, update)
+
+def test_add_a_node(nodes):
+    two = nodes[:2]
+    old = models.r
+    try:
+        using(shard.ShardedRedis(two))
+        u = User(name='nell', create=True)
+        ids = [ u.create_item('jar %d' % n) for n in range(40) ]
+        assert shard.rebalance(shard.Ring(two), shard.Ring(nodes)) > 0
+        three = shard.ShardedRedis(nodes)
+        using(three)
+        assert User(name='nell').id == u.id
+        assert sorted(Item.names(ids).values()) == sorted('jar %d' % n for n in range(40))
+        for node, client in three.clients.items():
+            assert all(three.ring.node_for(k) == node for k in client.keys())
+        # done already, running it again moves nothing
+        assert shard.rebalance(shard.Ring(two), shard.Ring(nodes)) == 0
+    finally:
+        models.reaper.join()
+        models.use_client(old)
@@ -0,0 +1,69 @@
+'''Timelines on both backends, the redis one runs the Lua'''
+import models
+from models import User, Timeline
+
+def pages(timeline, count):
+    seen, cursor = [], None
+    while True:
+        entries, cursor = timeline.page(cursor, count)
+        seen.extend(entries)
+        if not cursor:
+            return seen
+
+def test_pages_keep_updates_at_the_same_time(r):
+    u = User(name='eve', create=True)
+    key = Timeline._user % u.id
+    ids = [ models.create_object('updates_incr', [('SET', User._update_str, 'same %d' % n)]) for n in range(5) ]
+    models.fan_out(ids[0], [key], when=50)
+    models.fan_out(ids[1], [key], when=100)
+    for id in ids[2:]:
+        models.fan_out(id, [key], when=100)
+    seen = pages(u.timeline(), 2)
+    assert [ int(id) for id, _, _ in seen ] == [ int(m) for m in r.zrevrange(key, 0, -1) ]
+    assert len(seen) == 5 and seen[-1][1] == 50.0
+
+def test_deleted_updates_are_left_out(r):
+    u = User(name='fin', create=True)
+    ids = [ u.add_update('note %d' % n) for n in range(4) ]
+    u.del_update(ids[1])
+    models.fan_out(ids[1], [Timeline._user % u.id]) # a copy the delete missed
+    texts = [ text for _, _, text in pages(u.timeline(), 3) ]
+    assert texts == ['note 3', 'note 2', 'note 0']
+
+def test_old_cursor(r):
+    u = User(name='gil', create=True)
+    key = Timeline._user % u.id
+    for when in (10, 20, 30):
+        models.fan_out(u.add_update('at %d' % when), [key], when=when)
+    entries, _ = u.timeline().page('20.0', 5)
+    assert [ text for _, _, text in entries ] == ['at 10']
+
+def test_group_updates_reach_the_creator(r):
+    owner, member = User(name='hugh', create=True), User(name='ines', create=True)
+    g = owner.create_group('rowing')
+    models.Group(g).add_member(member.id)
+    assert not r.sismember(models.Group._members % g, owner.id)
+    u = member.add_update('outing sunday', group_id=g)
+    assert r.zscore(Timeline._user % owner.id, u)
+    models.set_packed()
+    try:
+        packed = owner.create_group('sculls')
+        models.Group(packed).add_member(member.id)
+        u = member.add_update('new oars', group_id=packed)
+        assert r.zscore(Timeline._user % owner.id, u)
+    finally:
+        models.set_packed(False)
+
+def test_async_group_updates_reach_the_creator(r, ar):
+    from tornado.ioloop import IOLoop
+    owner, member = User(name='jude', create=True), User(name='kurt', create=True)
+    models.set_packed()
+    try:
+        groups = [owner.create_group('fives')]
+    finally:
+        models.set_packed(False)
+    groups.append(owner.create_group('squash'))
+    for g in groups:
+        models.Group(g).add_member(member.id)
+        u = IOLoop.current().run_sync(lambda: member.async_add_update(ar, 'court at 6', group_id=g))
+        assert r.zscore(Timeline._user % owner.id, u)